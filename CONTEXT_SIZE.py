@@ -1,7 +1,13 @@
+# Files listed as the most relevant documents of the selected branches
 GIT_DOCUMENTS = 5
 GIT_TO_RANK = 20
 GIT_DIVERSE_K = 50
 
-SHARED_DOCUMENTS = 5
 SHARED_TO_RANK = 20
 SHARED_DIVERSE_K = 50
+
+# Prompt tokens are capped to bound prefill time, the answer is reserved
+MAX_PROMPT_TOKENS = 12000
+ANSWER_TOKENS = 2048
+# Fraction of the budget used, token counts of local models are estimates
+TOKEN_SAFETY = 0.9
@@ -9,3 +9,14 @@ LLM_MODELS = {
     "Llama-3.2-1B": "http://localhost:5000/v1",
     "Llama-3.2-3B": "http://localhost:5000/v1",
 }
+# Context window in tokens of each model, local models as they are served
+CONTEXT_WINDOWS = {
+    "gpt-3.5-turbo": 16385,
+    "gpt-4-turbo": 128000,
+    "gpt-4o": 128000,
+    "gpt-4o-mini": 128000,
+    "o1-mini": 128000,
+    "Llama-3.2-1B": 8192,
+    "Llama-3.2-3B": 8192,
+}
+DEFAULT_CONTEXT_WINDOW = 8192
@@ -20,6 +20,20 @@ Document: """{document}"""
 Relevant:
 '''
 
+RERANK_BATCH_PROMPT = '''You are an Assistant responsible for helping detect whether the retrieved documents are relevant to the query. For every document, in the given order, you need to output a single line with the document number and a single token: "Yes" or "No" indicating the document is relevant to the query.
+
+Query: Has the coronavirus vaccine been approved?
+Document 1: """The Pfizer-BioNTech COVID-19 vaccine was approved for emergency use in the United States on December 11, 2020."""
+Document 2: """Influenza viruses circulate all year round, most cases occur during the winter."""
+Relevant:
+1: Yes
+2: No
+
+Query: {query}
+{documents}
+Relevant:
+'''
+
 JUDGEMENT_PROMPT = """You are an Assistant responsible for detecting if provided answers are of good quality. For a given input, you need to output a single judgemnet of "Excellent", "Good", "Fair", "Poor", or "Bad".
 You are given the question, the answer, and the source of the answer. Please provide a judgement on the quality of the answer based on the source.
 
@@ -0,0 +1,138 @@
+import hashlib
+import sqlite3
+import threading
+import time
+import numpy as np
+
+
+class AnswerCache:
+    """Persistent cache of answers to semantically repeated questions.
+
+    Answers are stored with the embedding of their question under a selection
+    key, covering the selected branches and shared files, the model and the
+    prompts. A question is answered from the cache when the embedding of an
+    already answered question of the same selection has a cosine similarity
+    of at least `threshold`. Every entry records the datasets it was answered
+    from, so all entries of a dataset can be dropped when it is re-indexed.
+    Once more than `max_entries` are stored, the least recently used are
+    removed. A `max_entries` of 0 disables the cache.
+    """
+
+    def __init__(self, path: str, max_entries: int = 0, threshold: float = 0.97):
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self.lock = threading.Lock()
+        self.connection = None
+        if max_entries <= 0:
+            return
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            """CREATE TABLE IF NOT EXISTS answers (
+                selection TEXT,
+                datasets TEXT,
+                question TEXT,
+                embedding BLOB,
+                answer TEXT,
+                last_used REAL
+            )"""
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS answers_selection ON answers (selection)"
+        )
+        self.connection.commit()
+
+    @staticmethod
+    def selection_key(datasets: list[str], model: str, prompt: str):
+        """Key of the selected datasets, model and prompt version."""
+        key = "\n".join(sorted(datasets) + [model, prompt])
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def get(self, selection: str, embedding: list[float]):
+        """Find the answer of the most similar question of the selection.
+
+        Returns:
+            str: The cached answer, None if no question is similar enough.
+        """
+        if self.connection is None:
+            return None
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT rowid, embedding, answer FROM answers WHERE selection = ?",
+                (selection,),
+            ).fetchall()
+            if len(rows) == 0:
+                return None
+            embeddings = np.stack(
+                [np.frombuffer(row[1], dtype=np.float32) for row in rows]
+            )
+            query = np.asarray(embedding, dtype=np.float32)
+            similarities = (embeddings @ query) / np.maximum(
+                np.linalg.norm(embeddings, axis=1) * np.linalg.norm(query), 1e-12
+            )
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.threshold:
+                return None
+            self.connection.execute(
+                "UPDATE answers SET last_used = ? WHERE rowid = ?",
+                (time.time(), rows[best][0]),
+            )
+            self.connection.commit()
+            return rows[best][2]
+
+    def put(
+        self,
+        selection: str,
+        datasets: list[str],
+        question: str,
+        embedding: list[float],
+        answer: str,
+    ):
+        """Store the answer of a question asked over the given datasets."""
+        if self.connection is None:
+            return
+        # Delimited so a dataset can be matched exactly on invalidation
+        datasets = "\n" + "\n".join(datasets) + "\n"
+        with self.lock:
+            self.connection.execute(
+                "INSERT INTO answers VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    selection,
+                    datasets,
+                    question,
+                    np.asarray(embedding, dtype=np.float32).tobytes(),
+                    answer,
+                    time.time(),
+                ),
+            )
+            self.__evict()
+            self.connection.commit()
+
+    def invalidate(self, dataset: str):
+        """Drop every answer given from the dataset."""
+        if self.connection is None:
+            return
+        with self.lock:
+            self.connection.execute(
+                "DELETE FROM answers WHERE instr(datasets, ?) > 0",
+                ("\n" + dataset + "\n",),
+            )
+            self.connection.commit()
+
+    def __len__(self):
+        if self.connection is None:
+            return 0
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM answers").fetchone()[0]
+
+    def __evict(self):
+        count = self.connection.execute("SELECT COUNT(*) FROM answers").fetchone()[0]
+        if count <= self.max_entries:
+            return
+        # Evict a tenth of the cache at once to not evict on every insert
+        overflow = count - self.max_entries + self.max_entries // 10
+        self.connection.execute(
+            """DELETE FROM answers WHERE rowid IN (
+                SELECT rowid FROM answers ORDER BY last_used LIMIT ?
+            )""",
+            (overflow,),
+        )
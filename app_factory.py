@@ -0,0 +1,201 @@
+"""Command line options and construction shared by all entry points.
+
+The Gradio app, batch_answer.py and evaluate_retrieval.py build their
+RetrivalAugment here, so the command line tools do not import Gradio.
+"""
+import argparse
+from metrics import METRICS
+from retrival_augment_git import RetrivalAugment, RERANKERS, INDEX_PRECISIONS
+
+
+parser = argparse.ArgumentParser()
+
+parser.add_argument(
+    "--max-branch-boxes",
+    default=10,
+    type=int,
+    help="Maximal number of branches to cache at once",
+)
+parser.add_argument(
+    "--rerank",
+    nargs="?",
+    const="llm",
+    default=None,
+    choices=RERANKERS,
+    help="Rerank the documents based on the query, with the LLM if no backend given",
+)
+parser.add_argument(
+    "--cross-encoder-model",
+    default="cross-encoder/ms-marco-MiniLM-L-6-v2",
+    help="Model of the cross-encoder reranker",
+)
+parser.add_argument(
+    "--keep-history", action="store_true", help="Keep the history of the chatbot"
+)
+parser.add_argument(
+    "--judge", action="store_true", help="Judge the quality of the answer"
+)
+parser.add_argument(
+    "--ingest-workers",
+    default=0,
+    type=int,
+    help="Number of processes loading and splitting files during ingestion",
+)
+parser.add_argument(
+    "--embed-concurrency",
+    default=4,
+    type=int,
+    help="Number of embedding requests kept in flight during ingestion",
+)
+parser.add_argument(
+    "--max-open-datasets",
+    default=64,
+    type=int,
+    help="Maximal number of branch and shared datasets kept open at once",
+)
+parser.add_argument(
+    "--dataset-memory-budget",
+    default=0,
+    type=float,
+    help="Memory budget in MiB of open datasets, 0 for no budget",
+)
+parser.add_argument(
+    "--pin-datasets",
+    nargs="*",
+    default=[],
+    help="Datasets never closed once opened, as <repo>@<branch> or shared filename",
+)
+parser.add_argument(
+    "--single-collection",
+    action="store_true",
+    help="Store all branches and shared files in one filtered vector collection",
+)
+parser.add_argument(
+    "--retrieval-concurrency",
+    default=8,
+    type=int,
+    help="Maximal number of datasets searched concurrently for one question",
+)
+parser.add_argument(
+    "--rerank-concurrency",
+    default=8,
+    type=int,
+    help="Maximal number of rerank calls in flight",
+)
+parser.add_argument(
+    "--rerank-batch-size",
+    default=1,
+    type=int,
+    help="Number of documents judged by one rerank call",
+)
+parser.add_argument(
+    "--ingest-processes",
+    default=0,
+    type=int,
+    help="Worker processes running ingestion jobs, 0 to index inside the request",
+)
+parser.add_argument(
+    "--refresh-interval",
+    default=0,
+    type=float,
+    help="Minutes between checks for new commits of cached branches, 0 to disable",
+)
+parser.add_argument(
+    "--repo-refresh-interval",
+    nargs="*",
+    metavar="URL=MINUTES",
+    help="Check interval of specific repositories, e.g. https://github.com/a/b.git=10",
+)
+parser.add_argument(
+    "--refresh-jitter",
+    default=0.1,
+    type=float,
+    help="Fraction of the check interval checks are randomly shifted by",
+)
+parser.add_argument(
+    "--download-concurrency",
+    default=4,
+    type=int,
+    help="Number of branch archives downloaded at once",
+)
+parser.add_argument(
+    "--rerank-cache-size",
+    default=100000,
+    type=int,
+    help="Maximal number of cached rerank scores, 0 to disable the cache",
+)
+parser.add_argument(
+    "--answer-cache-size",
+    default=0,
+    type=int,
+    help="Maximal number of cached answers to repeated questions, 0 to disable",
+)
+parser.add_argument(
+    "--answer-cache-threshold",
+    default=0.97,
+    type=float,
+    help="Cosine similarity of questions needed to reuse a cached answer",
+)
+parser.add_argument(
+    "--http-max-connections",
+    default=64,
+    type=int,
+    help="Maximal number of connections to each LLM and embedding endpoint",
+)
+parser.add_argument(
+    "--http-keepalive",
+    default=60.0,
+    type=float,
+    help="Seconds idle connections to the endpoints are kept alive",
+)
+parser.add_argument(
+    "--http-timeout",
+    default=120.0,
+    type=float,
+    help="Timeout in seconds of requests to the LLM and embedding endpoints",
+)
+parser.add_argument(
+    "--index-precision",
+    default="float32",
+    choices=INDEX_PRECISIONS,
+    help="Precision of stored vectors, float16 and int8 are re-scored exactly",
+)
+parser.add_argument(
+    "--index-dimensions",
+    default=0,
+    type=int,
+    help="Store only the first dimensions of vectors, 0 keeps all of them",
+)
+parser.add_argument(
+    "--port", default=7860, type=int, help="Port to run the Gradio server on"
+)
+parser.add_argument(
+    "--metrics-port",
+    default=0,
+    type=int,
+    help="Port of the Prometheus metrics endpoint /metrics, 0 to disable",
+)
+parser.add_argument(
+    "--metrics-host",
+    default="0.0.0.0",
+    help="Address the metrics endpoint listens on",
+)
+
+
+def create_retrival(args: argparse.Namespace, serving: bool = True):
+    """Build the RetrivalAugment of an entry point and serve its metrics.
+
+    Args:
+        args (argparse.Namespace): Options parsed by `parser`.
+        serving (bool): False for command line tools, ingestion worker
+            processes and refreshes then stay with the server.
+    Returns:
+        RetrivalAugment: The retrieval and answering pipeline.
+    """
+    if not serving:
+        args.ingest_processes = 0
+        args.refresh_interval = 0
+    retrival_class = RetrivalAugment(args=args)
+    if args.metrics_port > 0:
+        METRICS.serve(args.metrics_port, args.metrics_host)
+    return retrival_class
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+"""Answer questions of a JSONL file without the Gradio UI.
+
+Every input line is a JSON object with a "question" and optionally an "id",
+"repos" (git URLs ending with .git), "branches" (branch names, the latest
+cached branch of every repo if omitted), "shared" (cached shared files) and
+"model". Answers are appended to the output JSONL as they finish, so an
+interrupted run is resumed by running the same command again.
+
+    python batch_answer.py questions.jsonl answers.jsonl --parallel 8
+"""
+import os
+
+os.environ["TOKENIZERS_PARALLELISM"] = "true"
+import MODEL_TYPES
+import PROMPTS
+import argparse
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from context_packer import count_tokens
+from app_factory import parser as app_parser, create_retrival
+from retrival_augment_git import RetrivalAugment
+
+
+parser = argparse.ArgumentParser(
+    description="Answer questions of a JSONL file",
+    parents=[app_parser],
+    conflict_handler="resolve",
+)
+parser.add_argument("questions", help="Input JSONL file with the questions")
+parser.add_argument("answers", help="Output JSONL file the answers are appended to")
+parser.add_argument(
+    "--parallel", default=4, type=int, help="Number of questions answered at once"
+)
+parser.add_argument(
+    "--model",
+    default=list(MODEL_TYPES.LLM_MODELS.keys())[-1],
+    choices=list(MODEL_TYPES.LLM_MODELS.keys()),
+    help="Model used for questions without a model",
+)
+parser.add_argument(
+    "--api-key",
+    default=os.getenv("OPENAI_API_KEY", "metacentrum"),
+    help="API key of the model",
+)
+parser.add_argument("--temperature", default=0.7, type=float)
+parser.add_argument(
+    "--retry-errors",
+    action="store_true",
+    help="Answer again questions that failed in a previous run",
+)
+
+
+def load_questions(path: str):
+    """Questions of a JSONL file, numbered by their line if without an ID."""
+    records = []
+    with open(path, "r", encoding="utf-8") as file:
+        for i, line in enumerate(file):
+            if line.strip() == "":
+                continue
+            record = json.loads(line)
+            record.setdefault("id", i)
+            records.append(record)
+    return records
+
+
+def load_done(path: str, retry_errors: bool):
+    """IDs of questions already answered in the output file."""
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, "r", encoding="utf-8") as file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # Line cut off by an interruption
+                continue
+            if retry_errors and record.get("error") is not None:
+                continue
+            done.add(record["id"])
+    return done
+
+
+def question_versions(retrival_class: RetrivalAugment, record: dict):
+    """Cached versions of the branches a question asks about.
+
+    Returns:
+        list[str]: Versions as listed in the UI, the latest cached branch of
+            every repo if the question names no branches.
+    """
+    versions = []
+    for repo in record.get("repos", []):
+        cached = retrival_class._check_branch_cache(repo)
+        if record.get("branches") is None:
+            versions += cached[-1:]
+        else:
+            versions += [
+                version
+                for version in cached
+                if os.path.split(version)[1] in record["branches"]
+            ]
+    return versions
+
+
+def answer_question(retrival_class: RetrivalAugment, record: dict, args):
+    """Run retrieval and generation of one question.
+
+    Returns:
+        dict: The output record with the answer or the error.
+    """
+    repos = record.get("repos", [])
+    versions = question_versions(retrival_class, record)
+    model = record.get("model", args.model)
+    start = time.perf_counter()
+    answer, error = "", None
+    try:
+        for output in retrival_class(
+            git_repos=repos,
+            versions=versions,
+            inputs=[{"role": "user", "content": record["question"]}],
+            shared=record.get("shared", []),
+            temperature=args.temperature,
+            api_key=args.api_key,
+            model=model,
+            system_prompt=PROMPTS.SYSTEM_PROMPT,
+            rerank=args.rerank,
+            preserve_history=False,
+            judge_answer=args.judge,
+        ):
+            if isinstance(output, str):
+                # Requests that can not be answered yield a message
+                error = output
+            else:
+                answer = output[-1]["content"]
+    except Exception as e:
+        error = repr(e)
+    return {
+        "id": record["id"],
+        "question": record["question"],
+        "answer": answer,
+        "model": model,
+        "versions": versions,
+        "shared": record.get("shared", []),
+        "tokens": count_tokens(answer),
+        "seconds": time.perf_counter() - start,
+        "error": error,
+    }
+
+
+def main(args):
+    # Ingestion and refreshes stay with the server
+    retrival_class = create_retrival(args, serving=False)
+
+    records = load_questions(args.questions)
+    done = load_done(args.answers, args.retry_errors)
+    pending = [record for record in records if record["id"] not in done]
+    print(f"{len(records)} questions, {len(records) - len(pending)} already answered")
+
+    answered, errors, tokens = 0, 0, 0
+    start = time.perf_counter()
+    with open(args.answers, "a", encoding="utf-8") as output, ThreadPoolExecutor(
+        max_workers=max(1, args.parallel)
+    ) as executor:
+        futures = [
+            executor.submit(answer_question, retrival_class, record, args)
+            for record in pending
+        ]
+        try:
+            for future in as_completed(futures):
+                result = future.result()
+                output.write(json.dumps(result, ensure_ascii=False) + "\n")
+                output.flush()
+                answered += 1
+                tokens += result["tokens"]
+                if result["error"] is not None:
+                    errors += 1
+                    print(f"Question {result['id']} failed: {result['error']}")
+        except KeyboardInterrupt:
+            print("Interrupted, run again to resume")
+            for future in futures:
+                future.cancel()
+    seconds = time.perf_counter() - start
+    print(
+        f"Answered {answered} questions ({errors} errors) in {seconds:.1f} s: "
+        f"{answered / max(seconds, 1e-9):.2f} questions/s, "
+        f"{tokens / max(seconds, 1e-9):.1f} answer tokens/s"
+    )
+
+
+if __name__ == "__main__":
+    main(parser.parse_args())
@@ -0,0 +1,143 @@
+"""Micro-benchmark of merging similarity results into MMR results.
+
+Compares the NearDuplicateIndex used by EmbeddingsDataset with the former
+pairwise fuzzywuzzy partial_ratio merge, when fuzzywuzzy is installed. The
+similarity list repeats MMR chunks as exact copies, contained slices and
+copies with an edited character, all of which should be merged away.
+
+    python benchmarks/bench_dedup.py --k 20 --chunk-size 1024
+    python benchmarks/bench_dedup.py --overlap 0 --contained 1 --edited 0
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+import random
+import string
+import time
+from dedup import NearDuplicateIndex
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--k", default=20, type=int, help="Documents per result list")
+parser.add_argument("--chunk-size", default=1024, type=int, help="Chunk length")
+parser.add_argument(
+    "--overlap", default=0.25, type=float, help="Fraction of exact copies"
+)
+parser.add_argument(
+    "--contained", default=0.25, type=float, help="Fraction of contained slices"
+)
+parser.add_argument(
+    "--edited", default=0.25, type=float, help="Fraction of near-exact copies"
+)
+parser.add_argument("--repeats", default=5, type=int, help="Timed repetitions")
+
+
+def random_chunk(length: int, rng: random.Random):
+    words = []
+    while sum(len(word) + 1 for word in words) < length:
+        words.append(
+            "".join(rng.choices(string.ascii_lowercase, k=rng.randint(2, 10)))
+        )
+    return " ".join(words)[:length]
+
+
+def contained_slice(text: str, rng: random.Random):
+    """A slice of a fifth to a half of the chunk, e.g. a smaller chunk of it."""
+    length = rng.randint(len(text) // 5, len(text) // 2)
+    start = rng.randrange(len(text) - length + 1)
+    return text[start : start + length]
+
+
+def edited_copy(text: str, rng: random.Random):
+    """The chunk with a single character replaced."""
+    i = rng.randrange(len(text))
+    return text[:i] + rng.choice(string.ascii_lowercase) + text[i + 1 :]
+
+
+def make_results(
+    k: int,
+    chunk_size: int,
+    overlap: float,
+    contained: float = 0.0,
+    edited: float = 0.0,
+    seed: int = 0,
+):
+    """Build MMR and similarity lists sharing a fraction of their chunks.
+
+    Shared chunks are exact copies, slices contained in a chunk of the
+    other list or copies with an edited character.
+
+    Returns:
+        tuple: MMR chunks, similarity chunks and the expected merged count.
+    """
+    rng = random.Random(seed)
+    max_marginal = [random_chunk(chunk_size, rng) for _ in range(k)]
+    shared = rng.sample(max_marginal, int(k * overlap))
+    shared += [
+        contained_slice(text, rng)
+        for text in rng.sample(max_marginal, int(k * contained))
+    ]
+    shared += [
+        edited_copy(text, rng) for text in rng.sample(max_marginal, int(k * edited))
+    ]
+    shared = shared[:k]
+    max_similar = shared + [
+        random_chunk(chunk_size, rng) for _ in range(k - len(shared))
+    ]
+    rng.shuffle(max_similar)
+    return max_marginal, max_similar, 2 * k - len(shared)
+
+
+def merge_index(max_marginal: list[str], max_similar: list[str]):
+    merged = list(max_marginal)
+    dedup_index = NearDuplicateIndex()
+    for text in max_marginal:
+        dedup_index.add(text)
+    for text in max_similar:
+        if dedup_index.add(text):
+            merged.append(text)
+    return merged
+
+
+def merge_fuzz(max_marginal: list[str], max_similar: list[str]):
+    from fuzzywuzzy import fuzz
+
+    merged = list(max_marginal)
+    for text in max_similar:
+        if all(fuzz.partial_ratio(text, other) <= 95 for other in merged):
+            merged.append(text)
+    return merged
+
+
+def bench(merge, max_marginal, max_similar, repeats: int):
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        merged = merge(max_marginal, max_similar)
+        timings.append(time.perf_counter() - start)
+    return min(timings), len(merged)
+
+
+def main(args):
+    max_marginal, max_similar, expected = make_results(
+        args.k, args.chunk_size, args.overlap, args.contained, args.edited
+    )
+    merges = [("NearDuplicateIndex", merge_index)]
+    try:
+        import fuzzywuzzy
+
+        merges.append(("fuzz.partial_ratio", merge_fuzz))
+    except ImportError:
+        print("fuzzywuzzy not installed, skipping the pairwise baseline")
+
+    print(f"k={args.k} chunk_size={args.chunk_size} expected merged={expected}")
+    for name, merge in merges:
+        seconds, merged = bench(merge, max_marginal, max_similar, args.repeats)
+        print(f"{name:>20}: {seconds * 1000:9.2f} ms, merged {merged}")
+
+
+if __name__ == "__main__":
+    main(parser.parse_args())
@@ -0,0 +1,153 @@
+"""Recall, size and latency of quantized and truncated vector indexes.
+
+Compares the top-k chunks of every QuantizedIndex setting with the exact
+float32 search, without and with exact re-scoring of the oversampled
+candidates from the memory mapped float32 sidecar, as done by
+EmbeddingsDataset. Use the vectors of a real
+embedding cache, the synthetic vectors of the stand-in server only show
+the mechanics:
+
+    python benchmarks/bench_quantization.py --embedding-cache py_cache/embedding-cache
+    python benchmarks/bench_quantization.py --vectors 50000 --dimensions 0 256 128
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+import random
+import statistics
+import tempfile
+import time
+import numpy as np
+from fake_openai_server import embed_text
+from quantized_index import QuantizedIndex, INDEX_PRECISIONS, RESCORE_OVERSAMPLE
+from synthetic_repo import TOPICS, WORDS, questions
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    "--embedding-cache", default=None, help="Directory of cached chunk embeddings"
+)
+parser.add_argument("--vectors", default=20000, type=int, help="Vectors to index")
+parser.add_argument("--queries", default=200, type=int, help="Queries to search")
+parser.add_argument("--k", default=20, type=int, help="Results per query")
+parser.add_argument(
+    "--precisions", default=INDEX_PRECISIONS, choices=INDEX_PRECISIONS, nargs="+"
+)
+parser.add_argument(
+    "--dimensions",
+    default=[0, 256, 128],
+    type=int,
+    nargs="+",
+    help="Truncated dimensions, 0 keeps all of them",
+)
+parser.add_argument("--seed", default=0, type=int)
+
+
+def load_cache(directory: str, count: int, seed: int):
+    """Sample vectors of a chunk embedding cache, stored as raw float32."""
+    paths = [
+        os.path.join(root, name)
+        for root, _, names in os.walk(directory)
+        for name in names
+    ]
+    random.Random(seed).shuffle(paths)
+    vectors = []
+    for path in paths[:count]:
+        with open(path, "rb") as file:
+            vectors.append(np.frombuffer(file.read(), dtype=np.float32))
+    return np.asarray(vectors, dtype=np.float32)
+
+
+def synthetic_vectors(count: int, seed: int, dimensions: int = 384):
+    """Vectors of the stand-in server for random chunks of the synthetic repos."""
+    rng = random.Random(seed)
+    return np.asarray(
+        [
+            embed_text(
+                " ".join(rng.choices(WORDS + TOPICS, k=rng.randint(20, 120))),
+                dimensions,
+            )
+            for _ in range(count)
+        ],
+        dtype=np.float32,
+    )
+
+
+def normalize(vectors):
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=-1, keepdims=True), 1e-12)
+
+
+def exact_top_k(vectors, query, k: int):
+    return set(np.argsort(-(vectors @ query))[:k].tolist())
+
+
+def bench(vectors, queries, precision: str, dimensions: int, k: int, directory: str):
+    path = os.path.join(directory, f"{precision}-{dimensions}.npz")
+    index = QuantizedIndex(path, precision, dimensions)
+    index.add([str(i) for i in range(len(vectors))], vectors)
+    index.save()
+    # Searched as served, with the full vectors memory mapped
+    index = QuantizedIndex(path, precision, dimensions)
+    recalls, rescored_recalls, timings, rescore_timings = [], [], [], []
+    for query in queries:
+        exact = exact_top_k(vectors, query, k)
+        start = time.perf_counter()
+        hits = index.search(query, k)
+        timings.append(time.perf_counter() - start)
+        recalls.append(len(exact.intersection(int(i) for i, _ in hits)) / k)
+        start = time.perf_counter()
+        rescored, _, _ = index.rescored_search(query, k)
+        rescore_timings.append(time.perf_counter() - start)
+        rescored_recalls.append(len(exact.intersection(map(int, rescored))) / k)
+    return {
+        "bytes_per_vector": index.memory_usage() / len(vectors),
+        "recall": statistics.mean(recalls),
+        "rescored_recall": statistics.mean(rescored_recalls),
+        "search_ms": statistics.median(timings) * 1000,
+        "rescore_ms": statistics.median(rescore_timings) * 1000,
+    }
+
+
+def main(args):
+    if args.embedding_cache is not None:
+        vectors = load_cache(
+            args.embedding_cache, args.vectors + args.queries, args.seed
+        )
+        vectors, queries = vectors[args.queries :], vectors[: args.queries]
+    else:
+        vectors = synthetic_vectors(args.vectors, args.seed)
+        queries = np.asarray(
+            [embed_text(query, vectors.shape[1]) for query in questions(args.queries)],
+            dtype=np.float32,
+        )
+    vectors, queries = normalize(vectors), normalize(queries)
+    print(
+        f"{len(vectors)} vectors of {vectors.shape[1]} dimensions, "
+        f"{len(queries)} queries, recall@{args.k} against exact float32 search, "
+        f"re-scoring {RESCORE_OVERSAMPLE}x oversampled candidates"
+    )
+    print(
+        f"{'precision':>9} {'dims':>5} {'bytes/vector':>12} {'recall':>7} "
+        f"{'rescored':>8} {'search ms':>9} {'rescored ms':>11}"
+    )
+    with tempfile.TemporaryDirectory() as directory:
+        for precision in args.precisions:
+            for dimensions in args.dimensions:
+                if dimensions >= vectors.shape[1]:
+                    continue
+                result = bench(
+                    vectors, queries, precision, dimensions, args.k, directory
+                )
+                print(
+                    f"{precision:>9} {dimensions or vectors.shape[1]:>5} "
+                    f"{result['bytes_per_vector']:>12.0f} {result['recall']:>7.3f} "
+                    f"{result['rescored_recall']:>8.3f} {result['search_ms']:>9.2f} "
+                    f"{result['rescore_ms']:>11.2f}"
+                )
+
+
+if __name__ == "__main__":
+    main(parser.parse_args())
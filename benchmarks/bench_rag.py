@@ -0,0 +1,295 @@
+"""End-to-end benchmarks of ingestion, retrieval, reranking and answering.
+
+Runs RetrivalAugment against the bundled stand-in OpenAI server on synthetic
+repositories, so results only depend on this project and the given latency
+settings. Suites:
+
+    ingest     files/s and chunks/s of indexing a branch, cold and with all
+               chunk embeddings already in the embedding cache
+    retrieval  search latency over 1..N branches of the repository
+    rerank     latency and model calls of every reranker per question
+    ttft       time to the first streamed answer token and to the full answer
+
+    python benchmarks/bench_rag.py --files 1000 10000 --branches 1 2 4 \
+        --embed-item-latency 0.001 --chat-latency 0.2 --output results.json
+
+Extra branches are copies of the first one, they reuse its chunk
+embeddings and only pay for writing their own collection.
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+import json
+import shutil
+import statistics
+import tempfile
+import time
+import MODEL_TYPES
+from fake_openai_server import start_server
+from synthetic_repo import generate_repo, questions
+from retrival_augment_git import RetrivalAugment, RERANKERS
+
+REPO = "https://example.com/bench/repo.git"
+VERSION_PREFIX = "bench/repo"
+MODEL = "fake-llm"
+API_KEY = "bench"
+SUITES = ["ingest", "retrieval", "rerank", "ttft"]
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    "--files", default=[1000], type=int, nargs="+", help="Repository sizes to run"
+)
+parser.add_argument(
+    "--branches", default=[1, 2, 4], type=int, nargs="+", help="Branch counts"
+)
+parser.add_argument("--suites", default=SUITES, choices=SUITES, nargs="+")
+parser.add_argument(
+    "--rerankers",
+    default=["llm", "embedding"],
+    choices=RERANKERS,
+    nargs="+",
+    help="Rerankers of the rerank suite",
+)
+parser.add_argument("--queries", default=20, type=int, help="Questions per suite")
+parser.add_argument("--seed", default=0, type=int)
+parser.add_argument(
+    "--workdir", default=None, help="Keep the synthetic repositories here"
+)
+parser.add_argument("--output", default=None, help="Write the results as JSON")
+parser.add_argument("--ingest-workers", default=0, type=int)
+parser.add_argument("--embed-concurrency", default=4, type=int)
+parser.add_argument("--rerank-batch-size", default=1, type=int)
+parser.add_argument("--embed-latency", default=0.0, type=float)
+parser.add_argument("--embed-item-latency", default=0.0, type=float)
+parser.add_argument("--chat-latency", default=0.0, type=float)
+parser.add_argument("--token-latency", default=0.0, type=float)
+
+
+def percentiles(timings: list[float]):
+    """Median and 95th percentile in milliseconds."""
+    timings = sorted(timings)
+    p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+    return {"p50_ms": statistics.median(timings) * 1000, "p95_ms": p95 * 1000}
+
+
+def prepare(cache_dir: str, files: int, branches: int, seed: int):
+    """Write the branches and register them as cached, dropping old indexes."""
+    for name in os.listdir(cache_dir) if os.path.exists(cache_dir) else []:
+        if name != "repo":
+            path = os.path.join(cache_dir, name)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+    size = 0
+    for i in range(branches):
+        size = generate_repo(os.path.join(cache_dir, "repo", f"b{i}"), files, seed)
+    cached = {
+        "cached_repos": {
+            REPO: {
+                f"b{i}": {"path": f"{REPO.removesuffix('.git')}/tree/b{i}", "sha": ""}
+                for i in range(branches)
+            }
+        },
+        "cached_shared": [],
+    }
+    cache_repo_list = os.path.join(cache_dir, "cached_repos.json")
+    json.dump(cached, open(cache_repo_list, "w+"), indent=6)
+    return size
+
+
+def bench_ingest(retrival_class: RetrivalAugment, server, branches: int):
+    """Index every branch, the first cold and the others from the cache."""
+    results = {}
+    for i in range(branches):
+        server.reset()
+        start = time.perf_counter()
+        dataset = retrival_class._branch_dataset(REPO, f"b{i}")
+        seconds = time.perf_counter() - start
+        if i > 1:
+            # Indexed like the second branch
+            continue
+        files = sum(stats["files"] for stats in dataset.ingest_stats.values())
+        chunks = sum(stats["chunks"] for stats in dataset.ingest_stats.values())
+        results["cold" if i == 0 else "cached"] = {
+            "seconds": seconds,
+            "files_per_s": files / seconds,
+            "chunks_per_s": chunks / seconds,
+            "files": files,
+            "chunks": chunks,
+            "embedding_requests": server.counters["embeddings"],
+        }
+    return results
+
+
+def bench_retrieval(retrival_class: RetrivalAugment, branch_counts, queries):
+    """Latency of retrieving the documents of a question over N branches."""
+    results = {}
+    for count in branch_counts:
+        keys = [("repo", REPO, f"b{i}") for i in range(count)]
+        with retrival_class.datasets.lease(keys):
+            datasets = retrival_class._search_datasets(keys)
+            timings = []
+            for query in queries:
+                start = time.perf_counter()
+                retrival_class._retrieve_documents(
+                    query, datasets, [], count, 0, None, API_KEY, MODEL
+                )
+                timings.append(time.perf_counter() - start)
+        results[count] = percentiles(timings)
+    return results
+
+
+def bench_rerank(retrival_class: RetrivalAugment, server, rerankers, queries):
+    """Latency and model calls of reranking the documents of one branch."""
+    results = {}
+    keys = [("repo", REPO, "b0")]
+    with retrival_class.datasets.lease(keys):
+        datasets = retrival_class._search_datasets(keys)
+        # Embed the questions beforehand, only reranking calls are counted
+        for query in queries:
+            retrival_class._embed_query(query)
+        for rerank in rerankers:
+            server.reset()
+            timings = []
+            for query in queries:
+                start = time.perf_counter()
+                retrival_class._retrieve_documents(
+                    query, datasets, [], 1, 0, rerank, API_KEY, MODEL
+                )
+                timings.append(time.perf_counter() - start)
+            results[rerank] = {
+                **percentiles(timings),
+                "chat_requests_per_query": server.counters["chat"] / len(queries),
+                "embedded_per_query": server.counters["embedded"] / len(queries),
+            }
+    return results
+
+
+def bench_ttft(retrival_class: RetrivalAugment, queries):
+    """Time to the first answer token and to the full answer of a question."""
+    first, total = [], []
+    for query in queries:
+        start = time.perf_counter()
+        first_token = None
+        for output in retrival_class(
+            git_repos=[REPO],
+            versions=[f"{VERSION_PREFIX}/b0"],
+            inputs=[{"role": "user", "content": query}],
+            shared=[],
+            api_key=API_KEY,
+            model=MODEL,
+            rerank=False,
+            preserve_history=False,
+        ):
+            if first_token is None and output[-1]["content"] != "":
+                first_token = time.perf_counter() - start
+        first.append(first_token)
+        total.append(time.perf_counter() - start)
+    return {"first_token": percentiles(first), "answer": percentiles(total)}
+
+
+def run(args, files: int, workdir: str):
+    server = start_server(
+        embed_latency=args.embed_latency,
+        embed_item_latency=args.embed_item_latency,
+        chat_latency=args.chat_latency,
+        token_latency=args.token_latency,
+    )
+    MODEL_TYPES.DEFAULT_EMBED_LOC = server.base_url
+    MODEL_TYPES.LLM_MODELS[MODEL] = server.base_url
+
+    cache_dir = os.path.join(workdir, f"{files}-files")
+    branches = max(args.branches)
+    size = prepare(cache_dir, files, branches, args.seed)
+    print(f"{files} files, {size / 2**20:.1f} MiB per branch, {branches} branches")
+    retrival_class = RetrivalAugment(
+        os.path.join(cache_dir, "cached_repos.json"),
+        cache_dir,
+        argparse.Namespace(
+            ingest_workers=args.ingest_workers,
+            embed_concurrency=args.embed_concurrency,
+            rerank_batch_size=args.rerank_batch_size,
+            max_open_datasets=branches + 1,
+            # Measure the uncached paths
+            rerank_cache_size=0,
+            answer_cache_size=0,
+            ingest_processes=0,
+            refresh_interval=0,
+        ),
+    )
+    results = {"bytes_per_branch": size}
+    try:
+        # Later suites need the indexes, build them even when not measured
+        ingest = bench_ingest(retrival_class, server, branches)
+        if "ingest" in args.suites:
+            results["ingest"] = ingest
+            for name, stats in ingest.items():
+                print(
+                    f"  ingest {name:>6}: {stats['seconds']:8.2f} s, "
+                    f"{stats['files_per_s']:8.1f} files/s, "
+                    f"{stats['chunks_per_s']:8.1f} chunks/s, "
+                    f"{stats['embedding_requests']} embedding requests"
+                )
+        if "retrieval" in args.suites:
+            results["retrieval"] = bench_retrieval(
+                retrival_class,
+                sorted(args.branches),
+                questions(args.queries, args.seed),
+            )
+            for count, stats in results["retrieval"].items():
+                print(
+                    f"  retrieval {count:>3} branches: {stats['p50_ms']:8.1f} ms p50, "
+                    f"{stats['p95_ms']:8.1f} ms p95"
+                )
+        if "rerank" in args.suites:
+            results["rerank"] = bench_rerank(
+                retrival_class,
+                server,
+                args.rerankers,
+                questions(args.queries, args.seed + 1),
+            )
+            for rerank, stats in results["rerank"].items():
+                print(
+                    f"  rerank {rerank:>13}: {stats['p50_ms']:8.1f} ms p50, "
+                    f"{stats['p95_ms']:8.1f} ms p95, "
+                    f"{stats['chat_requests_per_query']:.1f} chat requests and "
+                    f"{stats['embedded_per_query']:.1f} embedded texts per question"
+                )
+        if "ttft" in args.suites:
+            results["ttft"] = bench_ttft(
+                retrival_class, questions(args.queries, args.seed + 2)
+            )
+            print(
+                f"  time to first token: "
+                f"{results['ttft']['first_token']['p50_ms']:8.1f} ms p50, "
+                f"{results['ttft']['first_token']['p95_ms']:8.1f} ms p95, "
+                f"full answer {results['ttft']['answer']['p50_ms']:8.1f} ms p50"
+            )
+    finally:
+        retrival_class.clients.close()
+        server.shutdown()
+        server.server_close()
+    return results
+
+
+def main(args):
+    workdir = args.workdir or tempfile.mkdtemp(prefix="rag-bench-")
+    results = {"settings": vars(args), "runs": {}}
+    try:
+        for files in args.files:
+            results["runs"][files] = run(args, files, workdir)
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+    if args.output is not None:
+        with open(args.output, "w+") as file:
+            json.dump(results, file, indent=6)
+
+
+if __name__ == "__main__":
+    main(parser.parse_args())
@@ -0,0 +1,270 @@
+"""OpenAI compatible stand-in server for benchmarks.
+
+Serves /v1/embeddings and /v1/chat/completions (streamed or not, with
+logprobs) with deterministic output and configurable latency, so benchmarks
+measure this project instead of the model servers.
+
+Embeddings hash the words (or token IDs) of a text into a normalized
+vector, so texts sharing words get similar vectors and retrieval behaves
+like with a real model. Rerank prompts are answered "Yes" for documents
+sharing words with the query.
+
+    python benchmarks/fake_openai_server.py --port 5001 --embed-latency 0.05
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import argparse
+import array
+import base64
+import hashlib
+import json
+import math
+import re
+import threading
+import time
+
+ANSWER = (
+    "Based on the provided documents, the requested feature is configured in "
+    "the project settings. See the referenced files for the exact options."
+)
+
+
+def embed_text(text, dimensions: int):
+    """Deterministic bag of words vector of a text or a list of token IDs."""
+    words = text.lower().split() if isinstance(text, str) else map(str, text)
+    vector = [0.0] * dimensions
+    for word in words:
+        digest = hashlib.blake2b(word.encode("utf-8"), digest_size=8).digest()
+        value = int.from_bytes(digest, "little")
+        vector[value % dimensions] += 1.0 if value & (1 << 63) else -1.0
+    norm = math.sqrt(sum(x * x for x in vector)) or 1.0
+    return [x / norm for x in vector]
+
+
+def _words(text: str):
+    return set(re.findall(r"[a-z0-9]+", text.lower()))
+
+
+class FakeOpenAIServer(ThreadingHTTPServer):
+    """Threaded server holding the latency settings and request counters.
+
+    Args:
+        dimensions (int): Size of the embedding vectors.
+        embed_latency (float): Seconds added to every embedding request.
+        embed_item_latency (float): Seconds added per embedded text.
+        chat_latency (float): Seconds until the first token of a completion.
+        token_latency (float): Seconds between streamed tokens.
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        address=("127.0.0.1", 0),
+        dimensions: int = 384,
+        embed_latency: float = 0.0,
+        embed_item_latency: float = 0.0,
+        chat_latency: float = 0.0,
+        token_latency: float = 0.0,
+    ):
+        super().__init__(address, _Handler)
+        self.dimensions = dimensions
+        self.embed_latency = embed_latency
+        self.embed_item_latency = embed_item_latency
+        self.chat_latency = chat_latency
+        self.token_latency = token_latency
+        self.counters = {"embeddings": 0, "embedded": 0, "chat": 0, "streams": 0}
+        self.lock = threading.Lock()
+
+    @property
+    def base_url(self):
+        return f"http://{self.server_address[0]}:{self.server_address[1]}/v1"
+
+    def count(self, name: str, value: int = 1):
+        with self.lock:
+            self.counters[name] += value
+
+    def reset(self):
+        with self.lock:
+            self.counters = {key: 0 for key in self.counters}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def __send_json(self, body: dict):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def __send_chunk(self, data: bytes):
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        if self.path.endswith("/embeddings"):
+            self.__embeddings(request)
+        elif self.path.endswith("/chat/completions"):
+            self.__chat(request)
+        else:
+            self.send_error(404)
+
+    def __embeddings(self, request: dict):
+        server = self.server
+        inputs = request["input"]
+        if isinstance(inputs, str) or (
+            len(inputs) > 0 and isinstance(inputs[0], int)
+        ):
+            inputs = [inputs]
+        server.count("embeddings")
+        server.count("embedded", len(inputs))
+        time.sleep(server.embed_latency + server.embed_item_latency * len(inputs))
+        data = []
+        for i, text in enumerate(inputs):
+            vector = embed_text(text, server.dimensions)
+            if request.get("encoding_format") == "base64":
+                vector = base64.b64encode(array.array("f", vector).tobytes()).decode()
+            data.append({"object": "embedding", "index": i, "embedding": vector})
+        self.__send_json(
+            {
+                "object": "list",
+                "data": data,
+                "model": request.get("model", "fake"),
+                "usage": {"prompt_tokens": 0, "total_tokens": 0},
+            }
+        )
+
+    def __completion(self, request: dict):
+        """Answer text and token logprobs of a chat request."""
+        # The rerank prompts start with an example, the request comes last
+        request_part = request["messages"][-1]["content"].split("Query:")[-1]
+        documents = re.findall(
+            r'Document (\d+): """(.*?)"""', request_part, re.DOTALL
+        )
+        if len(documents) > 0:
+            # Batched rerank, "<n>: Yes|No" per document
+            query = _words(request_part.split("\n")[0])
+            tokens = []
+            for number, document in documents:
+                relevant = len(query & _words(document)) > 0
+                tokens += [f"{number}:", " Yes" if relevant else " No", "\n"]
+            return tokens
+        if request.get("max_tokens") == 1:
+            # Single document rerank
+            return ["Yes"]
+        if request.get("max_tokens", 2048) <= 10:
+            # Answer judgement
+            return ["Good"]
+        return [word + " " for word in ANSWER.split()]
+
+    def __chat(self, request: dict):
+        server = self.server
+        server.count("chat")
+        tokens = self.__completion(request)
+        time.sleep(server.chat_latency)
+        created = int(time.time())
+        if not request.get("stream", False):
+            time.sleep(server.token_latency * len(tokens))
+            logprobs = None
+            if request.get("logprobs"):
+                logprobs = {
+                    "content": [
+                        {
+                            "token": token,
+                            "logprob": -0.05,
+                            "bytes": None,
+                            "top_logprobs": [],
+                        }
+                        for token in tokens
+                    ]
+                }
+            self.__send_json(
+                {
+                    "id": "chatcmpl-fake",
+                    "object": "chat.completion",
+                    "created": created,
+                    "model": request.get("model", "fake"),
+                    "choices": [
+                        {
+                            "index": 0,
+                            "message": {
+                                "role": "assistant",
+                                "content": "".join(tokens),
+                            },
+                            "logprobs": logprobs,
+                            "finish_reason": "stop",
+                        }
+                    ],
+                    "usage": {
+                        "prompt_tokens": 0,
+                        "completion_tokens": len(tokens),
+                        "total_tokens": len(tokens),
+                    },
+                }
+            )
+            return
+
+        server.count("streams")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for i, token in enumerate(tokens + [None]):
+            if i > 0:
+                time.sleep(server.token_latency)
+            chunk = {
+                "id": "chatcmpl-fake",
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": request.get("model", "fake"),
+                "choices": [
+                    {
+                        "index": 0,
+                        "delta": {} if token is None else {"content": token},
+                        "finish_reason": "stop" if token is None else None,
+                    }
+                ],
+            }
+            self.__send_chunk(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+        self.__send_chunk(b"data: [DONE]\n\n")
+        self.__send_chunk(b"")
+
+
+def start_server(**settings):
+    """Start the server in a background thread.
+
+    Returns:
+        FakeOpenAIServer: The running server, see `base_url`.
+    """
+    server = FakeOpenAIServer(**settings)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", default=5001, type=int)
+    parser.add_argument("--dimensions", default=384, type=int)
+    parser.add_argument("--embed-latency", default=0.0, type=float)
+    parser.add_argument("--embed-item-latency", default=0.0, type=float)
+    parser.add_argument("--chat-latency", default=0.0, type=float)
+    parser.add_argument("--token-latency", default=0.0, type=float)
+    args = parser.parse_args()
+    server = FakeOpenAIServer(
+        (args.host, args.port),
+        dimensions=args.dimensions,
+        embed_latency=args.embed_latency,
+        embed_item_latency=args.embed_item_latency,
+        chat_latency=args.chat_latency,
+        token_latency=args.token_latency,
+    )
+    print(f"Serving on {server.base_url}")
+    server.serve_forever()
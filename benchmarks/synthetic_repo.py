@@ -0,0 +1,116 @@
+"""Deterministic synthetic documentation repositories for benchmarks.
+
+Files are spread over nested directories as markdown, python and text
+files, built from a fixed vocabulary so chunks share words with the
+generated questions. The same seed and size always give the same tree.
+
+    python benchmarks/synthetic_repo.py /tmp/repo --files 10000
+"""
+
+import argparse
+import os
+import random
+
+# fmt: off
+TOPICS = [
+    "scheduler", "storage", "network", "quota", "module", "container",
+    "gpu", "license", "backup", "frontend", "kerberos", "cluster",
+    "queue", "memory", "walltime", "python", "compiler", "singularity",
+    "jupyter", "account", "project", "archive", "transfer", "mpi",
+]
+WORDS = [
+    "the", "job", "node", "user", "run", "set", "file", "path", "use",
+    "request", "default", "limit", "option", "command", "variable", "example",
+    "configure", "install", "submit", "output", "error", "version", "server",
+    "directory", "environment", "resource", "access", "script", "log", "time",
+]
+# fmt: on
+EXTENSIONS = [".md", ".md", ".py", ".txt"]
+
+
+def _sentence(rng: random.Random, topic: str):
+    words = rng.choices(WORDS, k=rng.randint(6, 16))
+    words.insert(rng.randrange(len(words)), topic)
+    return " ".join(words).capitalize() + "."
+
+
+def _markdown(rng: random.Random, topic: str, paragraphs: int):
+    lines = [f"# {topic.capitalize()} guide", ""]
+    for i in range(paragraphs):
+        lines += [f"## {topic.capitalize()} section {i}", ""]
+        lines.append(" ".join(_sentence(rng, topic) for _ in range(rng.randint(3, 8))))
+        lines.append("")
+    return "\n".join(lines)
+
+
+def _python(rng: random.Random, topic: str, paragraphs: int):
+    lines = []
+    for i in range(paragraphs):
+        lines += [
+            f"def {topic}_{rng.choice(WORDS)}_{i}(value):",
+            f'    """{_sentence(rng, topic)}"""',
+            f"    return value * {rng.randint(1, 100)}",
+            "",
+            "",
+        ]
+    return "\n".join(lines)
+
+
+def _text(rng: random.Random, topic: str, paragraphs: int):
+    return "\n\n".join(
+        " ".join(_sentence(rng, topic) for _ in range(rng.randint(2, 6)))
+        for _ in range(paragraphs)
+    )
+
+
+WRITERS = {".md": _markdown, ".py": _python, ".txt": _text}
+
+
+def generate_repo(directory: str, files: int, seed: int = 0, files_per_dir: int = 50):
+    """Write a synthetic repository, skipping files that already exist.
+
+    Args:
+        directory (str): Root directory of the repository.
+        files (int): Number of files to write.
+        seed (int): Seed of the contents, equal seeds give equal trees.
+        files_per_dir (int): Files per directory before nesting deeper.
+    Returns:
+        int: Total size of the files in bytes.
+    """
+    size = 0
+    for i in range(files):
+        rng = random.Random(f"{seed}-{i}")
+        topic = rng.choice(TOPICS)
+        extension = rng.choice(EXTENSIONS)
+        parts = []
+        index = i // files_per_dir
+        while index > 0:
+            parts.append(f"d{index % files_per_dir}")
+            index //= files_per_dir
+        path = os.path.join(directory, *parts, f"{topic}_{i}{extension}")
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w", encoding="utf-8") as file:
+                file.write(WRITERS[extension](rng, topic, rng.randint(1, 6)))
+        size += os.path.getsize(path)
+    return size
+
+
+def questions(count: int, seed: int = 0):
+    """Questions about the topics of the synthetic repositories."""
+    rng = random.Random(seed)
+    return [
+        f"How do I {rng.choice(WORDS)} the {rng.choice(TOPICS)} "
+        f"{rng.choice(WORDS)} option?"
+        for _ in range(count)
+    ]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("directory")
+    parser.add_argument("--files", default=1000, type=int)
+    parser.add_argument("--seed", default=0, type=int)
+    args = parser.parse_args()
+    size = generate_repo(args.directory, args.files, args.seed)
+    print(f"{args.files} files, {size / 2**20:.1f} MiB in {args.directory}")
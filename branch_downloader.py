@@ -0,0 +1,164 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from zipfile import ZipFile, BadZipFile
+import http.client
+import os
+import shutil
+import tarfile
+import tempfile
+import urllib.request
+import uuid
+
+
+class BranchDownloader:
+    """Download branch archives concurrently, extracting only indexed files.
+
+    Tarballs are streamed straight from the response into the branch
+    directory, members are never buffered on disk. Zip archives need a
+    seekable file, so they are only spooled to a temporary file when no
+    tarball is available. Members with extensions outside `extensions` and
+    hidden files are skipped. The branch directory is swapped in atomically
+    once the archive is complete.
+    """
+
+    def __init__(self, extensions=None, concurrency: int = 4, timeout: float = 60):
+        self.extensions = None if extensions is None else set(extensions)
+        self.concurrency = max(1, concurrency)
+        self.timeout = timeout
+
+    def archive_urls(self, repo_url: str, branch: str):
+        """Archive URLs of the branch in the order they are tried.
+
+        GitHub serves `/tarball/` and `/zipball/`, GitLab serves
+        `/-/archive/` (e.g. https://code.it4i.cz/sccs/docs.it4i.cz).
+        """
+        _, name = os.path.split(repo_url)
+        return [
+            (f"{repo_url}/tarball/{branch}", "tar"),
+            (f"{repo_url}/-/archive/{branch}/{name}-{branch}.tar.gz", "tar"),
+            (f"{repo_url}/zipball/{branch}", "zip"),
+            (f"{repo_url}/-/archive/{branch}/zipfile.zip", "zip"),
+        ]
+
+    def __member_path(self, name: str):
+        """Path of an archive member inside the branch, None if skipped.
+
+        The top level directory added by the forges is stripped.
+        """
+        parts = name.replace("\\", "/").split("/")[1:]
+        if len(parts) == 0 or parts[-1] == "":
+            return None
+        if any(part in ("", ".", "..") or part.startswith(".") for part in parts):
+            return None
+        if (
+            self.extensions is not None
+            and os.path.splitext(parts[-1])[1] not in self.extensions
+        ):
+            return None
+        return os.path.join(*parts)
+
+    def __write_member(self, source, directory: str, path: str):
+        destination = os.path.join(directory, path)
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        with open(destination, "wb") as file:
+            shutil.copyfileobj(source, file, 1 << 20)
+
+    def __extract_tar(self, response, directory: str):
+        with tarfile.open(fileobj=response, mode="r|gz") as archive:
+            for member in archive:
+                if not member.isfile():
+                    continue
+                path = self.__member_path(member.name)
+                if path is None:
+                    continue
+                self.__write_member(archive.extractfile(member), directory, path)
+
+    def __extract_zip(self, response, directory: str):
+        with tempfile.TemporaryFile() as spool:
+            shutil.copyfileobj(response, spool, 1 << 20)
+            spool.seek(0)
+            with ZipFile(spool, "r") as archive:
+                for member in archive.infolist():
+                    if member.is_dir():
+                        continue
+                    path = self.__member_path(member.filename)
+                    if path is None:
+                        continue
+                    with archive.open(member) as source:
+                        self.__write_member(source, directory, path)
+
+    def download(self, repo_url: str, branch: str, branch_dir: str):
+        """Download the branch into `branch_dir`, replacing its content.
+
+        Args:
+            repo_url (str): URL of the repository without the `.git` suffix.
+            branch (str): The branch to download.
+            branch_dir (str): Directory the branch files are extracted to.
+        Returns:
+            bool: True if the branch was downloaded.
+        """
+        parent = os.path.dirname(branch_dir)
+        os.makedirs(parent, exist_ok=True)
+        for url, kind in self.archive_urls(repo_url, branch):
+            partial_dir = os.path.join(parent, f".partial-{uuid.uuid4().hex}")
+            try:
+                with urllib.request.urlopen(url, timeout=self.timeout) as response:
+                    if kind == "tar":
+                        self.__extract_tar(response, partial_dir)
+                    else:
+                        self.__extract_zip(response, partial_dir)
+                os.makedirs(partial_dir, exist_ok=True)
+                self.__swap(partial_dir, branch_dir)
+                return True
+            except (
+                OSError,
+                http.client.HTTPException,
+                tarfile.TarError,
+                BadZipFile,
+                EOFError,
+            ) as e:
+                # IncompleteRead of a dropped connection is an HTTPException
+                print(f"Download of {url} failed: {e!r}")
+            finally:
+                # Gone after a successful swap
+                shutil.rmtree(partial_dir, ignore_errors=True)
+        return False
+
+    def __swap(self, partial_dir: str, branch_dir: str):
+        """Replace the branch directory with the freshly extracted one."""
+        if not os.path.exists(branch_dir):
+            os.rename(partial_dir, branch_dir)
+            return
+        old_dir = f"{partial_dir}.old"
+        os.rename(branch_dir, old_dir)
+        os.rename(partial_dir, branch_dir)
+        shutil.rmtree(old_dir, ignore_errors=True)
+
+    def download_many(self, repo_url: str, branches: list[str], branch_dir):
+        """Download several branches concurrently.
+
+        Args:
+            repo_url (str): URL of the repository without the `.git` suffix.
+            branches (list[str]): Branches to download.
+            branch_dir: Function returning the directory of a branch.
+        Yields:
+            tuple: Branch and whether it was downloaded, in completion order.
+                A failed branch does not stop the others.
+        """
+        if len(branches) == 0:
+            return
+        with ThreadPoolExecutor(
+            max_workers=min(self.concurrency, len(branches))
+        ) as executor:
+            futures = {
+                executor.submit(
+                    self.download, repo_url, branch, branch_dir(branch)
+                ): branch
+                for branch in branches
+            }
+            for future in as_completed(futures):
+                try:
+                    downloaded = future.result()
+                except Exception as e:
+                    print(f"Download of branch {futures[future]} failed: {e!r}")
+                    downloaded = False
+                yield futures[future], downloaded
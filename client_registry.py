@@ -0,0 +1,131 @@
+from openai import OpenAI
+import httpx
+import threading
+import time
+
+
+class _CountingTransport(httpx.HTTPTransport):
+    """HTTP transport reporting every request once it completes or fails."""
+
+    def __init__(self, on_request, on_done, **kwargs):
+        super().__init__(**kwargs)
+        self.on_request = on_request
+        self.on_done = on_done
+
+    def handle_request(self, request: httpx.Request):
+        self.on_request()
+        start = time.perf_counter()
+        response = None
+        try:
+            # Returns once the headers are received, the body is streamed
+            response = super().handle_request(request)
+            return response
+        finally:
+            self.on_done(time.perf_counter() - start, response)
+
+
+class ClientRegistry:
+    """Process wide OpenAI clients sharing tuned keep-alive connection pools.
+
+    One httpx client, and so one connection pool, is kept per endpoint and
+    shared by the OpenAI clients of every API key and by the embedding
+    models. Connections to the local servers and to OpenAI are kept alive
+    between requests instead of paying new TCP/TLS handshakes. Request counts,
+    errors, latency to the response headers and pool usage are collected per
+    endpoint.
+    """
+
+    def __init__(
+        self,
+        max_connections: int = 64,
+        max_keepalive_connections: int = 32,
+        keepalive_expiry: float = 60.0,
+        connect_timeout: float = 5.0,
+        timeout: float = 120.0,
+    ):
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self.timeout = httpx.Timeout(timeout, connect=connect_timeout)
+        self.http_clients = {}
+        self.openai_clients = {}
+        self.stats = {}
+        self.lock = threading.Lock()
+
+    def __on_request(self, base_url):
+        with self.lock:
+            stats = self.stats[base_url]
+            stats["requests"] += 1
+            stats["waiting"] += 1
+
+    def __on_done(self, base_url, latency: float, response: httpx.Response):
+        """Count a finished request, `response` is None if it raised."""
+        with self.lock:
+            stats = self.stats[base_url]
+            stats["waiting"] -= 1
+            stats["seconds"] += latency
+            if response is None or response.status_code >= 400:
+                stats["errors"] += 1
+
+    def http_client(self, base_url: str = None):
+        """The pooled httpx client of an endpoint, None for the OpenAI API."""
+        with self.lock:
+            if base_url not in self.http_clients:
+                self.stats[base_url] = {
+                    "requests": 0,
+                    "errors": 0,
+                    "waiting": 0,
+                    "seconds": 0.0,
+                }
+                self.http_clients[base_url] = httpx.Client(
+                    timeout=self.timeout,
+                    transport=_CountingTransport(
+                        lambda: self.__on_request(base_url),
+                        lambda latency, response: self.__on_done(
+                            base_url, latency, response
+                        ),
+                        limits=self.limits,
+                    ),
+                )
+            return self.http_clients[base_url]
+
+    def openai(self, base_url: str, api_key: str):
+        """The OpenAI client of an endpoint and API key, created on first use."""
+        http_client = self.http_client(base_url)
+        with self.lock:
+            key = (base_url, api_key)
+            if key not in self.openai_clients:
+                self.openai_clients[key] = OpenAI(
+                    api_key=api_key,
+                    base_url=base_url,
+                    http_client=http_client,
+                    timeout=self.timeout,
+                )
+            return self.openai_clients[key]
+
+    def metrics(self):
+        """Request and connection pool counters of every endpoint."""
+        with self.lock:
+            metrics = {}
+            for base_url, client in self.http_clients.items():
+                # httpx does not expose its pool, read it from httpcore
+                pool = getattr(getattr(client, "_transport", None), "_pool", None)
+                connections = list(getattr(pool, "connections", []))
+                metrics[base_url or "https://api.openai.com/v1"] = {
+                    **self.stats[base_url],
+                    "connections": len(connections),
+                    "idle_connections": sum(
+                        1 for connection in connections if connection.is_idle()
+                    ),
+                    "max_connections": self.limits.max_connections,
+                }
+            return metrics
+
+    def close(self):
+        with self.lock:
+            for client in self.http_clients.values():
+                client.close()
+            self.http_clients = {}
+            self.openai_clients = {}
@@ -0,0 +1,70 @@
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# Encoding used to count tokens, False when tiktoken is not usable
+_encoding = None
+
+
+def _get_encoding():
+    global _encoding
+    if _encoding is None:
+        try:
+            _encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception:
+            # Not installed or the encoding could not be downloaded
+            _encoding = False
+    return _encoding
+
+
+def count_tokens(text: str):
+    """Count the tokens of a text.
+
+    Uses the cl100k tokenizer of tiktoken when available, otherwise estimates
+    four characters per token. Local models tokenize differently, so counts
+    are treated as estimates and budgets keep a safety margin.
+    """
+    encoding = _get_encoding()
+    if encoding:
+        return len(encoding.encode(text, disallowed_special=()))
+    return (len(text) + 3) // 4
+
+
+def format_document(doc: dict):
+    """Format a retrieved document for the prompt."""
+    if doc.get("branch") is not None:
+        header = f'File: {doc["filename"]} (branch {doc["branch"]})'
+    else:
+        header = f'File: {doc["filename"]}'
+    return f'{header}\n{doc["content"]}\n'
+
+
+def document_tokens(doc: dict):
+    """Tokens of the formatted document, using the count stored at ingestion."""
+    if doc.get("tokens") is None:
+        return count_tokens(format_document(doc))
+    return count_tokens(format_document({**doc, "content": ""})) + doc["tokens"]
+
+
+def pack_documents(candidates: list[tuple], budget: int):
+    """Select the best scored documents that fit into the token budget.
+
+    Documents that do not fit are skipped, so smaller documents with lower
+    scores can still fill the remaining budget.
+
+    Args:
+        candidates (list[tuple]): Documents with their scores.
+        budget (int): Maximal number of tokens of the selected documents.
+    Returns:
+        tuple: Selected documents, most relevant first, and their tokens.
+    """
+    selected = []
+    used = 0
+    for doc, _ in sorted(candidates, key=lambda x: x[1], reverse=True):
+        tokens = document_tokens(doc)
+        if used + tokens > budget:
+            continue
+        selected.append(doc)
+        used += tokens
+    return selected, used
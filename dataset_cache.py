@@ -0,0 +1,185 @@
+from collections import OrderedDict, Counter
+from contextlib import contextmanager
+import threading
+
+
+class DatasetCache:
+    """Lazily opened embedding datasets with LRU eviction.
+
+    Datasets are registered with a factory and only opened on first use. At
+    most `max_open` datasets are kept open and, when `memory_budget` (bytes)
+    is set, the estimated memory of open datasets is kept under it. The least
+    recently used datasets that are not pinned or leased are closed first.
+    Datasets are opened outside of the lock, concurrent users of a dataset
+    being opened wait for it instead of opening it again.
+    """
+
+    def __init__(self, max_open: int = 64, memory_budget: int = 0, pinned=()):
+        self.max_open = max_open
+        self.memory_budget = memory_budget
+        self.pinned = set(pinned)
+        self.factories = {}
+        self.open = OrderedDict()
+        self.memory = {}
+        self.leases = Counter()
+        self.lock = threading.RLock()
+        # Notified when a dataset was opened, replaced or released by a lease
+        self.changed = threading.Condition(self.lock)
+        # Datasets being opened or swapped by `replace`
+        self.opening = set()
+        self.replacing = set()
+
+    def __contains__(self, key):
+        return key in self.factories
+
+    def keys(self):
+        return list(self.factories.keys())
+
+    def register(self, key, factory):
+        """Register a dataset to be opened by `factory` on first use."""
+        with self.lock:
+            self.factories[key] = factory
+
+    def put(self, key, dataset, factory):
+        """Add an already opened dataset, replacing any previous one."""
+        with self.lock:
+            previous = self.open.pop(key, None)
+            if previous is not None and previous is not dataset:
+                previous.close()
+            self.factories[key] = factory
+            self.open[key] = dataset
+            self.memory[key] = dataset.memory_usage()
+            self.__evict(keep=key)
+
+    def get(self, key):
+        """Return the dataset, opening it and evicting others if needed."""
+        with self.changed:
+            while key in self.opening or key in self.replacing:
+                self.changed.wait()
+            if key in self.open:
+                self.open.move_to_end(key)
+                return self.open[key]
+            factory = self.factories[key]
+            self.opening.add(key)
+        try:
+            dataset = factory()
+        finally:
+            with self.changed:
+                self.opening.discard(key)
+                self.changed.notify_all()
+        with self.lock:
+            if key in self.open:
+                # Put while it was being opened
+                dataset.close()
+                return self.open[key]
+            self.open[key] = dataset
+            self.memory[key] = dataset.memory_usage()
+            self.__evict(keep=key)
+            return dataset
+
+    @contextmanager
+    def lease(self, keys):
+        """Protect datasets from eviction while a request is using them."""
+        keys = list(keys)
+        with self.lock:
+            self.leases.update(keys)
+        try:
+            yield
+        finally:
+            with self.changed:
+                self.leases.subtract(keys)
+                self.leases += Counter()
+                self.__evict()
+                self.changed.notify_all()
+
+    def get_open(self, key):
+        """Return the dataset if it is currently open, otherwise None."""
+        with self.lock:
+            return self.open.get(key)
+
+    def update_memory(self, key):
+        """Re-estimate the memory of an open dataset, e.g. after a refresh."""
+        with self.lock:
+            if key in self.open:
+                self.memory[key] = self.open[key].memory_usage()
+                self.__evict(keep=key)
+
+    def remove(self, key):
+        """Close and forget the dataset."""
+        with self.lock:
+            self.factories.pop(key, None)
+            self.close(key)
+
+    def close(self, key):
+        """Close the dataset if open, it is reopened on next use."""
+        with self.lock:
+            dataset = self.open.pop(key, None)
+            self.memory.pop(key, None)
+            if dataset is not None:
+                dataset.close()
+
+    def replace(self, key, function):
+        """Close the dataset once no request uses it and run `function`.
+
+        No request can open the dataset while `function` runs, so its files
+        can be swapped on disk. It is reopened from disk on next use.
+        """
+        with self.changed:
+            while (
+                self.leases[key] > 0 or key in self.opening or key in self.replacing
+            ):
+                self.changed.wait()
+            self.close(key)
+            self.replacing.add(key)
+        try:
+            function()
+        finally:
+            with self.changed:
+                self.replacing.discard(key)
+                self.changed.notify_all()
+
+    def pin(self, key):
+        """Never evict the dataset once opened."""
+        self.pinned.add(key)
+
+    def unpin(self, key):
+        self.pinned.discard(key)
+
+    def memory_usage(self):
+        """Estimated memory in bytes of every open dataset."""
+        with self.lock:
+            return dict(self.memory)
+
+    def report(self):
+        """Human readable memory report of open datasets, largest first."""
+        usage = self.memory_usage()
+        lines = [
+            f"Open datasets: {len(usage)}/{self.max_open}, "
+            f"{sum(usage.values()) / 2**20:.1f} MiB"
+            + (
+                f" of {self.memory_budget / 2**20:.1f} MiB budget"
+                if self.memory_budget > 0
+                else ""
+            )
+        ]
+        for key, size in sorted(usage.items(), key=lambda x: x[1], reverse=True):
+            pinned = " (pinned)" if key in self.pinned else ""
+            lines.append(f"  {' '.join(key)}: {size / 2**20:.1f} MiB{pinned}")
+        return "\n".join(lines)
+
+    def __over_limit(self):
+        if len(self.open) > self.max_open:
+            return True
+        return self.memory_budget > 0 and sum(self.memory.values()) > self.memory_budget
+
+    def __evict(self, keep=None):
+        for key in list(self.open.keys()):
+            if not self.__over_limit():
+                return
+            if key == keep or key in self.pinned or self.leases[key] > 0:
+                continue
+            print(
+                f"Closing dataset {' '.join(key)} "
+                f"({self.memory[key] / 2**20:.1f} MiB)"
+            )
+            self.close(key)
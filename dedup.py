@@ -0,0 +1,89 @@
+from collections import Counter
+from itertools import chain
+import hashlib
+
+
+class NearDuplicateIndex:
+    """Incremental near duplicate detection of retrieved chunks.
+
+    A chunk is a duplicate when it has an already seen chunk ID, the same
+    normalized content hash, or its character shingles are contained in an
+    already seen chunk above `threshold`, or the other way around. Shingles
+    are indexed in posting lists, so the shared shingles of every indexed
+    chunk are counted in one pass over the new chunk. Unlike similarity based
+    candidates such as MinHash buckets, this finds small chunks contained in
+    large ones.
+
+    Posting lists stop growing at `max_postings` chunks. Such common
+    shingles, e.g. license headers, are no longer looked up and count as
+    shared with every candidate, so adding a chunk of L shingles costs at
+    most O(L * max_postings) instead of growing with the number of indexed
+    chunks.
+    """
+
+    def __init__(
+        self, threshold: float = 0.95, shingle_size: int = 5, max_postings: int = 16
+    ):
+        self.threshold = threshold
+        self.shingle_size = shingle_size
+        self.max_postings = max_postings
+        self.ids = set()
+        self.hashes = set()
+        # Shingle count of each indexed chunk
+        self.sizes = []
+        self.postings = {}
+
+    def __shingles(self, text: str):
+        text = " ".join(text.split())
+        if len(text) <= self.shingle_size:
+            return {hash(text)}
+        return {
+            hash(text[i : i + self.shingle_size])
+            for i in range(len(text) - self.shingle_size + 1)
+        }
+
+    def add(self, text: str, doc_id: str = None):
+        """Index a chunk unless it duplicates an already indexed one.
+
+        Args:
+            text (str): Content of the chunk.
+            doc_id (str): Optional ID of the chunk in the vector store.
+        Returns:
+            bool: True if the chunk was new and got indexed.
+        """
+        if doc_id is not None and doc_id in self.ids:
+            return False
+        content_hash = hashlib.sha1(" ".join(text.split()).encode("utf-8")).digest()
+        if content_hash in self.hashes:
+            return False
+
+        shingles = self.__shingles(text)
+        postings = [self.postings.get(shingle) for shingle in shingles]
+        common = sum(
+            1
+            for posting in postings
+            if posting is not None and len(posting) >= self.max_postings
+        )
+        # Shared shingles per indexed chunk
+        shared = Counter(
+            chain.from_iterable(
+                posting
+                for posting in postings
+                if posting is not None and len(posting) < self.max_postings
+            )
+        )
+        for chunk, count in shared.items():
+            if count + common >= self.threshold * min(
+                self.sizes[chunk], len(shingles)
+            ):
+                return False
+
+        if doc_id is not None:
+            self.ids.add(doc_id)
+        self.hashes.add(content_hash)
+        for shingle in shingles:
+            posting = self.postings.setdefault(shingle, [])
+            if len(posting) < self.max_postings:
+                posting.append(len(self.sizes))
+        self.sizes.append(len(shingles))
+        return True
@@ -0,0 +1,39 @@
+from array import array
+import hashlib
+from langchain.storage import EncoderBackedStore, LocalFileStore
+
+
+def encode_vector(vector: list[float]):
+    """Serialize a vector as raw float32, 4 bytes per dimension."""
+    return array("f", vector).tobytes()
+
+
+def decode_vector(data: bytes):
+    return array("f", data).tolist()
+
+
+def chunk_key(namespace: str, text: str):
+    """Key of a chunk, sharded in 256 subdirectories by the first hash byte.
+
+    Keeps every directory of the file store small instead of one flat
+    directory with a file per chunk.
+    """
+    digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+    return f"{namespace}/{digest[:2]}/{digest}"
+
+
+def embedding_store(directory: str, namespace: str):
+    """File store of chunk embeddings keyed by the chunk text hash.
+
+    Args:
+        directory (str): Directory of the file store.
+        namespace (str): Embedding model, vectors of other models never match.
+    Returns:
+        EncoderBackedStore: Store to back CacheBackedEmbeddings with.
+    """
+    return EncoderBackedStore(
+        LocalFileStore(directory),
+        lambda text: chunk_key(namespace, text),
+        encode_vector,
+        decode_vector,
+    )
@@ -0,0 +1,155 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from metrics import METRICS
+import time
+
+
+class EmbeddingPipeline:
+    """Embed document batches concurrently and hand the results to a writer.
+
+    Up to `concurrency` batches are kept in flight against the embedding
+    server. Finished batches are written in the calling thread as they arrive,
+    so the vector store is only touched from one thread. The batch size is
+    tuned from the observed latency: it grows while batches return faster
+    than `target_latency` and shrinks when they are slower or fail. Failed
+    batches are split and resubmitted after an exponential backoff, while
+    the other batches keep going. Used as a context manager, the executor is
+    shut down even if embedding fails.
+    """
+
+    def __init__(
+        self,
+        embedding_function: Embeddings,
+        write_function,
+        concurrency: int = 4,
+        batch_size: int = 256,
+        min_batch_size: int = 16,
+        max_batch_size: int = 2048,
+        target_latency: float = 2.0,
+        max_retries: int = 3,
+    ):
+        self.embedding_function = embedding_function
+        self.write_function = write_function
+        self.concurrency = max(1, concurrency)
+        self.batch_size = batch_size
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max_batch_size
+        self.target_latency = target_latency
+        self.max_retries = max_retries
+
+        self.executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        self.in_flight = {}
+        # Failed batches waiting for their retry, as (retry time, docs, attempt)
+        self.delayed = []
+        self.buffer = []
+        # Counters of the embedding stage
+        self.stats = {"batches": 0, "chunks": 0, "retries": 0, "seconds": 0.0}
+
+    def __embed(self, docs: list[Document]):
+        start = time.perf_counter()
+        vectors = self.embedding_function.embed_documents(
+            [doc.page_content for doc in docs]
+        )
+        return vectors, time.perf_counter() - start
+
+    def __submit(self, docs: list[Document], attempt: int = 0):
+        future = self.executor.submit(self.__embed, docs)
+        self.in_flight[future] = (docs, attempt)
+
+    def __submit_delayed(self):
+        """Submit the failed batches whose backoff has passed."""
+        now = time.monotonic()
+        ready = [entry for entry in self.delayed if entry[0] <= now]
+        self.delayed = [entry for entry in self.delayed if entry[0] > now]
+        for _, docs, attempt in ready:
+            self.__submit(docs, attempt)
+
+    def __pending(self):
+        return len(self.in_flight) + len(self.delayed)
+
+    def __adapt(self, latency: float, failed: bool = False):
+        """Grow the batch size on fast batches, shrink it on slow or failed ones."""
+        if failed or latency > self.target_latency:
+            self.batch_size = max(self.min_batch_size, self.batch_size // 2)
+        elif latency < self.target_latency / 2:
+            self.batch_size = min(self.max_batch_size, int(self.batch_size * 1.5))
+
+    def __collect(self):
+        """Write finished batches and reschedule failed ones in smaller pieces.
+
+        Waits for the next finished batch or the next retry to be due.
+        """
+        self.__submit_delayed()
+        timeout = None
+        if len(self.delayed) > 0:
+            retry = min(entry[0] for entry in self.delayed)
+            timeout = max(0.0, retry - time.monotonic())
+        if len(self.in_flight) == 0:
+            time.sleep(timeout)
+            return
+        done, _ = wait(
+            list(self.in_flight.keys()), timeout=timeout, return_when=FIRST_COMPLETED
+        )
+        for future in done:
+            docs, attempt = self.in_flight.pop(future)
+            try:
+                vectors, latency = future.result()
+            except Exception as e:
+                if attempt >= self.max_retries:
+                    raise e
+                print(e)
+                self.stats["retries"] += 1
+                METRICS.inc("rag_embedding_retries_total")
+                self.__adapt(0.0, failed=True)
+                retry = time.monotonic() + 2**attempt
+                middle = max(1, len(docs) // 2)
+                self.delayed.append((retry, docs[:middle], attempt + 1))
+                if len(docs[middle:]) > 0:
+                    self.delayed.append((retry, docs[middle:], attempt + 1))
+                continue
+            self.__adapt(latency)
+            METRICS.inc("rag_embedding_requests_total", kind="ingest")
+            METRICS.observe("rag_embedding_batch_seconds", latency)
+            self.stats["batches"] += 1
+            self.stats["chunks"] += len(docs)
+            self.stats["seconds"] += latency
+            self.write_function(docs, vectors)
+
+    def add(self, docs: list[Document]):
+        """Queue chunks, dispatching full batches to the embedding server."""
+        self.buffer += docs
+        while len(self.buffer) >= self.batch_size:
+            batch, self.buffer = (
+                self.buffer[: self.batch_size],
+                self.buffer[self.batch_size :],
+            )
+            # Wait for a free slot before building more requests
+            while self.__pending() >= self.concurrency:
+                self.__collect()
+            self.__submit(batch)
+        self.__submit_delayed()
+
+    def close(self):
+        """Embed the remaining chunks and wait for every batch to be written."""
+        try:
+            if len(self.buffer) > 0:
+                self.__submit(self.buffer)
+                self.buffer = []
+            while self.__pending() > 0:
+                self.__collect()
+        finally:
+            self.shutdown()
+        return self.stats
+
+    def shutdown(self):
+        """Cancel the batches not started yet and release the executor."""
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.in_flight = {}
+        self.delayed = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
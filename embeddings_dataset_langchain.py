@@ -5,160 +5,515 @@ from torch.utils.data import Dataset
 # sys.modules['sqlite3'] = sys.modules.pop('pysqlite3')
 
 from langchain_community.document_loaders import (
-    DirectoryLoader,
     TextLoader,
     PyPDFLoader,
 )
 from langchain_core.documents import Document
 from langchain_text_splitters import RecursiveCharacterTextSplitter, Language
 from langchain_chroma import Chroma
-from langchain_openai import OpenAIEmbeddings
-from fuzzywuzzy import fuzz
+from langchain_community.vectorstores.utils import maximal_marginal_relevance
+from chromadb.api.client import SharedSystemClient
+from langchain_core.embeddings import Embeddings
+from embedding_pipeline import EmbeddingPipeline
+from dedup import NearDuplicateIndex
+from context_packer import count_tokens
+from metrics import METRICS
+from quantized_index import QuantizedIndex, INDEX_FILE
 
 import os
+import copy
+import json
+import hashlib
+import uuid
+import time
+import multiprocessing
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 
+# Initial number of chunks per embedding request, tuned during ingestion
 EMBED_STEP = 256
 
 
+SPLITTER_CONFIGS = {
+    ".md": {
+        "language": Language.MARKDOWN,
+        "chunk_size": 1024,
+        "chunk_overlap": 256,
+        "length_function": len,
+    },
+    ".rst": {
+        "language": Language.RST,
+        "chunk_size": 1024,
+        "chunk_overlap": 256,
+        "length_function": len,
+    },
+    ".txt": {
+        "splitter": RecursiveCharacterTextSplitter,
+        "chunk_size": 512,
+        "chunk_overlap": 128,
+        "length_function": len,
+    },
+    ".pdf": {
+        "splitter": RecursiveCharacterTextSplitter,
+        "chunk_size": 512,
+        "chunk_overlap": 256,
+        "length_function": len,
+        "loader_cls": PyPDFLoader,
+        "loader_kwargs": {
+            "extraction_kwargs": {
+                "autodetect_encoding": True,
+                "encoding": "utf-8",
+            }
+        },
+    },
+    ".py": {
+        "language": Language.PYTHON,
+        "chunk_size": 256,
+        "chunk_overlap": 0,
+        "length_function": len,
+    },
+    ".html": {
+        "language": Language.HTML,
+        "chunk_size": 512,
+        "chunk_overlap": 0,
+        "length_function": len,
+    },
+    ".tex": {
+        "language": Language.LATEX,
+        "chunk_size": 1024,
+        "chunk_overlap": 256,
+        "length_function": len,
+    },
+}
+
+MANIFEST_FILE = "manifest.json"
+# Manifest of a dataset stored in the shared multi-dataset collection
+COLLECTION_MANIFEST_FILE = "collection-manifest.json"
+
+
+def _split_loader_kwargs(kwargs_splitter: dict):
+    """Separate loader settings from the splitter settings of a source config."""
+    kwargs_splitter = dict(kwargs_splitter)
+    loader_cls = kwargs_splitter.pop("loader_cls", None)
+    loader_kwargs = kwargs_splitter.pop("loader_kwargs", {})
+
+    if "language" in kwargs_splitter:
+        text_splitter = RecursiveCharacterTextSplitter.from_language(**kwargs_splitter)
+    else:
+        splitter = kwargs_splitter.pop("splitter", RecursiveCharacterTextSplitter)
+        text_splitter = splitter(**kwargs_splitter)
+    return loader_cls, loader_kwargs, text_splitter
+
+
+def _scan_source_files(directory: str):
+    """Walk the directory once and yield every file with an indexed extension.
+
+    Hidden files and directories are skipped, same as DirectoryLoader did.
+
+    Yields:
+        tuple: File path, its extension and its size in bytes.
+    """
+    directories = [directory]
+    while len(directories) > 0:
+        with os.scandir(directories.pop()) as entries:
+            for entry in entries:
+                if entry.name.startswith("."):
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    directories.append(entry.path)
+                    continue
+                extension = os.path.splitext(entry.name)[1]
+                if extension in SPLITTER_CONFIGS and entry.is_file():
+                    yield entry.path, extension, entry.stat().st_size
+
+
+def _load_text_file(path: str):
+    """Load a text file, decoding strict UTF-8 before detecting the encoding."""
+    with open(path, "rb") as file:
+        raw = file.read()
+    try:
+        text = raw.decode("utf-8")
+    except UnicodeDecodeError:
+        return TextLoader(path, encoding="utf-8", autodetect_encoding=True).load()
+    return [Document(page_content=text, metadata={"source": path})]
+
+
+def _load_and_split(path: str, extension: str):
+    """Load and split one source file, run inside the ingestion worker pool.
+
+    Returns:
+        tuple: Extension, file size in bytes and the non empty chunks.
+    """
+    loader_cls, loader_kwargs, text_splitter = _split_loader_kwargs(
+        SPLITTER_CONFIGS[extension]
+    )
+    try:
+        if loader_cls is None:
+            documents = _load_text_file(path)
+        else:
+            documents = loader_cls(path, **loader_kwargs).load()
+    except Exception as e:
+        print(e)
+        return extension, None, []
+    docs = text_splitter.split_documents(documents)
+    # Filter Empty Documents
+    docs = [doc for doc in docs if len(doc.page_content.strip()) > 0]
+    # Token counts let the context packer budget prompts without tokenizing
+    for doc in docs:
+        doc.metadata["tokens"] = count_tokens(doc.page_content)
+    return extension, os.path.getsize(path), docs
+
+
+def _file_hash(path: str):
+    """Compute the content hash of a file used in the branch manifest."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
 class EmbeddingsDataset(Dataset):
     def __init__(
         self,
         datasource_directory,
-        transformer_model: OpenAIEmbeddings,
+        transformer_model: Embeddings,
         cache_dir=os.path.join(os.path.dirname(__file__), "chroma-embed-cache"),
+        refresh: bool = False,
+        workers: int = 0,
+        embed_concurrency: int = 4,
+        collection_dir: str = None,
+        dataset_key: str = None,
+        progress=None,
+        index_precision: str = "float32",
+        index_dimensions: int = 0,
     ):
         self.cache_dir = os.path.join(os.path.dirname(__file__), cache_dir)
+        # Chunks live in a collection shared by all datasets when collection_dir
+        # is given, tagged with the dataset key and filtered by it on search
+        self.collection_dir = collection_dir
+        self.dataset_key = dataset_key
+        # Keys of all datasets covered by searches of this object
+        self.dataset_keys = [dataset_key]
+        if collection_dir is None:
+            self.persist_dir = self.cache_dir
+            self.manifest_path = os.path.join(self.cache_dir, MANIFEST_FILE)
+            self.where = None
+        else:
+            self.persist_dir = collection_dir
+            self.manifest_path = os.path.join(self.cache_dir, COLLECTION_MANIFEST_FILE)
+            self.where = {"dataset": dataset_key}
         self.embedd_function = transformer_model
         self.source_dir = datasource_directory
         self.branch = datasource_directory.split(os.sep)[-1]
+        # Number of processes loading and splitting files, serial if <= 1
+        self.workers = workers
+        # Number of embedding batches kept in flight against the server
+        self.embed_concurrency = embed_concurrency
+        # Per extension file, byte and chunk counts of the last ingestion
+        self.ingest_stats = {}
+        # Called with the number of embedded and of all files during ingestion
+        self.progress = progress
+        # Vectors are searched in a quantized index instead of Chroma, which
+        # then only keeps the chunks, unless stored as full float32 vectors
+        self.requested_index_settings = {
+            "precision": index_precision,
+            "dimensions": index_dimensions,
+        }
+        if collection_dir is not None and self.__quantized(
+            self.requested_index_settings
+        ):
+            raise ValueError(
+                "Quantized indexes are not supported in a single collection"
+            )
 
-        exist = os.path.exists(self.cache_dir)
+        if collection_dir is None:
+            exist = os.path.exists(self.cache_dir)
+        else:
+            exist = os.path.exists(self.manifest_path)
+
+        # Indexes built with other settings keep being searched until rebuilt
+        # by refresh, see `index_outdated`
+        self.index_settings = self.requested_index_settings
+        if exist and not refresh:
+            self.index_settings = self.__stored_index_settings(self.__load_manifest())
+        self.index = self.__open_index()
 
         os.makedirs(self.cache_dir, exist_ok=True)
 
-        self.vectordb = Chroma(
+        self.vectordb = self.__open_vectordb()
+        if not exist:
+            manifest = self._file_manifest()
+            if self.where is not None:
+                # Chunks left by an ingestion that stopped before its manifest
+                # was saved would be stored twice
+                self.vectordb._collection.delete(where=self.where)
+            try:
+                self.__embed_files(manifest.keys())
+            except BaseException:
+                # Cancelled or failed, the caller removes the cache directory
+                # but the chunks would stay behind in the shared collection
+                if self.where is not None:
+                    self.vectordb._collection.delete(where=self.where)
+                raise
+            self.__save_manifest(manifest)
+        elif refresh:
+            self.refresh()
+
+    def __open_vectordb(self):
+        return Chroma(
             collection_name="embedding-data",
-            persist_directory=self.cache_dir,
+            persist_directory=self.persist_dir,
             embedding_function=self.embedd_function,
         )
-        if not exist:
 
-            data_sources_splitter_pairs = [
-                (
-                    "*.md",
-                    {
-                        "language": Language.MARKDOWN,
-                        "chunk_size": 1024,
-                        "chunk_overlap": 256,
-                        "length_function": len,
-                    },
-                ),
-                (
-                    "*.rst",
-                    {
-                        "language": Language.RST,
-                        "chunk_size": 1024,
-                        "chunk_overlap": 256,
-                        "length_function": len,
-                    },
-                ),
-                (
-                    "*.txt",
-                    {
-                        "splitter": RecursiveCharacterTextSplitter,
-                        "chunk_size": 512,
-                        "chunk_overlap": 128,
-                        "length_function": len,
-                    },
-                ),
-                (
-                    "*.pdf",
-                    {
-                        "splitter": RecursiveCharacterTextSplitter,
-                        "chunk_size": 512,
-                        "chunk_overlap": 256,
-                        "length_function": len,
-                        "loader_cls": PyPDFLoader,
-                        "loader_kwargs": {
-                            "extraction_kwargs": {
-                                "autodetect_encoding": True,
-                                "encoding": "utf-8",
-                            }
-                        },
-                    },
-                ),
-                (
-                    "*.py",
-                    {
-                        "language": Language.PYTHON,
-                        "chunk_size": 256,
-                        "chunk_overlap": 0,
-                        "length_function": len,
-                    },
-                ),
-                (
-                    "*.html",
-                    {
-                        "language": Language.HTML,
-                        "chunk_size": 512,
-                        "chunk_overlap": 0,
-                        "length_function": len,
-                    },
-                ),
-                (
-                    "*.tex",
-                    {
-                        "language": Language.LATEX,
-                        "chunk_size": 1024,
-                        "chunk_overlap": 256,
-                        "length_function": len,
-                    },
-                ),
-            ]
+    def _file_manifest(self):
+        """Hash every indexable file of the source directory.
+
+        Returns:
+            dict: Mapping of source relative file path to its content hash.
+        """
+        manifest = {}
+        for path, _, _ in _scan_source_files(self.source_dir):
+            manifest[os.path.relpath(path, self.source_dir)] = _file_hash(path)
+        return manifest
+
+    def __load_manifest(self):
+        if not os.path.exists(self.manifest_path):
+            return None
+        with open(self.manifest_path, "r") as file:
+            return json.load(file)
+
+    def __save_manifest(self, manifest: dict):
+        with open(self.manifest_path, "w+") as file:
+            json.dump({"files": manifest, "index": self.index_settings}, file, indent=6)
+
+    @staticmethod
+    def __quantized(settings: dict):
+        return settings["precision"] != "float32" or settings["dimensions"] > 0
+
+    @staticmethod
+    def __stored_index_settings(manifest: dict):
+        """Index settings the stored vectors were indexed with."""
+        # Caches of older versions only stored float32 vectors in Chroma
+        return (manifest or {}).get("index", {"precision": "float32", "dimensions": 0})
+
+    def __open_index(self):
+        if not self.__quantized(self.index_settings):
+            return None
+        return QuantizedIndex(
+            os.path.join(self.cache_dir, INDEX_FILE),
+            self.index_settings["precision"],
+            self.index_settings["dimensions"],
+        )
+
+    @property
+    def index_outdated(self):
+        """Whether the index differs from the requested settings.
+
+        Such indexes are searched as they are until `refresh` rebuilds them,
+        as are indexes stored without their full precision vectors.
+        """
+        return self.index_settings != self.requested_index_settings or (
+            self.index is not None and not self.index.rescorable
+        )
+
+    def __index_changed(self, old_manifest: dict):
+        """Check if the vectors were indexed with other index settings."""
+        if old_manifest is None:
+            return False
+        return (
+            self.__stored_index_settings(old_manifest)
+            != self.requested_index_settings
+        )
+
+    def refresh(self):
+        """Re-embed only the files that changed since the last indexing.
+
+        Files are compared by content hash against the manifest stored beside
+        the Chroma collection. Chunks of removed and changed files are deleted
+        and the added and changed files are embedded again.
 
-            for ending, kwargs_splitter in data_sources_splitter_pairs:
-
-                text_loader_kwargs = {"autodetect_encoding": True, "encoding": "utf-8"}
-                loader = DirectoryLoader(
-                    datasource_directory,
-                    show_progress=True,
-                    recursive=True,
-                    glob=ending,
-                    loader_cls=kwargs_splitter.get("loader_cls", TextLoader),
-                    loader_kwargs=kwargs_splitter.get(
-                        "loader_kwargs", text_loader_kwargs
-                    ),
+        Returns:
+            tuple: Lists of added, changed and removed relative file paths.
+        """
+        old_manifest = self.__load_manifest()
+        manifest = self._file_manifest()
+        # Cache created before manifests existed or with other index settings,
+        # rebuild it from scratch
+        if (
+            old_manifest is None
+            or self.__index_changed(old_manifest)
+            or (self.index is not None and not self.index.rescorable)
+        ):
+            if self.where is None:
+                self.vectordb.delete_collection()
+                self.vectordb = self.__open_vectordb()
+            else:
+                self.vectordb._collection.delete(where=self.where)
+            if os.path.exists(os.path.join(self.cache_dir, INDEX_FILE)):
+                os.remove(os.path.join(self.cache_dir, INDEX_FILE))
+            self.index_settings = self.requested_index_settings
+            self.index = self.__open_index()
+            self.__embed_files(manifest.keys())
+            self.__save_manifest(manifest)
+            return list(manifest.keys()), [], []
+        old_manifest = old_manifest["files"]
+
+        added = [path for path in manifest if path not in old_manifest]
+        changed = [
+            path
+            for path in manifest
+            if path in old_manifest and manifest[path] != old_manifest[path]
+        ]
+        removed = [path for path in old_manifest if path not in manifest]
+
+        # Chunks of added files are only stored if a previous refresh stopped
+        # before saving the manifest, delete them to not store them twice
+        stale = [
+            os.path.join(self.source_dir, path) for path in added + changed + removed
+        ]
+        for i in range(0, len(stale), EMBED_STEP):
+            where = {"source": {"$in": stale[i : i + EMBED_STEP]}}
+            if self.where is not None:
+                where = {"$and": [self.where, where]}
+            if self.index is not None:
+                self.index.remove(
+                    self.vectordb._collection.get(where=where, include=[])["ids"]
                 )
+            self.vectordb._collection.delete(where=where)
+        self.__embed_files(added + changed)
+        self.__save_manifest(manifest)
+        return added, changed, removed
 
-                kwargs_splitter.pop("loader_cls", None)
-                kwargs_splitter.pop("loader_kwargs", None)
+    def __embed_files(self, rel_paths):
+        """Load, split and embed the given source relative files.
 
-                if "language" in kwargs_splitter:
-                    text_splitter = RecursiveCharacterTextSplitter.from_language(
-                        **kwargs_splitter
-                    )
-                else:
-                    splitter = kwargs_splitter.pop(
-                        "splitter", RecursiveCharacterTextSplitter
+        With workers > 1 the files are loaded and split in a process pool. The
+        chunks are streamed into an EmbeddingPipeline keeping several
+        adaptively sized batches in flight against the embedding server.
+        Per extension file, byte and chunk counts are kept in ingest_stats.
+        """
+        start = time.perf_counter()
+        self.ingest_stats = {}
+        paths = [os.path.join(self.source_dir, rel_path) for rel_path in rel_paths]
+        extensions = [os.path.splitext(path)[1] for path in paths]
+
+        executor = None
+        if self.workers > 1 and len(paths) > 1:
+            executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+            split_files = executor.map(
+                _load_and_split,
+                paths,
+                extensions,
+                chunksize=max(1, min(64, len(paths) // (4 * self.workers))),
+            )
+        else:
+            split_files = map(_load_and_split, paths, extensions)
+
+        # Embed Documents
+        try:
+            with EmbeddingPipeline(
+                self.embedd_function,
+                self.__write_embeddings,
+                concurrency=self.embed_concurrency,
+                batch_size=EMBED_STEP,
+            ) as pipeline:
+                for done, (extension, size, docs) in enumerate(split_files, 1):
+                    stats = self.ingest_stats.setdefault(
+                        extension, {"files": 0, "bytes": 0, "chunks": 0}
                     )
-                    text_splitter = splitter(**kwargs_splitter)
-
-                documents = loader.load()
-
-                if len(documents) > 0:
-                    docs = text_splitter.split_documents(documents)
-                    # Filter Empty Documents
-                    index = 0
-                    while index < len(docs):
-                        if len(docs[index].page_content.strip()) == 0:
-                            docs.pop(index)
-                            index -= 1
-                        index += 1
-                    # Embed Documents
-                    for i in range(0, len(docs), EMBED_STEP):
-                        self.vectordb.add_documents(
-                            documents=docs[i : i + EMBED_STEP],
-                        )
+                    if size is not None:
+                        stats["files"] += 1
+                        stats["bytes"] += size
+                        stats["chunks"] += len(docs)
+                        pipeline.add(docs)
+                    # Files only count as done once embeddings are coming back
+                    if self.progress is not None and pipeline.stats["batches"] > 0:
+                        self.progress(done, len(paths))
+                pipeline_stats = pipeline.close()
+            if self.progress is not None:
+                self.progress(len(paths), len(paths))
+        finally:
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+        if self.index is not None:
+            self.index.save()
+
+        print(
+            f"{self.branch}: embedded {pipeline_stats['chunks']} chunks in "
+            f"{pipeline_stats['batches']} batches, "
+            f"final batch size {pipeline.batch_size}"
+        )
+        METRICS.observe("rag_ingest_seconds", time.perf_counter() - start)
+        for extension, stats in self.ingest_stats.items():
+            print(
+                f"{self.branch} {extension}: {stats['files']} files, "
+                f"{stats['bytes']} bytes, {stats['chunks']} chunks"
+            )
+            METRICS.inc("rag_ingested_files_total", stats["files"], extension=extension)
+            METRICS.inc("rag_ingested_bytes_total", stats["bytes"], extension=extension)
+            METRICS.inc(
+                "rag_ingested_chunks_total", stats["chunks"], extension=extension
+            )
+
+    def __write_embeddings(self, docs: list[Document], vectors: list[list[float]]):
+        """Store already embedded chunks in the Chroma collection."""
+        metadatas = [doc.metadata for doc in docs]
+        if self.where is not None:
+            metadatas = [
+                {
+                    **metadata,
+                    "dataset": self.dataset_key,
+                    "branch": self.branch,
+                    "root": self.source_dir,
+                }
+                for metadata in metadatas
+            ]
+        ids = [str(uuid.uuid4()) for _ in docs]
+        if self.index is not None:
+            self.index.add(ids, vectors)
+            # Chroma only keeps the chunks, a one dimensional placeholder
+            # keeps its own vector index negligible
+            vectors = [[0.0] for _ in docs]
+        self.vectordb._collection.upsert(
+            ids=ids,
+            embeddings=vectors,
+            metadatas=metadatas,
+            documents=[doc.page_content for doc in docs],
+        )
+
+    def memory_usage(self):
+        """Estimate the resident memory of the collection in bytes.
+
+        Chroma keeps the HNSW index of an opened collection in memory, so the
+        size of its index files is used as the estimate. Datasets in a shared
+        collection report 0, the collection stays open for all of them.
+        """
+        if self.collection_dir is not None:
+            return 0
+        size = 0
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if name.endswith(".bin") or name.endswith(".pickle"):
+                    size += os.path.getsize(os.path.join(root, name))
+        if self.index is not None:
+            size += self.index.memory_usage()
+        return size
+
+    def close(self):
+        """Release the Chroma client and its in-memory index."""
+        if self.collection_dir is not None:
+            return
+        client = self.vectordb._client
+        system = SharedSystemClient._identifier_to_system.pop(
+            getattr(client, "_identifier", None), None
+        )
+        if system is not None:
+            system.stop()
 
     def __getitem__(self, index):
         return self.vectordb[index]
@@ -166,38 +521,115 @@ class EmbeddingsDataset(Dataset):
     def __len__(self):
         return self.vectordb._collection.count()
 
+    @staticmethod
+    def merged(datasets: list["EmbeddingsDataset"]):
+        """Search several datasets of the shared collection with one query.
+
+        Args:
+            datasets (list[EmbeddingsDataset]): Datasets sharing a collection.
+        Returns:
+            EmbeddingsDataset: View filtering the collection to all datasets.
+        """
+        view = copy.copy(datasets[0])
+        view.dataset_keys = [dataset.dataset_key for dataset in datasets]
+        view.where = {"dataset": {"$in": view.dataset_keys}}
+        return view
+
     def __remove_full_overhead(self, document: Document):
         filename_rel_path = os.path.relpath(
-            document.metadata["source"], self.source_dir
+            document.metadata["source"],
+            document.metadata.get("root", self.source_dir),
         )
         doc_dict = {
             "filename": filename_rel_path,
-            "branch": self.branch,
+            "branch": document.metadata.get("branch", self.branch),
             "content": document.page_content,
+            "tokens": document.metadata.get("tokens"),
         }
 
         return doc_dict
 
-    def __call__(self, query, k=7, fetch_k=50):
-        max_marginal = self.vectordb.max_marginal_relevance_search(
-            query, k=k, fetch_k=fetch_k
+    def embed_query(self, query):
+        """Embed the query with the embedding model of this dataset."""
+        return self.embedd_function.embed_query(query)
+
+    def __rescored_candidates(self, embedding: list[float], fetch_k: int):
+        """Search the quantized index and re-score the hits exactly.
+
+        The hits are re-scored with the full precision vectors stored beside
+        the index, only their chunks are read from Chroma.
+
+        Returns:
+            tuple: Up to `fetch_k` documents, most similar first, and their
+                vectors.
+        """
+        ids, _, vectors = self.index.rescored_search(embedding, fetch_k)
+        if len(ids) == 0:
+            return [], vectors
+        records = self.vectordb._collection.get(
+            ids=ids, include=["documents", "metadatas"]
+        )
+        found = {
+            doc_id: Document(page_content=text, metadata=metadata, id=doc_id)
+            for doc_id, text, metadata in zip(
+                records["ids"], records["documents"], records["metadatas"]
+            )
+        }
+        rows = [i for i, doc_id in enumerate(ids) if doc_id in found]
+        return [found[ids[i]] for i in rows], vectors[rows]
+
+    def _search(self, embedding: list[float], k: int, fetch_k: int, similar=True):
+        """Find the most diverse and, if `similar`, the most similar chunks.
+
+        Returns:
+            tuple: Maximal marginal relevance and similarity search results.
+        """
+        if self.index is None:
+            max_marginal = self.vectordb.max_marginal_relevance_search_by_vector(
+                embedding, k=k, fetch_k=fetch_k, filter=self.where
+            )
+            max_similar = []
+            if similar:
+                max_similar = self.vectordb.similarity_search_by_vector(
+                    embedding, k=k, filter=self.where
+                )
+            return max_marginal, max_similar
+        docs, vectors = self.__rescored_candidates(embedding, max(k, fetch_k))
+        if len(docs) == 0:
+            return [], []
+        # Same diversity as the Chroma search, computed on the exact vectors
+        # (truncated ones for indexes stored without them)
+        selected = maximal_marginal_relevance(
+            np.asarray(embedding, dtype=np.float32)[: vectors.shape[1]],
+            vectors,
+            lambda_mult=0.5,
+            k=min(k, len(docs)),
         )
-        max_similar = self.vectordb.similarity_search(query, k=k)
-        for doc in max_similar:
-            is_different = True
-            for sim_doc in max_marginal:
-                if fuzz.partial_ratio(doc.page_content, sim_doc.page_content) > 95:
-                    is_different = False
-                    break
-            if is_different:
-                max_marginal.append(doc)
+        return [docs[i] for i in selected], docs[:k] if similar else []
+
+    def __call__(self, query, k=7, fetch_k=50, embedding: list[float] = None):
+        if embedding is None:
+            embedding = self.embed_query(query)
+        with METRICS.timer("rag_stage_seconds", stage="search"):
+            max_marginal, max_similar = self._search(embedding, k, fetch_k)
+        # Merge the similarity results that are not already present
+        with METRICS.timer("rag_stage_seconds", stage="dedup"):
+            dedup_index = NearDuplicateIndex()
+            for doc in max_marginal:
+                dedup_index.add(doc.page_content, getattr(doc, "id", None))
+            for doc in max_similar:
+                if dedup_index.add(doc.page_content, getattr(doc, "id", None)):
+                    max_marginal.append(doc)
 
         return [self.__remove_full_overhead(x) for x in max_marginal]
 
-    def relevant_docs_filename(self, query, k=7, fetch_k=50):
-        max_marginal = self.vectordb.max_marginal_relevance_search(
-            query, k=k, fetch_k=fetch_k
-        ) + self.vectordb.similarity_search(query, k=k)
+    def relevant_docs_filename(
+        self, query, k=7, fetch_k=50, embedding: list[float] = None
+    ):
+        if embedding is None:
+            embedding = self.embed_query(query)
+        max_marginal, max_similar = self._search(embedding, k, fetch_k)
+        max_marginal = max_marginal + max_similar
         filename_reference_list = []
         filepaths = []
         for doc in max_marginal:
@@ -209,10 +641,10 @@ class EmbeddingsDataset(Dataset):
                 filepaths.append(doc.metadata["source"])
         return filepaths
 
-    def querry_documents(self, query, k=5, fetch_k=30):
-        documents = self.vectordb.max_marginal_relevance_search(
-            query, k=k, fetch_k=fetch_k
-        )
+    def querry_documents(self, query, k=5, fetch_k=30, embedding: list[float] = None):
+        if embedding is None:
+            embedding = self.embed_query(query)
+        documents, _ = self._search(embedding, k, fetch_k, similar=False)
         docuemnt_filenames = []
         i = 0
         while i < len(documents):
@@ -232,15 +664,25 @@ class EmbeddingsDataset(Dataset):
 
         return full_documents
 
-    def querry_documents_small(self, query, k=5, fetch_k=30):
-        documents = self.vectordb.max_marginal_relevance_search(
-            query, k=k, fetch_k=fetch_k
-        )
+    def querry_documents_small(
+        self, query, k=5, fetch_k=30, embedding: list[float] = None
+    ):
+        if embedding is None:
+            embedding = self.embed_query(query)
+        with METRICS.timer("rag_stage_seconds", stage="search"):
+            documents, _ = self._search(embedding, k, fetch_k, similar=False)
         full_documents = []
         for document in documents:
-            filename = os.path.relpath(document.metadata["source"], self.source_dir)
+            filename = os.path.relpath(
+                document.metadata["source"],
+                document.metadata.get("root", self.source_dir),
+            )
             full_documents.append(
-                {"filename": filename, "content": document.page_content}
+                {
+                    "filename": filename,
+                    "content": document.page_content,
+                    "tokens": document.metadata.get("tokens"),
+                }
             )
 
         return full_documents
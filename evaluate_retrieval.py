@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+"""Evaluate retrieval quality, latency and prompt cost of retrieval settings.
+
+Every input line is a JSON object like for batch_answer.py, with a
+"question", "repos", "branches" and "shared", plus the "relevant" files
+answering it, as paths relative to the branch root or within the shared
+file. Every combination of the given candidate counts (GIT_TO_RANK and
+SHARED_TO_RANK), diverse fields (GIT_DIVERSE_K and SHARED_DIVERSE_K),
+rerankers and prompt token caps is run over all questions and reports:
+
+- recall@n of the ranked candidate files and of the files packed into the
+  prompt, and the mean reciprocal rank of the first relevant file
+- retrieval latency, including reranking
+- tokens of the packed documents and model requests per question
+
+    python evaluate_retrieval.py labelled.jsonl --k 10 20 --fetch-k 30 50 \\
+        --rerankers none embedding llm --min-recall 0.8
+
+With --min-recall the cheapest settings reaching the recall of the packed
+prompt are printed, to be put into CONTEXT_SIZE.py.
+"""
+import os
+
+os.environ["TOKENIZERS_PARALLELISM"] = "true"
+import MODEL_TYPES
+import PROMPTS
+import CONTEXT_SIZE
+import argparse
+import itertools
+import json
+import statistics
+import time
+from contextlib import contextmanager
+from batch_answer import load_questions, question_versions
+from context_packer import count_tokens, pack_documents
+from app_factory import parser as app_parser, create_retrival
+from retrival_augment_git import RetrivalAugment, RERANKERS
+
+
+parser = argparse.ArgumentParser(
+    description="Sweep retrieval settings over labelled questions",
+    parents=[app_parser],
+    conflict_handler="resolve",
+)
+parser.add_argument("questions", help="JSONL file with the labelled questions")
+parser.add_argument(
+    "--k",
+    default=[CONTEXT_SIZE.GIT_TO_RANK],
+    type=int,
+    nargs="+",
+    help="Candidate documents per question (GIT_TO_RANK, SHARED_TO_RANK)",
+)
+parser.add_argument(
+    "--fetch-k",
+    default=[CONTEXT_SIZE.GIT_DIVERSE_K],
+    type=int,
+    nargs="+",
+    help="Diverse field of the candidates (GIT_DIVERSE_K, SHARED_DIVERSE_K)",
+)
+parser.add_argument(
+    "--rerankers",
+    default=["none"],
+    choices=["none"] + RERANKERS,
+    nargs="+",
+    help="Rerankers to evaluate, none keeps the search order",
+)
+parser.add_argument(
+    "--max-prompt-tokens",
+    default=[CONTEXT_SIZE.MAX_PROMPT_TOKENS],
+    type=int,
+    nargs="+",
+    help="Prompt token caps (MAX_PROMPT_TOKENS)",
+)
+parser.add_argument(
+    "--cutoffs", default=[1, 5, 10, 20], type=int, nargs="+", help="n of recall@n"
+)
+parser.add_argument(
+    "--model",
+    default=list(MODEL_TYPES.LLM_MODELS.keys())[-1],
+    choices=list(MODEL_TYPES.LLM_MODELS.keys()),
+    help="Model of the LLM reranker and of the prompt budget",
+)
+parser.add_argument(
+    "--api-key",
+    default=os.getenv("OPENAI_API_KEY", "metacentrum"),
+    help="API key of the model",
+)
+parser.add_argument(
+    "--min-recall",
+    default=None,
+    type=float,
+    help="Print the cheapest settings with at least this recall of the prompt",
+)
+parser.add_argument("--output", default=None, help="Write the results as JSONL")
+
+
+@contextmanager
+def context_sizes(**sizes):
+    """Temporarily override values of CONTEXT_SIZE."""
+    previous = {name: getattr(CONTEXT_SIZE, name) for name in sizes}
+    for name, value in sizes.items():
+        setattr(CONTEXT_SIZE, name, value)
+    try:
+        yield
+    finally:
+        for name, value in previous.items():
+            setattr(CONTEXT_SIZE, name, value)
+
+
+def ranked_files(candidates: list[tuple]):
+    """Files of the scored documents, best first, each listed once."""
+    files = []
+    for doc, _ in sorted(candidates, key=lambda x: x[1], reverse=True):
+        if doc["filename"] not in files:
+            files.append(doc["filename"])
+    return files
+
+
+def recall(files: list[str], relevant: set[str]):
+    return len(relevant.intersection(files)) / len(relevant)
+
+
+def reciprocal_rank(files: list[str], relevant: set[str]):
+    for rank, filename in enumerate(files):
+        if filename in relevant:
+            return 1 / (rank + 1)
+    return 0.0
+
+
+def model_requests(retrival_class: RetrivalAugment):
+    """Requests sent to all model endpoints so far."""
+    return sum(stats["requests"] for stats in retrival_class.clients.metrics().values())
+
+
+def evaluate(retrival_class: RetrivalAugment, record: dict, configs: list, args):
+    """Run every configuration for one question.
+
+    Returns:
+        list[dict]: Measurements of the question per configuration.
+    """
+    versions = question_versions(retrival_class, record)
+    shared = record.get("shared", [])
+    relevant = set(record["relevant"])
+    version_keys = retrival_class._version_keys(record.get("repos", []), versions)
+    shared_keys = [("shared", share) for share in shared]
+    # Embedded once, all configurations then search with the cached vector
+    retrival_class._embed_query(record["question"])
+
+    measurements = []
+    with retrival_class.datasets.lease(version_keys + shared_keys):
+        version_datasets = retrival_class._search_datasets(version_keys)
+        shared_datasets = retrival_class._search_datasets(shared_keys)
+        for k, fetch_k, rerank, max_prompt_tokens in configs:
+            with context_sizes(
+                GIT_TO_RANK=k,
+                SHARED_TO_RANK=k,
+                GIT_DIVERSE_K=fetch_k,
+                SHARED_DIVERSE_K=fetch_k,
+                MAX_PROMPT_TOKENS=max_prompt_tokens,
+            ):
+                requests = model_requests(retrival_class)
+                start = time.perf_counter()
+                docs, shared_docs = retrival_class._retrieve_documents(
+                    record["question"],
+                    version_datasets,
+                    shared_datasets,
+                    len(versions),
+                    len(shared),
+                    None if rerank == "none" else rerank,
+                    args.api_key,
+                    args.model,
+                )
+                seconds = time.perf_counter() - start
+                requests = model_requests(retrival_class) - requests
+                budget = retrival_class._prompt_budget(args.model) - count_tokens(
+                    PROMPTS.SYSTEM_PROMPT
+                )
+            selected, tokens = pack_documents(docs + shared_docs, budget)
+            files = ranked_files(docs + shared_docs)
+            prompt_files = list(dict.fromkeys(doc["filename"] for doc in selected))
+            measurements.append(
+                {
+                    **{
+                        f"recall@{n}": recall(files[:n], relevant)
+                        for n in args.cutoffs
+                    },
+                    "prompt_recall": recall(prompt_files, relevant),
+                    "mrr": reciprocal_rank(files, relevant),
+                    "seconds": seconds,
+                    "prompt_tokens": tokens,
+                    "model_requests": requests,
+                }
+            )
+    return measurements
+
+
+def summarize(config: tuple, measurements: list[dict], cutoffs: list[int]):
+    """Average the measurements of all questions of a configuration."""
+    k, fetch_k, rerank, max_prompt_tokens = config
+    seconds = sorted(measurement["seconds"] for measurement in measurements)
+    result = {
+        "k": k,
+        "fetch_k": fetch_k,
+        "rerank": rerank,
+        "max_prompt_tokens": max_prompt_tokens,
+        "questions": len(measurements),
+    }
+    for name in [f"recall@{n}" for n in cutoffs] + [
+        "prompt_recall",
+        "mrr",
+        "prompt_tokens",
+        "model_requests",
+    ]:
+        result[name] = statistics.mean(
+            measurement[name] for measurement in measurements
+        )
+    result["p50_ms"] = statistics.median(seconds) * 1000
+    result["p95_ms"] = seconds[min(len(seconds) - 1, int(len(seconds) * 0.95))] * 1000
+    return result
+
+
+def main(args):
+    # Scores are measured, not looked up, and nothing is indexed meanwhile
+    args.rerank_cache_size = 0
+    args.answer_cache_size = 0
+    retrival_class = create_retrival(args, serving=False)
+
+    configs = [
+        config
+        for config in itertools.product(
+            args.k, args.fetch_k, args.rerankers, args.max_prompt_tokens
+        )
+        # Diverse candidates are picked out of the fetched ones
+        if config[1] >= config[0]
+    ]
+    records = [
+        record for record in load_questions(args.questions) if record.get("relevant")
+    ]
+    print(f"{len(records)} labelled questions, {len(configs)} configurations")
+
+    measurements = {config: [] for config in configs}
+    for i, record in enumerate(records):
+        try:
+            for config, measurement in zip(
+                configs, evaluate(retrival_class, record, configs, args)
+            ):
+                measurements[config].append(measurement)
+        except Exception as e:
+            print(f"Question {record['id']} failed: {e!r}")
+        if (i + 1) % 10 == 0:
+            print(f"Evaluated {i + 1}/{len(records)} questions")
+
+    results = [
+        summarize(config, measurements[config], args.cutoffs)
+        for config in configs
+        if len(measurements[config]) > 0
+    ]
+    recall_columns = [f"recall@{n}" for n in args.cutoffs] + ["prompt_recall"]
+    print(
+        f"{'k':>4} {'fetch_k':>7} {'rerank':>13} {'tokens':>7} "
+        + " ".join(f"{column:>13}" for column in recall_columns)
+        + f" {'mrr':>6} {'p50 ms':>8} {'p95 ms':>8} {'prompt':>7} {'requests':>8}"
+    )
+    for result in results:
+        print(
+            f"{result['k']:>4} {result['fetch_k']:>7} {result['rerank']:>13} "
+            f"{result['max_prompt_tokens']:>7} "
+            + " ".join(f"{result[column]:>13.3f}" for column in recall_columns)
+            + f" {result['mrr']:>6.3f} {result['p50_ms']:>8.1f} "
+            f"{result['p95_ms']:>8.1f} {result['prompt_tokens']:>7.0f} "
+            f"{result['model_requests']:>8.1f}"
+        )
+
+    if args.min_recall is not None:
+        passing = [
+            result for result in results if result["prompt_recall"] >= args.min_recall
+        ]
+        if len(passing) == 0:
+            print(f"No settings reach a prompt recall of {args.min_recall}")
+        else:
+            cheapest = min(
+                passing,
+                key=lambda x: (x["prompt_tokens"], x["model_requests"], x["p50_ms"]),
+            )
+            print(
+                f"Cheapest settings with a prompt recall of {args.min_recall}: "
+                f"GIT_TO_RANK = SHARED_TO_RANK = {cheapest['k']}, "
+                f"GIT_DIVERSE_K = SHARED_DIVERSE_K = {cheapest['fetch_k']}, "
+                f"MAX_PROMPT_TOKENS = {cheapest['max_prompt_tokens']}, "
+                f"rerank {cheapest['rerank']}"
+            )
+
+    if args.output is not None:
+        with open(args.output, "w+", encoding="utf-8") as file:
+            for result in results:
+                file.write(json.dumps(result) + "\n")
+
+
+if __name__ == "__main__":
+    main(parser.parse_args())
@@ -0,0 +1,118 @@
+import heapq
+import random
+import threading
+import time
+
+
+class FreshnessScheduler:
+    """Refresh cached branches whose remote head moved since they were indexed.
+
+    Every repository is checked on its own interval with random jitter, and
+    the first checks are spread over one interval, so many repositories do
+    not hit the forges or the ingestion queue at once. A check only lists the
+    remote heads and compares them with the SHAs recorded at index time;
+    branches that moved are handed to `refresh(repo, branches)`. Branches
+    cached before SHAs were recorded are assumed current, their remote SHAs
+    are handed to `record(repo, heads)` instead of refreshing all of them.
+
+    Args:
+        indexed_heads: Returns {repo: {branch: indexed SHA}} of cached branches.
+        remote_heads: Returns {branch: SHA} of a repo, None if unreachable.
+        refresh: Called with a repo and the list of its moved branches.
+        record: Called with a repo and the remote SHAs of its branches without
+            an indexed SHA.
+        interval (float): Seconds between checks of a repository.
+        intervals (dict): Intervals in seconds overriding `interval` per repo.
+        jitter (float): Fraction of the interval checks are randomly shifted by.
+    """
+
+    def __init__(
+        self,
+        indexed_heads,
+        remote_heads,
+        refresh,
+        record=None,
+        interval: float = 3600,
+        intervals: dict = None,
+        jitter: float = 0.1,
+    ):
+        self.indexed_heads = indexed_heads
+        self.remote_heads = remote_heads
+        self.refresh = refresh
+        self.record = record
+        self.interval = interval
+        self.intervals = intervals or {}
+        self.jitter = jitter
+        self.random = random.Random()
+        # Heap of (next check time, repo)
+        self.schedule = []
+        self.scheduled = set()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.__run, daemon=True)
+        self.thread.start()
+
+    def __interval(self, repo: str):
+        interval = self.intervals.get(repo, self.interval)
+        return interval * (1 + self.random.uniform(-self.jitter, self.jitter))
+
+    def __sync(self, repos):
+        """Schedule newly cached repos somewhere within their first interval."""
+        now = time.time()
+        for repo in repos:
+            if repo not in self.scheduled:
+                self.scheduled.add(repo)
+                interval = self.intervals.get(repo, self.interval)
+                heapq.heappush(
+                    self.schedule, (now + self.random.uniform(0, interval), repo)
+                )
+
+    def check(self, repo: str, indexed: dict):
+        """Refresh the branches of the repo whose remote head moved.
+
+        Returns:
+            list[str]: The moved branches.
+        """
+        heads = self.remote_heads(repo)
+        if heads is None:
+            return []
+        unknown = {
+            branch: heads[branch]
+            for branch, sha in indexed.items()
+            if branch in heads and sha == ""
+        }
+        if len(unknown) > 0 and self.record is not None:
+            self.record(repo, unknown)
+        moved = [
+            branch
+            for branch, sha in indexed.items()
+            if branch in heads and heads[branch] != sha and branch not in unknown
+        ]
+        if len(moved) > 0:
+            print(f"Refreshing moved branches of {repo}: {', '.join(moved)}")
+            self.refresh(repo, moved)
+        return moved
+
+    def __run(self):
+        while not self.stopped.is_set():
+            indexed_heads = self.indexed_heads()
+            self.__sync(indexed_heads.keys())
+            now = time.time()
+            while len(self.schedule) > 0 and self.schedule[0][0] <= now:
+                _, repo = heapq.heappop(self.schedule)
+                if repo not in indexed_heads:
+                    # No longer cached
+                    self.scheduled.discard(repo)
+                    continue
+                try:
+                    self.check(repo, indexed_heads[repo])
+                except Exception as e:
+                    print(e)
+                heapq.heappush(
+                    self.schedule, (time.time() + self.__interval(repo), repo)
+                )
+            wait = 60 if len(self.schedule) == 0 else self.schedule[0][0] - time.time()
+            # Wake up at least every minute to pick up newly cached repos
+            self.stopped.wait(min(60, max(1, wait)))
+
+    def close(self):
+        self.stopped.set()
@@ -5,39 +5,16 @@ import sys
 os.environ["TOKENIZERS_PARALLELISM"] = "true"
 import MODEL_TYPES
 import PROMPTS
-import argparse
 import torch
 import gradio as gr
 from functools import partial
-from retrival_augment_git import RetrivalAugment
+from app_factory import parser, create_retrival
 from contextlib import redirect_stdout
 
 
-parser = argparse.ArgumentParser()
-
-parser.add_argument(
-    "--max-branch-boxes",
-    default=10,
-    type=int,
-    help="Maximal number of branches to cache at once",
-)
-parser.add_argument(
-    "--rerank", action="store_true", help="Rerank the documents based on the query"
-)
-parser.add_argument(
-    "--keep-history", action="store_true", help="Keep the history of the chatbot"
-)
-parser.add_argument(
-    "--judge", action="store_true", help="Judge the quality of the answer"
-)
-parser.add_argument(
-    "--port", default=7860, type=int, help="Port to run the Gradio server on"
-)
-
-
 def main(args):
 
-    retrival_class = RetrivalAugment(args=args)
+    retrival_class = create_retrival(args)
     generate_answer = partial(
         retrival_class.__call__,
         rerank=args.rerank,
@@ -147,6 +124,25 @@ def main(args):
             choices=retrival_class._get_cached_shared(), value=[], interactive=True
         )
 
+    def poll_ingest_jobs(applied: int, repos: list[str]):
+        """Show the ingestion jobs, refreshing the choices once jobs finished."""
+        report = gr.update(value=retrival_class._ingest_report())
+        jobs = gr.update(choices=retrival_class._active_ingest_jobs())
+        if applied == retrival_class.ingest_applied:
+            return report, jobs, applied, gr.update(), gr.update(), gr.update()
+        return (
+            report,
+            jobs,
+            retrival_class.ingest_applied,
+            gr.update(choices=retrival_class._get_cached_repos()),
+            gr.update(choices=retrival_class._check_branch_cache(repos)),
+            gr.update(choices=retrival_class._get_cached_shared()),
+        )
+
+    def cancel_ingest_job(job_id: str):
+        retrival_class._cancel_ingest_job(job_id)
+        return gr.update(value=None, choices=retrival_class._active_ingest_jobs())
+
     def user_input(user_input: str, history: list):
         if not args.keep_history:
             history = []
@@ -471,6 +467,22 @@ def main(args):
                     visible=False,
                 )
                 documents = gr.Markdown(visible=False)
+                ingest_status = gr.Markdown(visible=False)
+                with gr.Row():
+                    with gr.Column():
+                        ingest_job_box = gr.Dropdown(
+                            choices=[],
+                            label="Running Ingestion Jobs",
+                            interactive=True,
+                            visible=False,
+                        )
+                    with gr.Column():
+                        cancel_job_button = gr.Button(
+                            "Cancel Job",
+                            variant="secondary",
+                            interactive=True,
+                            visible=False,
+                        )
 
         main_page_boxes = [
             main_page_markdown,
@@ -485,7 +497,11 @@ def main(args):
             chatbot_box,
             clear_history,
             documents,
-        ]
+        ] + (
+            [ingest_status, ingest_job_box, cancel_job_button]
+            if retrival_class.ingest_jobs is not None
+            else []
+        )
 
         ## Main section UI controll
         git_box.change(fn=changed_repo, inputs=[git_box], outputs=[version_box])
@@ -531,6 +547,23 @@ def main(args):
 
         clear_history.click(lambda: gr.update(value=[]), [], chatbot_box)
 
+        # Ingestion runs in worker processes, its jobs are polled
+        ingest_applied = gr.State(retrival_class.ingest_applied)
+        ingest_timer = gr.Timer(2, active=retrival_class.ingest_jobs is not None)
+        ingest_timer.tick(
+            poll_ingest_jobs,
+            [ingest_applied, git_box],
+            [
+                ingest_status,
+                ingest_job_box,
+                ingest_applied,
+                git_box,
+                version_box,
+                shared_box,
+            ],
+        )
+        cancel_job_button.click(cancel_ingest_job, [ingest_job_box], [ingest_job_box])
+
         add_repo.click(
             lambda: len(main_page_boxes) * [gr.update(visible=False)],
             [],
@@ -0,0 +1,341 @@
+import atexit
+import json
+import multiprocessing
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+
+class IngestCancelled(Exception):
+    """Raised inside a job when its cancellation was requested."""
+
+
+class IngestJobQueue:
+    """Persistent queue of ingestion jobs stored in SQLite.
+
+    Jobs are claimed by worker processes and report their progress back
+    through the queue, so their status can be polled from any process and
+    survives restarts. Jobs left running by a crashed worker are queued again
+    on startup. Finished jobs stay unapplied until the serving process has
+    registered their results. Jobs name the datasets they index, a job is
+    only claimed once no running or unapplied job indexes one of them.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute(
+            """CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                kind TEXT,
+                payload TEXT,
+                status TEXT,
+                progress REAL,
+                message TEXT,
+                result TEXT,
+                cancel INTEGER,
+                applied INTEGER,
+                worker INTEGER,
+                created REAL,
+                updated REAL,
+                datasets TEXT
+            )"""
+        )
+        columns = [
+            row["name"] for row in self.connection.execute("PRAGMA table_info(jobs)")
+        ]
+        if "datasets" not in columns:
+            # Queues of older versions
+            self.connection.execute(
+                "ALTER TABLE jobs ADD COLUMN datasets TEXT DEFAULT '[]'"
+            )
+        self.connection.commit()
+
+    def __execute(self, query: str, parameters=()):
+        with self.lock:
+            # Rows are read before committing, which RETURNING requires
+            rows = self.connection.execute(query, parameters).fetchall()
+            self.connection.commit()
+            return rows
+
+    def __row(self, row):
+        if row is None:
+            return None
+        job = dict(row)
+        job["payload"] = json.loads(job["payload"])
+        job["result"] = None if job["result"] is None else json.loads(job["result"])
+        job["datasets"] = json.loads(job["datasets"] or "[]")
+        return job
+
+    def submit(self, kind: str, payload: dict, datasets: list[str] = ()):
+        """Queue a job, unless the same job is already queued.
+
+        Args:
+            kind (str): Kind of the job.
+            payload (dict): JSON serializable arguments of the job.
+            datasets (list[str]): Datasets the job indexes.
+        Returns:
+            str: ID of the job, or of the already queued equal job.
+        """
+        payload, datasets = json.dumps(payload), json.dumps(sorted(datasets))
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT id FROM jobs WHERE status = 'queued' "
+                "AND kind = ? AND payload = ? AND datasets = ?",
+                (kind, payload, datasets),
+            ).fetchone()
+            if row is not None:
+                return row["id"]
+            job_id = uuid.uuid4().hex[:12]
+            now = time.time()
+            self.connection.execute(
+                "INSERT INTO jobs (id, kind, payload, status, progress, message, "
+                "result, cancel, applied, worker, created, updated, datasets) "
+                "VALUES (?, ?, ?, 'queued', 0, '', NULL, 0, 0, NULL, ?, ?, ?)",
+                (job_id, kind, payload, now, now, datasets),
+            )
+            self.connection.commit()
+        return job_id
+
+    def claim(self, worker: int):
+        """Take the oldest queued job whose datasets are not being indexed.
+
+        Datasets of running jobs and of finished jobs not applied yet are
+        busy, so jobs of one dataset run and are applied one after another.
+
+        Returns:
+            dict: The claimed job, None if no job can run now.
+        """
+        with self.lock:
+            # Claims of all worker processes are serialized by the write lock
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                busy = set()
+                for row in self.connection.execute(
+                    "SELECT datasets FROM jobs WHERE status = 'running' "
+                    "OR (status = 'done' AND applied = 0)"
+                ):
+                    busy.update(json.loads(row["datasets"] or "[]"))
+                row = None
+                for queued in self.connection.execute(
+                    "SELECT id, datasets FROM jobs WHERE status = 'queued' "
+                    "ORDER BY created"
+                ).fetchall():
+                    if busy.isdisjoint(json.loads(queued["datasets"] or "[]")):
+                        row = self.connection.execute(
+                            "UPDATE jobs SET status = 'running', worker = ?, "
+                            "updated = ? WHERE id = ? RETURNING *",
+                            (worker, time.time(), queued["id"]),
+                        ).fetchone()
+                        break
+                self.connection.commit()
+            except BaseException:
+                self.connection.rollback()
+                raise
+        return self.__row(row)
+
+    def active_datasets(self):
+        """Datasets of the queued and running jobs."""
+        datasets = set()
+        for row in self.__execute(
+            "SELECT datasets FROM jobs WHERE status IN ('queued', 'running')"
+        ):
+            datasets.update(json.loads(row["datasets"] or "[]"))
+        return datasets
+
+    def progress(self, job_id: str, progress: float, message: str = ""):
+        """Report the progress of a running job.
+
+        Raises:
+            IngestCancelled: If the cancellation of the job was requested.
+        """
+        rows = self.__execute(
+            "UPDATE jobs SET progress = ?, message = ?, updated = ? "
+            "WHERE id = ? RETURNING cancel",
+            (progress, message, time.time(), job_id),
+        )
+        if len(rows) > 0 and rows[0]["cancel"]:
+            raise IngestCancelled(job_id)
+
+    def finish(self, job_id: str, result: dict):
+        self.__execute(
+            "UPDATE jobs SET status = 'done', progress = 1, result = ?, updated = ? "
+            "WHERE id = ?",
+            (json.dumps(result), time.time(), job_id),
+        )
+
+    def fail(self, job_id: str, message: str, status: str = "failed"):
+        self.__execute(
+            "UPDATE jobs SET status = ?, message = ?, updated = ? WHERE id = ?",
+            (status, message, time.time(), job_id),
+        )
+
+    def cancel(self, job_id: str):
+        """Cancel a queued job or ask a running job to stop.
+
+        Returns:
+            bool: True if the job was still queued or running.
+        """
+        with self.lock:
+            cursor = self.connection.execute(
+                """UPDATE jobs SET
+                status = CASE status WHEN 'queued' THEN 'cancelled' ELSE status END,
+                cancel = 1, updated = ?
+                WHERE id = ? AND status IN ('queued', 'running')""",
+                (time.time(), job_id),
+            )
+            self.connection.commit()
+            return cursor.rowcount > 0
+
+    def get(self, job_id: str):
+        """Status, progress and result of a job, None if unknown."""
+        rows = self.__execute("SELECT * FROM jobs WHERE id = ?", (job_id,))
+        return self.__row(rows[0]) if len(rows) > 0 else None
+
+    def jobs(self, limit: int = 20):
+        """The most recently submitted jobs."""
+        rows = self.__execute(
+            "SELECT * FROM jobs ORDER BY created DESC LIMIT ?", (limit,)
+        )
+        return [self.__row(row) for row in rows]
+
+    def unapplied(self):
+        """Finished jobs whose results were not registered yet."""
+        rows = self.__execute(
+            "SELECT * FROM jobs WHERE status = 'done' AND applied = 0 ORDER BY updated"
+        )
+        return [self.__row(row) for row in rows]
+
+    def mark_applied(self, job_id: str):
+        self.__execute("UPDATE jobs SET applied = 1 WHERE id = ?", (job_id,))
+
+    def fail_worker(self, worker: int):
+        """Fail the running jobs of a worker that died."""
+        self.__execute(
+            "UPDATE jobs SET status = 'failed', message = 'Worker died', updated = ? "
+            "WHERE status = 'running' AND worker = ?",
+            (time.time(), worker),
+        )
+
+    def requeue_running(self):
+        """Queue again the jobs interrupted by a restart."""
+        self.__execute(
+            "UPDATE jobs SET status = 'queued', progress = 0, worker = NULL "
+            "WHERE status = 'running'"
+        )
+
+
+def _work(queue_path: str, handler_factory, handler_args=(), poll_interval=1.0):
+    """Run jobs of the queue until the process is stopped.
+
+    The handler is created once per worker by `handler_factory(*handler_args)`
+    and called as `handler(job, progress)`, where `progress(fraction, message)`
+    raises IngestCancelled once the job should stop.
+    """
+    queue = IngestJobQueue(queue_path)
+    handler = handler_factory(*handler_args)
+    while True:
+        job = queue.claim(os.getpid())
+        if job is None:
+            time.sleep(poll_interval)
+            continue
+        try:
+            result = handler(
+                job,
+                lambda progress, message="": queue.progress(
+                    job["id"], progress, message
+                ),
+            )
+            queue.finish(job["id"], result)
+        except IngestCancelled:
+            queue.fail(job["id"], "Cancelled", status="cancelled")
+        except Exception as e:
+            print(e)
+            queue.fail(job["id"], repr(e))
+
+
+class IngestWorkerPool:
+    """Workers running ingestion jobs outside of the request handlers.
+
+    With `processes` above zero every worker is a spawned process, keeping
+    splitting and embedding off the GIL of the serving process. Otherwise a
+    single thread of the serving process runs the jobs. A watcher thread
+    restarts dead workers and hands finished jobs to `apply_function` in the
+    serving process.
+    """
+
+    def __init__(
+        self,
+        queue: IngestJobQueue,
+        handler_factory,
+        handler_args=(),
+        processes: int = 1,
+        apply_function=None,
+        poll_interval: float = 1.0,
+    ):
+        self.queue = queue
+        self.handler_factory = handler_factory
+        self.handler_args = handler_args
+        self.processes = processes
+        self.apply_function = apply_function
+        self.poll_interval = poll_interval
+        self.context = multiprocessing.get_context("spawn")
+        self.stopped = threading.Event()
+
+        self.queue.requeue_running()
+        if processes > 0:
+            self.workers = [self.__start_process() for _ in range(processes)]
+        else:
+            self.workers = [
+                threading.Thread(
+                    target=_work,
+                    args=(queue.path, handler_factory, handler_args, poll_interval),
+                    daemon=True,
+                )
+            ]
+            self.workers[0].start()
+        self.watcher = threading.Thread(target=self.__watch, daemon=True)
+        self.watcher.start()
+        atexit.register(self.close)
+
+    def __start_process(self):
+        process = self.context.Process(
+            target=_work,
+            args=(
+                self.queue.path,
+                self.handler_factory,
+                self.handler_args,
+                self.poll_interval,
+            ),
+            # Workers may start their own pool for splitting files
+            daemon=False,
+        )
+        process.start()
+        return process
+
+    def __watch(self):
+        while not self.stopped.wait(self.poll_interval):
+            if self.processes > 0:
+                for i, process in enumerate(self.workers):
+                    if not process.is_alive():
+                        print(f"Ingestion worker {process.pid} died, restarting")
+                        self.queue.fail_worker(process.pid)
+                        self.workers[i] = self.__start_process()
+            for job in self.queue.unapplied():
+                try:
+                    if self.apply_function is not None:
+                        self.apply_function(job)
+                except Exception as e:
+                    print(e)
+                self.queue.mark_applied(job["id"])
+
+    def close(self):
+        """Stop the watcher and terminate worker processes."""
+        self.stopped.set()
+        if self.processes > 0:
+            for process in self.workers:
+                process.terminate()
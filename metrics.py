@@ -0,0 +1,263 @@
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import bisect
+import threading
+import time
+
+# Upper bounds in seconds of the latency histogram buckets
+# fmt: off
+LATENCY_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0
+)
+# fmt: on
+# Upper bounds of the prompt token histogram buckets
+TOKEN_BUCKETS = (256, 512, 1024, 2048, 4096, 8192, 16384, 32768, 131072)
+INF_LABEL = 'le="+Inf"'
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels, extra: str = ""):
+    parts = [f'{name}="{_escape(value)}"' for name, value in labels]
+    if extra != "":
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if len(parts) > 0 else ""
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metrics:
+    """Process wide counters and histograms in the Prometheus text format.
+
+    Metrics are declared once with `describe` and recorded by name with
+    labels as keyword arguments. Gauges are read on scrape from collectors,
+    functions returning (name, labels, value) samples. Worker processes hand
+    their recorded metrics over with `export`, merged in the serving process
+    with `merge`.
+    """
+
+    def __init__(self):
+        self.descriptions = {}
+        self.counters = {}
+        # (name, labels) -> [bucket counts, sum, count]
+        self.histograms = {}
+        self.collectors = []
+        self.lock = threading.Lock()
+
+    def describe(self, name: str, kind: str, help: str, buckets=LATENCY_BUCKETS):
+        """Declare a counter, gauge or histogram and its help text."""
+        self.descriptions[name] = (kind, help, tuple(buckets))
+
+    def inc(self, name: str, value: float = 1, **labels):
+        """Increase a counter."""
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        """Record a value, e.g. a duration in seconds, in a histogram."""
+        buckets = self.descriptions[name][2]
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = [[0] * len(buckets), 0.0, 0]
+            histogram = self.histograms[key]
+            index = bisect.bisect_left(buckets, value)
+            if index < len(buckets):
+                histogram[0][index] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        """Observe the duration of the block in seconds."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def add_collector(self, collector):
+        """Add a function returning (name, labels, value) samples on scrape."""
+        self.collectors.append(collector)
+
+    def export(self):
+        """Take the recorded counters and histograms, resetting them.
+
+        Returns:
+            dict: JSON serializable metrics to be merged by another process.
+        """
+        with self.lock:
+            exported = {
+                "counters": [
+                    [name, [list(label) for label in labels], value]
+                    for (name, labels), value in self.counters.items()
+                ],
+                "histograms": [
+                    [name, [list(label) for label in labels], histogram]
+                    for (name, labels), histogram in self.histograms.items()
+                ],
+            }
+            self.counters = {}
+            self.histograms = {}
+        return exported
+
+    def merge(self, exported: dict):
+        """Add metrics exported by another process."""
+        with self.lock:
+            for name, labels, value in exported.get("counters", []):
+                key = (name, tuple(tuple(label) for label in labels))
+                self.counters[key] = self.counters.get(key, 0) + value
+            for name, labels, (counts, total, count) in exported.get(
+                "histograms", []
+            ):
+                key = (name, tuple(tuple(label) for label in labels))
+                if key not in self.histograms:
+                    self.histograms[key] = [[0] * len(counts), 0.0, 0]
+                histogram = self.histograms[key]
+                histogram[0] = [a + b for a, b in zip(histogram[0], counts)]
+                histogram[1] += total
+                histogram[2] += count
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format."""
+        samples = {}
+        with self.lock:
+            for (name, labels), value in self.counters.items():
+                samples.setdefault(name, []).append((labels, value))
+            histograms = {}
+            for (name, labels), (counts, total, count) in self.histograms.items():
+                histograms.setdefault(name, []).append(
+                    (labels, list(counts), total, count)
+                )
+        for collector in self.collectors:
+            try:
+                for name, labels, value in collector():
+                    samples.setdefault(name, []).append(
+                        (tuple(sorted(labels.items())), value)
+                    )
+            except Exception as e:
+                print(e)
+
+        lines = []
+        for name in sorted(set(samples) | set(histograms)):
+            kind, help, buckets = self.descriptions.get(name, ("untyped", "", ()))
+            if help != "":
+                lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in sorted(samples.get(name, [])):
+                lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+            for labels, counts, total, count in sorted(histograms.get(name, [])):
+                cumulative = 0
+                for bound, bucket_count in zip(buckets, counts):
+                    cumulative += bucket_count
+                    bound_label = f'le="{_format_value(bound)}"'
+                    lines.append(
+                        f"{name}_bucket{_format_labels(labels, bound_label)} "
+                        f"{cumulative}"
+                    )
+                lines.append(
+                    f"{name}_bucket{_format_labels(labels, INF_LABEL)} {count}"
+                )
+                lines.append(f"{name}_sum{_format_labels(labels)} {total}")
+                lines.append(f"{name}_count{_format_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port: int, host: str = "0.0.0.0"):
+        """Serve the metrics on http://host:port/metrics in a background thread.
+
+        Returns:
+            ThreadingHTTPServer: The running server.
+        """
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                data = metrics.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+METRICS = Metrics()
+
+METRICS.describe(
+    "rag_requests_total", "counter", "Chat requests by answer source"
+)
+METRICS.describe(
+    "rag_request_seconds", "histogram", "Duration of chat requests by answer source"
+)
+METRICS.describe(
+    "rag_stage_seconds",
+    "histogram",
+    "Duration of the stages of a chat request: query_embedding, retrieval, "
+    "search, dedup, rerank, prompt, first_token, generation and judgement",
+)
+METRICS.describe(
+    "rag_prompt_tokens",
+    "histogram",
+    "Estimated tokens of the prompts sent to the model",
+    buckets=TOKEN_BUCKETS,
+)
+METRICS.describe(
+    "rag_prompt_tokens_total", "counter", "Estimated tokens of all prompts"
+)
+METRICS.describe(
+    "rag_cache_total",
+    "counter",
+    "Lookups of the query embedding, retrieval, rerank score and answer caches",
+)
+METRICS.describe(
+    "rag_embedding_requests_total",
+    "counter",
+    "Calls of the embedding model for queries and ingestion batches",
+)
+METRICS.describe(
+    "rag_embedding_batch_seconds", "histogram", "Duration of ingestion batches"
+)
+METRICS.describe(
+    "rag_embedding_retries_total", "counter", "Retried ingestion batches"
+)
+METRICS.describe("rag_rerank_requests_total", "counter", "Calls of the rerankers")
+METRICS.describe(
+    "rag_reranked_documents_total", "counter", "Documents scored by the rerankers"
+)
+METRICS.describe("rag_ingest_seconds", "histogram", "Duration of dataset indexing")
+METRICS.describe("rag_ingested_files_total", "counter", "Indexed files by extension")
+METRICS.describe("rag_ingested_bytes_total", "counter", "Indexed bytes by extension")
+METRICS.describe(
+    "rag_ingested_chunks_total", "counter", "Indexed chunks by extension"
+)
+METRICS.describe("rag_open_datasets", "gauge", "Open branch and shared datasets")
+METRICS.describe(
+    "rag_dataset_memory_bytes", "gauge", "Estimated memory of the open datasets"
+)
+METRICS.describe("rag_ingest_jobs", "gauge", "Recent ingestion jobs by status")
+METRICS.describe(
+    "rag_http_requests_total", "counter", "Requests to the model endpoints"
+)
+METRICS.describe(
+    "rag_http_errors_total", "counter", "Failed requests to the model endpoints"
+)
+METRICS.describe(
+    "rag_http_connections", "gauge", "Pooled connections to the model endpoints"
+)
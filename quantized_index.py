@@ -0,0 +1,232 @@
+import os
+import threading
+import numpy as np
+
+# Precisions of the stored vectors, float32 without truncation is plain Chroma
+INDEX_PRECISIONS = ["float32", "float16", "int8"]
+# File of the quantized vectors beside the Chroma collection
+INDEX_FILE = "quantized-index.npz"
+# Candidates taken from the index per candidate re-scored exactly
+RESCORE_OVERSAMPLE = 4
+# Rows scored at once, bounds the float32 copy of int8 and float16 codes
+SEARCH_BLOCK = 16384
+
+
+class QuantizedIndex:
+    """Exhaustive vector index of reduced precision, optionally truncated vectors.
+
+    Vectors are truncated to their first `dimensions` components (Matryoshka
+    style, 0 keeps all of them), normalized and stored as float16 or as int8
+    with one scale per vector, so an index takes 2 or 4 times less memory
+    and disk than float32, times the truncation. Searches score every stored
+    vector with the inner product, i.e. the approximate cosine similarity.
+    The full float32 vectors are kept in a sidecar `.npy` file beside the
+    index, memory mapped once saved, to re-score the candidates of a search
+    without loading them.
+    """
+
+    def __init__(self, path: str, precision: str = "int8", dimensions: int = 0):
+        if precision not in INDEX_PRECISIONS:
+            raise ValueError(
+                f"Unknown index precision {precision}, expected {INDEX_PRECISIONS}"
+            )
+        self.path = path
+        self.vectors_path = f"{os.path.splitext(path)[0]}-vectors.npy"
+        self.precision = precision
+        self.dimensions = dimensions
+        self.dtype = np.dtype(precision)
+        # IDs are ASCII UUIDs, stored as bytes to not take 4 bytes per character
+        self.ids = np.zeros(0, dtype="S36")
+        self.codes = None
+        self.scales = np.zeros(0, dtype=np.float32)
+        # Full precision vectors, None if the index was saved without them
+        self.vectors = np.zeros((0, 0), dtype=np.float32)
+        # Added batches, concatenated on the next search or save
+        self.pending = []
+        self.lock = threading.Lock()
+        if os.path.exists(path):
+            with np.load(path, allow_pickle=False) as data:
+                if len(data["ids"]) > 0:
+                    self.ids = data["ids"]
+                    self.codes = data["codes"]
+                    self.scales = data["scales"]
+            self.vectors = None
+            if os.path.exists(self.vectors_path):
+                vectors = np.load(self.vectors_path, mmap_mode="r")
+                if len(vectors) == len(self.ids):
+                    self.vectors = vectors
+
+    @property
+    def rescorable(self):
+        """Whether the full precision vectors of every entry are stored."""
+        return self.vectors is not None
+
+    def __len__(self):
+        with self.lock:
+            self.__merge_pending()
+            return len(self.ids)
+
+    def __merge_pending(self):
+        if len(self.pending) == 0:
+            return
+        ids, codes, scales, vectors = zip(*self.pending)
+        self.pending = []
+        self.ids = np.concatenate([self.ids, *ids])
+        if self.codes is not None:
+            codes = (self.codes,) + codes
+        self.codes = np.concatenate(codes)
+        self.scales = np.concatenate([self.scales, *scales])
+        if self.vectors is not None:
+            if len(self.vectors) > 0:
+                vectors = (self.vectors,) + vectors
+            self.vectors = np.concatenate(vectors)
+
+    def __prepare(self, vectors):
+        """Truncate and normalize float32 vectors."""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if self.dimensions > 0:
+            vectors = vectors[..., : self.dimensions]
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+    def encode(self, vectors):
+        """Quantize vectors.
+
+        Returns:
+            tuple: Codes and the per vector scales to multiply scores with.
+        """
+        vectors = self.__prepare(vectors)
+        if self.precision == "int8":
+            scales = np.maximum(np.abs(vectors).max(axis=1), 1e-12) / 127
+            codes = np.round(vectors / scales[:, None]).astype(np.int8)
+            return codes, scales.astype(np.float32)
+        return vectors.astype(self.dtype), np.ones(len(vectors), dtype=np.float32)
+
+    def add(self, ids: list[str], vectors: list[list[float]]):
+        if len(ids) == 0:
+            return
+        vectors = np.asarray(vectors, dtype=np.float32)
+        codes, scales = self.encode(vectors)
+        with self.lock:
+            self.pending.append(
+                (np.asarray(ids, dtype="S36"), codes, scales, vectors)
+            )
+
+    def remove(self, ids: list[str]):
+        if len(ids) == 0:
+            return
+        with self.lock:
+            self.__merge_pending()
+            if self.codes is None:
+                return
+            keep = ~np.isin(self.ids, np.asarray(ids, dtype="S36"))
+            self.ids = self.ids[keep]
+            self.codes = self.codes[keep]
+            self.scales = self.scales[keep]
+            if self.vectors is not None:
+                self.vectors = self.vectors[keep]
+
+    def clear(self):
+        with self.lock:
+            self.ids = np.zeros(0, dtype="S36")
+            self.codes = None
+            self.pending = []
+            self.scales = np.zeros(0, dtype=np.float32)
+            self.vectors = np.zeros((0, 0), dtype=np.float32)
+
+    def __top_rows(self, embedding, k: int):
+        """Rows of the k best approximate scores and the index arrays."""
+        with self.lock:
+            self.__merge_pending()
+            arrays = self.ids, self.codes, self.scales, self.vectors
+        ids, codes, scales, _ = arrays
+        if len(ids) == 0 or k <= 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, np.float32), arrays
+        query = self.__prepare(embedding)
+        scores = np.empty(len(ids), dtype=np.float32)
+        for start in range(0, len(ids), SEARCH_BLOCK):
+            block = codes[start : start + SEARCH_BLOCK].astype(np.float32)
+            scores[start : start + len(block)] = block @ query
+        scores *= scales
+        k = min(k, len(ids))
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[np.argsort(-scores[best])]
+        return best, scores[best], arrays
+
+    def search(self, embedding: list[float], k: int):
+        """Find the vectors most similar to the embedding.
+
+        Returns:
+            list[tuple]: IDs and approximate similarities, most similar first.
+        """
+        rows, scores, (ids, _, _, _) = self.__top_rows(embedding, k)
+        return [(ids[i].decode("ascii"), float(s)) for i, s in zip(rows, scores)]
+
+    def rescored_search(self, embedding: list[float], k: int):
+        """Search `RESCORE_OVERSAMPLE` times k candidates and re-score them.
+
+        The candidates are re-scored with their full precision vectors read
+        from the sidecar file. Indexes saved without them keep the approximate
+        scores and return their dequantized vectors, truncated to `dimensions`.
+
+        Returns:
+            tuple: IDs, similarities and vectors of up to k hits, most
+                similar first.
+        """
+        rows, scores, (ids, codes, scales, vectors) = self.__top_rows(
+            embedding, k * RESCORE_OVERSAMPLE
+        )
+        if len(rows) == 0:
+            return [], np.zeros(0, dtype=np.float32), np.zeros((0, 0), np.float32)
+        # Sorted rows read the memory mapped sidecar sequentially
+        order = np.argsort(rows)
+        rows, scores = rows[order], scores[order]
+        if vectors is None:
+            candidates = codes[rows].astype(np.float32) * scales[rows, None]
+        else:
+            candidates = np.asarray(vectors[rows], dtype=np.float32)
+            query = np.asarray(embedding, dtype=np.float32)
+            scores = (candidates @ query) / np.maximum(
+                np.linalg.norm(candidates, axis=1) * np.linalg.norm(query), 1e-12
+            )
+        best = np.argsort(-scores)[:k]
+        return (
+            [ids[rows[i]].decode("ascii") for i in best],
+            scores[best],
+            candidates[best],
+        )
+
+    def save(self):
+        """Write the index, replacing the previous file at once."""
+        with self.lock:
+            self.__merge_pending()
+            ids, codes, scales, vectors = (
+                self.ids,
+                self.codes,
+                self.scales,
+                self.vectors,
+            )
+        if codes is None:
+            codes = np.zeros((0, max(0, self.dimensions)), dtype=self.dtype)
+        if vectors is not None:
+            temporary = f"{self.vectors_path}.tmp"
+            with open(temporary, "wb") as file:
+                np.save(file, vectors)
+            os.replace(temporary, self.vectors_path)
+        temporary = f"{self.path}.tmp"
+        with open(temporary, "wb") as file:
+            np.savez(file, ids=ids, codes=codes, scales=scales)
+        os.replace(temporary, self.path)
+
+    def memory_usage(self):
+        """Bytes of the stored IDs, codes, scales and unsaved full vectors.
+
+        Memory mapped full vectors are only paged in for re-scoring.
+        """
+        with self.lock:
+            self.__merge_pending()
+            codes = 0 if self.codes is None else self.codes.nbytes
+            vectors = 0
+            if self.vectors is not None and not isinstance(self.vectors, np.memmap):
+                vectors = self.vectors.nbytes
+            return self.ids.nbytes + codes + self.scales.nbytes + vectors
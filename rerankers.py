@@ -0,0 +1,201 @@
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from langchain_core.embeddings import Embeddings
+from openai import OpenAI
+import numpy as np
+import PROMPTS
+import math
+
+
+class Reranker(ABC):
+    """Scores retrieved documents by their relevance to the query.
+
+    Documents are the dictionaries returned by EmbeddingsDataset searches.
+    Scores of one reranker are comparable across datasets, so reranked
+    documents of several branches can be merged by score. `version` is part
+    of the rerank score cache key, increase it when the scores change.
+    """
+
+    version = 1
+
+    @abstractmethod
+    def score(
+        self,
+        documents: list[dict],
+        query: str,
+        query_embedding: list[float] = None,
+        api_key: str = None,
+        model: str = None,
+    ):
+        """Score the documents.
+
+        Returns:
+            list: Relevance score of each document, None drops the document.
+        """
+
+
+class LLMReranker(Reranker):
+    """Asks the chat model for the "Yes" log probability of each document.
+
+    Calls run concurrently on a shared pool over clients from
+    `client_factory(api_key, model)`. With `batch_size` above one, several
+    documents are judged by a single call.
+    """
+
+    # 2: single document answers are read from the answer token logprobs
+    version = 2
+
+    def __init__(self, client_factory, concurrency: int = 8, batch_size: int = 1):
+        self.client_factory = client_factory
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+        self.batch_size = max(1, batch_size)
+
+    def score(self, documents, query, query_embedding=None, api_key=None, model=None):
+        open_api = self.client_factory(api_key, model)
+        batches = [
+            documents[i : i + self.batch_size]
+            for i in range(0, len(documents), self.batch_size)
+        ]
+        futures = [
+            self.executor.submit(self.__score_batch, open_api, batch, query, model)
+            for batch in batches
+        ]
+        return [score for future in futures for score in future.result()]
+
+    def __score_batch(self, open_api: OpenAI, documents, query, model):
+        """Score a batch of documents, one call per document if not batched.
+
+        Returns:
+            list: Log probability of relevance of each document or None.
+        """
+        if len(documents) > 1:
+            rank_out = open_api.chat.completions.create(
+                model=model,
+                messages=[
+                    {
+                        "role": "user",
+                        "content": PROMPTS.RERANK_BATCH_PROMPT.format(
+                            query=query,
+                            documents="\n".join(
+                                f'Document {j + 1}: """{doc["content"]}"""'
+                                for j, doc in enumerate(documents)
+                            ),
+                        ),
+                    }
+                ],
+                max_tokens=6 * len(documents),
+                temperature=0.2,
+                logprobs=True,
+            )
+            scores = self.__batch_yes_logprobs(rank_out.choices[0].logprobs)
+            if scores is not None and len(scores) == len(documents):
+                return scores
+        # Fall back to one call per document
+        scores = []
+        for doc in documents:
+            rank_out = open_api.chat.completions.create(
+                model=model,
+                messages=[
+                    {
+                        "role": "user",
+                        "content": PROMPTS.RERANK_PROMPT.format(
+                            query=query, document=doc["content"]
+                        ),
+                    }
+                ],
+                max_tokens=1,
+                temperature=0.2,
+                logprobs=True,
+            )
+            scores.append(self.__yes_logprob(rank_out.choices[0].logprobs))
+        return scores
+
+    @staticmethod
+    def __answer_logprob(token: dict):
+        """Relevance log probability of a "Yes" or "No" answer token, else None.
+
+        "No" answers are scored with log(1 - p(No)), so documents answered
+        either way stay comparable.
+        """
+        answer = token["token"].strip()
+        if answer == "Yes":
+            return token["logprob"]
+        if answer == "No":
+            return math.log(max(1e-12, -math.expm1(token["logprob"])))
+        return None
+
+    def __yes_logprob(self, logprobs):
+        """Read the relevance log probability of a single answer token."""
+        if logprobs is None:
+            return None
+        content = logprobs.to_dict().get("content")
+        if not content:
+            return None
+        return self.__answer_logprob(content[0])
+
+    def __batch_yes_logprobs(self, logprobs):
+        """Read the relevance log probability of each answer line."""
+        if logprobs is None or logprobs.to_dict().get("content") is None:
+            return None
+        scores = []
+        for token in logprobs.to_dict()["content"]:
+            score = self.__answer_logprob(token)
+            if score is not None:
+                scores.append(score)
+        return scores
+
+
+class EmbeddingReranker(Reranker):
+    """Cosine similarity of the query and document embeddings, in process.
+
+    Document embeddings come from the cache backed embedding model, so chunks
+    that were indexed are not sent to the embedding server again.
+    """
+
+    def __init__(self, embedding_function: Embeddings):
+        self.embedding_function = embedding_function
+
+    def score(self, documents, query, query_embedding=None, api_key=None, model=None):
+        if query_embedding is None:
+            query_embedding = self.embedding_function.embed_query(query)
+        doc_embeddings = np.asarray(
+            self.embedding_function.embed_documents(
+                [doc["content"] for doc in documents]
+            ),
+            dtype=np.float32,
+        )
+        query_embedding = np.asarray(query_embedding, dtype=np.float32)
+        norms = np.linalg.norm(doc_embeddings, axis=1) * np.linalg.norm(
+            query_embedding
+        )
+        return (doc_embeddings @ query_embedding / np.maximum(norms, 1e-12)).tolist()
+
+
+class CrossEncoderReranker(Reranker):
+    """Small cross-encoder scoring all (query, document) pairs in one CPU batch.
+
+    Requires the sentence-transformers package.
+    """
+
+    def __init__(
+        self,
+        model_name: str = "cross-encoder/ms-marco-MiniLM-L-6-v2",
+        batch_size: int = 32,
+    ):
+        try:
+            from sentence_transformers import CrossEncoder
+        except ImportError as e:
+            raise ImportError(
+                "The cross-encoder reranker requires sentence-transformers, "
+                "install it with `pip install sentence-transformers`."
+            ) from e
+        self.model = CrossEncoder(model_name, device="cpu")
+        self.batch_size = batch_size
+
+    def score(self, documents, query, query_embedding=None, api_key=None, model=None):
+        scores = self.model.predict(
+            [(query, doc["content"]) for doc in documents],
+            batch_size=self.batch_size,
+            show_progress_bar=False,
+        )
+        return [float(score) for score in scores]
@@ -1,17 +1,48 @@
-from embeddings_dataset_langchain import EmbeddingsDataset
+from embeddings_dataset_langchain import EmbeddingsDataset, SPLITTER_CONFIGS
+from dataset_cache import DatasetCache
+from branch_downloader import BranchDownloader
+from freshness import FreshnessScheduler
+from ingest_jobs import IngestJobQueue, IngestWorkerPool, IngestCancelled
+from score_cache import RerankScoreCache
+from answer_cache import AnswerCache
+from context_packer import count_tokens, format_document, pack_documents
+from rerankers import LLMReranker, EmbeddingReranker, CrossEncoderReranker
 from langchain_openai import OpenAIEmbeddings
+from langchain.embeddings import CacheBackedEmbeddings
+from embedding_cache import embedding_store
 from langchain_community.document_transformers import LongContextReorder
-from openai import OpenAI
-from zipfile import ZipFile, BadZipFile
+from client_registry import ClientRegistry
+from metrics import METRICS
+from quantized_index import INDEX_PRECISIONS
+from zipfile import ZipFile
 import PROMPTS
 import MODEL_TYPES
 import CONTEXT_SIZE
 import os
 import json
 import git
-import subprocess
 import argparse
 import shutil
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+
+# Available reranker backends
+RERANKER_CLASSES = {
+    "llm": LLMReranker,
+    "embedding": EmbeddingReranker,
+    "cross-encoder": CrossEncoderReranker,
+}
+RERANKERS = list(RERANKER_CLASSES)
+# Number of query embeddings kept for reuse
+QUERY_EMBEDDING_CACHE_SIZE = 128
+# Number of retrieved contexts of chat messages kept for later turns
+RETRIEVAL_CACHE_SIZE = 256
+# Characters per streamed chunk of a cached answer
+ANSWER_REPLAY_CHUNK = 16
 
 
 class RetrivalAugment:
@@ -26,6 +57,44 @@ class RetrivalAugment:
 
         self.cache_dir = cache_dir
         os.makedirs(self.cache_dir, exist_ok=True)
+        # Processes used to load and split files during ingestion
+        self.ingest_workers = getattr(args, "ingest_workers", 0)
+        # Embedding requests kept in flight during ingestion
+        self.embed_concurrency = getattr(args, "embed_concurrency", 4)
+        # Datasets searched concurrently for a single request
+        self.retrieval_concurrency = getattr(args, "retrieval_concurrency", 8)
+        # Rerank calls in flight across all requests and documents per call
+        self.rerank_concurrency = getattr(args, "rerank_concurrency", 8)
+        self.rerank_batch_size = getattr(args, "rerank_batch_size", 1)
+        self.cross_encoder_model = getattr(
+            args, "cross_encoder_model", "cross-encoder/ms-marco-MiniLM-L-6-v2"
+        )
+        self.rerankers = {}
+        self.rerank_scores = RerankScoreCache(
+            os.path.join(self.cache_dir, "rerank-scores.sqlite3"),
+            max_entries=getattr(args, "rerank_cache_size", 100000),
+        )
+        # Branch archives downloaded concurrently, keeping only indexed files
+        self.downloader = BranchDownloader(
+            extensions=SPLITTER_CONFIGS.keys(),
+            concurrency=getattr(args, "download_concurrency", 4),
+        )
+        # Answers of semantically repeated questions, disabled by default
+        self.answers = AnswerCache(
+            os.path.join(self.cache_dir, "answers.sqlite3"),
+            max_entries=getattr(args, "answer_cache_size", 0),
+            threshold=getattr(args, "answer_cache_threshold", 0.97),
+        )
+        # OpenAI clients and connection pools shared by the whole process
+        self.clients = ClientRegistry(
+            max_connections=getattr(args, "http_max_connections", 64),
+            max_keepalive_connections=getattr(args, "http_max_connections", 64) // 2,
+            keepalive_expiry=getattr(args, "http_keepalive", 60.0),
+            timeout=getattr(args, "http_timeout", 120.0),
+        )
+        # Embedding models and rerankers per API key, created on first use
+        self.embedding_functions = {}
+        self.clients_lock = threading.RLock()
 
         # Store requested cache list location
         self.cache_repo_list = cache_repo_list
@@ -35,45 +104,334 @@ class RetrivalAugment:
             json.dump(self.cached, open(self.cache_repo_list, "w+"), indent=6)
         else:
             self.cached = json.load(open(self.cache_repo_list, "r"))
+        # Guards the cache list, changed by the UI, ingestion and refreshes
+        self.cached_lock = threading.RLock()
 
-        # Template variable for shared documents that could be uploaded
-        self.shared_documents = {}
-        self.version_specific_documents = {}
+        # Content addressed chunk embeddings shared by all branches and files
+        self.embedding_store = embedding_store(
+            os.path.join(self.cache_dir, "embedding-cache"),
+            MODEL_TYPES.DEFAULT_EMBED_MODEL,
+        )
+
+        # Recently embedded queries, shared by document listing and answering
+        self.query_embeddings = OrderedDict()
+        self.query_embeddings_lock = threading.Lock()
+        # Retrieved documents of past chat messages per dataset selection
+        self.retrievals = OrderedDict()
+        self.retrievals_lock = threading.Lock()
+
+        # Single collection holding the chunks of every branch and shared file
+        self.collection_dir = (
+            os.path.join(self.cache_dir, "collection-embed")
+            if getattr(args, "single_collection", False)
+            else None
+        )
+        # Vectors of new indexes stored quantized and truncated, if set
+        self.index_precision = getattr(args, "index_precision", "float32")
+        self.index_dimensions = getattr(args, "index_dimensions", 0)
+        if self.collection_dir is not None and (
+            self.index_precision != "float32" or self.index_dimensions > 0
+        ):
+            raise ValueError(
+                "Quantized indexes are not supported with a single collection"
+            )
+        # Datasets with a queued rebuild of their index to the settings above
+        self.index_rebuilds = set()
+        self.index_rebuilds_lock = threading.Lock()
+        # Lazily opened branch and shared datasets
+        self.datasets = DatasetCache(
+            max_open=getattr(args, "max_open_datasets", 64),
+            memory_budget=int(getattr(args, "dataset_memory_budget", 0) * 2**20),
+        )
         self.__load_all_cached()
+        for pinned in getattr(args, "pin_datasets", None) or []:
+            self._pin_dataset(pinned)
 
-    def __load_all_cached(self):
-        """Load all cached repositories and shared documents."""
-        # Load each git repo
-        for key in self.cached["cached_repos"].keys():
-            # Embedding storage variable
-            self.version_specific_documents[key] = {}
-            normalized_github_path = key.removesuffix(".git")
-            _, repo_rel_name = os.path.split(normalized_github_path)
-            # Load all cached branches of the git repo
-            for branch in self.cached["cached_repos"][key].keys():
-                self.version_specific_documents[key][branch] = EmbeddingsDataset(
-                    os.path.join(self.cache_dir, repo_rel_name, branch),
-                    cache_dir=os.path.join(
-                        self.cache_dir, f"{repo_rel_name}-{branch}-embed"
+        # Worker processes index into staging copies of existing branches
+        self.ingest_staging = False
+        # Number of finished ingestion jobs registered in this process
+        self.ingest_applied = 0
+        # Ingestion jobs run outside of the request handlers unless disabled
+        self.ingest_jobs = None
+        self.ingest_pool = None
+        ingest_processes = getattr(args, "ingest_processes", 0)
+        if ingest_processes > 0:
+            self.ingest_jobs = IngestJobQueue(
+                os.path.join(self.cache_dir, "ingest-jobs.sqlite3")
+            )
+            if self.collection_dir is not None:
+                # The shared collection is only written through this process
+                self.ingest_pool = IngestWorkerPool(
+                    self.ingest_jobs,
+                    lambda: self._run_ingest_job,
+                    processes=0,
+                    apply_function=self._apply_ingest_job,
+                )
+            else:
+                self.ingest_pool = IngestWorkerPool(
+                    self.ingest_jobs,
+                    _ingest_worker,
+                    (
+                        self.cache_repo_list,
+                        self.cache_dir,
+                        # Workers neither start workers nor schedule refreshes
+                        argparse.Namespace(
+                            **{
+                                **vars(args),
+                                "ingest_processes": 0,
+                                "refresh_interval": 0,
+                            }
+                        ),
                     ),
-                    transformer_model=OpenAIEmbeddings(
+                    processes=ingest_processes,
+                    apply_function=self._apply_ingest_job,
+                )
+
+        # Cached branches are refreshed once their remote head moved
+        self.freshness = None
+        refresh_interval = getattr(args, "refresh_interval", 0)
+        if refresh_interval > 0:
+            intervals = {}
+            for repo_interval in getattr(args, "repo_refresh_interval", None) or []:
+                repo, _, minutes = repo_interval.rpartition("=")
+                intervals[repo] = float(minutes) * 60
+            self.freshness = FreshnessScheduler(
+                self._indexed_heads,
+                self._get_repo_heads,
+                self._refresh_moved_branches,
+                record=self._record_heads,
+                interval=refresh_interval * 60,
+                intervals=intervals,
+                jitter=getattr(args, "refresh_jitter", 0.1),
+            )
+
+        # Gauges of datasets, ingestion jobs and connections read on scrape
+        METRICS.add_collector(self._collect_metrics)
+
+    def _embedding_function(self, api_key: str = "None"):
+        """Get the embedding model backed by the shared chunk embedding cache.
+
+        Chunks are looked up by (embedding model, chunk text hash) before the
+        embedding server is called, so files shared between branches and
+        repositories are embedded only once.
+
+        Args:
+            api_key (str): API key for the embedding model.
+        Returns:
+            CacheBackedEmbeddings: The cached embedding model.
+        """
+        with self.clients_lock:
+            if api_key not in self.embedding_functions:
+                self.embedding_functions[api_key] = CacheBackedEmbeddings(
+                    OpenAIEmbeddings(
                         model=MODEL_TYPES.DEFAULT_EMBED_MODEL,
-                        api_key="None",
+                        api_key=api_key,
                         base_url=MODEL_TYPES.DEFAULT_EMBED_LOC,
+                        http_client=self.clients.http_client(
+                            MODEL_TYPES.DEFAULT_EMBED_LOC
+                        ),
                     ),
+                    self.embedding_store,
+                )
+            return self.embedding_functions[api_key]
+
+    def _embed_query(self, query: str):
+        """Embed the query once and reuse the vector for every dataset.
+
+        All datasets share the same embedding model, so the vector is kept in
+        a small LRU and reused by by-vector searches of every branch and
+        shared file, and across the document listing and answering steps.
+
+        Args:
+            query (str): The user question.
+        Returns:
+            list[float]: The query embedding.
+        """
+        with self.query_embeddings_lock:
+            embedding = self.query_embeddings.get(query)
+            if embedding is not None:
+                self.query_embeddings.move_to_end(query)
+        if embedding is not None:
+            METRICS.inc("rag_cache_total", cache="query_embedding", result="hit")
+            return embedding
+        METRICS.inc("rag_cache_total", cache="query_embedding", result="miss")
+        METRICS.inc("rag_embedding_requests_total", kind="query")
+        # Embedded outside of the lock, concurrent requests do not wait
+        with METRICS.timer("rag_stage_seconds", stage="query_embedding"):
+            embedding = self._embedding_function().embed_query(query)
+        with self.query_embeddings_lock:
+            self.query_embeddings[query] = embedding
+            while len(self.query_embeddings) > QUERY_EMBEDDING_CACHE_SIZE:
+                self.query_embeddings.popitem(last=False)
+        return embedding
+
+    def _branch_embed_dir(self, base_repo: str, branch: str):
+        """Directory of the embedding cache of a branch."""
+        _, repo_rel_name = os.path.split(base_repo.removesuffix(".git"))
+        return os.path.join(self.cache_dir, f"{repo_rel_name}-{branch}-embed")
+
+    def __branch_dataset(
+        self,
+        base_repo: str,
+        branch: str,
+        api_key: str = "None",
+        refresh=False,
+        cache_dir: str = None,
+        progress=None,
+    ):
+        """Open the embedding dataset of a cached branch."""
+        _, repo_rel_name = os.path.split(base_repo.removesuffix(".git"))
+        dataset = EmbeddingsDataset(
+            os.path.join(self.cache_dir, repo_rel_name, branch),
+            cache_dir=(
+                self._branch_embed_dir(base_repo, branch)
+                if cache_dir is None
+                else cache_dir
+            ),
+            transformer_model=self._embedding_function(api_key),
+            workers=self.ingest_workers,
+            embed_concurrency=self.embed_concurrency,
+            refresh=refresh,
+            collection_dir=self.collection_dir,
+            dataset_key=f"{base_repo}@{branch}",
+            progress=progress,
+            index_precision=self.index_precision,
+            index_dimensions=self.index_dimensions,
+        )
+        if dataset.index_outdated and cache_dir is None:
+            self._queue_index_rebuild(("repo", base_repo, branch))
+        return dataset
+
+    def _shared_embed_dir(self, filename: str):
+        """Directory of the embedding cache of a shared file."""
+        return os.path.join(self.cache_dir, f'{filename.split(".")[0]}-embed')
+
+    def __shared_dataset(
+        self,
+        filename: str,
+        api_key: str = "None",
+        progress=None,
+        cache_dir: str = None,
+    ):
+        """Open the embedding dataset of a cached shared file."""
+        dataset = EmbeddingsDataset(
+            os.path.join(self.cache_dir, filename.split(".")[0]),
+            cache_dir=(
+                self._shared_embed_dir(filename) if cache_dir is None else cache_dir
+            ),
+            transformer_model=self._embedding_function(api_key),
+            workers=self.ingest_workers,
+            embed_concurrency=self.embed_concurrency,
+            collection_dir=self.collection_dir,
+            dataset_key=filename,
+            progress=progress,
+            index_precision=self.index_precision,
+            index_dimensions=self.index_dimensions,
+        )
+        if dataset.index_outdated and cache_dir is None:
+            self._queue_index_rebuild(("shared", filename))
+        return dataset
+
+    def _branch_dataset(self, base_repo: str, branch: str):
+        """Get the dataset of a cached branch, opening it on first use."""
+        return self.datasets.get(("repo", base_repo, branch))
+
+    def _shared_dataset(self, filename: str):
+        """Get the dataset of a cached shared file, opening it on first use."""
+        return self.datasets.get(("shared", filename))
+
+    def __merge_datasets(self, datasets: list[EmbeddingsDataset]):
+        """Pair datasets with the number of selected datasets they cover.
+
+        In single collection mode all datasets are searched at once through
+        one filtered view of the shared collection.
+        """
+        if self.collection_dir is not None and len(datasets) > 1:
+            return [(EmbeddingsDataset.merged(datasets), len(datasets))]
+        return [(dataset, 1) for dataset in datasets]
+
+    def _version_keys(self, git_repos: list[str], versions: list[str]):
+        """Dataset keys of the selected versions of the git repos."""
+        keys = []
+        for repo in git_repos:
+            _, repo_rel_name = os.path.split(repo.removesuffix(".git"))
+            repo_dir = os.path.dirname(repo)
+            _, repo_rel_dir = os.path.split(repo_dir)
+
+            for version in versions:
+                if f"{repo_rel_dir}/{repo_rel_name}" in version:
+                    _, true_ver = os.path.split(version)
+                    keys.append(("repo", repo, true_ver))
+        return keys
+
+    def _search_datasets(self, keys: list[tuple]):
+        """Open the datasets to search for the given dataset keys.
+
+        The memory of the open datasets is logged when one had to be opened.
+
+        Returns:
+            list[tuple]: Dataset and the number of selected datasets it covers.
+        """
+        opened = [key for key in keys if self.datasets.get_open(key) is None]
+        datasets = [self.datasets.get(key) for key in keys]
+        if len(opened) > 0:
+            print(self._dataset_memory_report())
+        return self.__merge_datasets(datasets)
+
+    def _dataset_names(self, keys: list[tuple]):
+        """Names of datasets, `<repo>@<branch>` or the shared filename."""
+        return [
+            f"{key[1]}@{key[2]}" if key[0] == "repo" else key[1] for key in keys
+        ]
+
+    def _dataset_reindexed(self, dataset_key: str):
+        """Invalidate everything derived from the previous index of a dataset.
+
+        Args:
+            dataset_key (str): Shared filename or `<repo>@<branch>`.
+        """
+        self.rerank_scores.invalidate(dataset_key)
+        self.answers.invalidate(dataset_key)
+        with self.retrievals_lock:
+            for key in [
+                key
+                for key, (_, _, dataset_keys) in self.retrievals.items()
+                if dataset_key in dataset_keys
+            ]:
+                del self.retrievals[key]
+
+    def _pin_dataset(self, name: str):
+        """Keep a dataset open once used.
+
+        Args:
+            name (str): Shared filename or `<repo>@<branch>` of a cached branch.
+        """
+        if name in self.cached["cached_shared"]:
+            self.datasets.pin(("shared", name))
+        else:
+            base_repo, _, branch = name.rpartition("@")
+            self.datasets.pin(("repo", base_repo, branch))
+
+    def _dataset_memory_report(self):
+        """Report the estimated memory of every open dataset."""
+        return self.datasets.report()
+
+    def __load_all_cached(self):
+        """Register all cached repositories and shared documents.
+
+        Datasets are only opened when first queried.
+        """
+        # Register each git repo
+        for key in self.cached["cached_repos"].keys():
+            # Register all cached branches of the git repo
+            for branch in self.cached["cached_repos"][key].keys():
+                self.datasets.register(
+                    ("repo", key, branch), partial(self.__branch_dataset, key, branch)
                 )
 
         for filename in self.cached["cached_shared"]:
-            self.shared_documents[filename] = EmbeddingsDataset(
-                os.path.join(self.cache_dir, filename.split(".")[0]),
-                cache_dir=os.path.join(
-                    self.cache_dir, f'{filename.split(".")[0]}-embed'
-                ),
-                transformer_model=OpenAIEmbeddings(
-                    model=MODEL_TYPES.DEFAULT_EMBED_MODEL,
-                    api_key="None",
-                    base_url=MODEL_TYPES.DEFAULT_EMBED_LOC,
-                ),
+            self.datasets.register(
+                ("shared", filename), partial(self.__shared_dataset, filename)
             )
 
     def _get_repo_branches(self, base_repo: str):
@@ -84,21 +442,77 @@ class RetrivalAugment:
             list: A list of branch names in the git repository.
 
         """
+        heads = self._get_repo_heads(base_repo)
+        if heads is None:
+            return []
+        return list(heads.keys())
+
+    def _get_repo_heads(self, base_repo: str):
+        """Retrieves the head commit SHA of every branch of a git repository.
+        Args:
+            base_repo (str): The URL of the git repository.
+        Returns:
+            dict: Branch names mapped to their head SHA, None if not accessible.
+        """
         # Check if proper git repo format
         if not base_repo.endswith(".git"):
-            return []
-        branches = []
+            return None
+        heads = {}
         g = git.cmd.Git()
         # Try to lookup all of git branches
         try:
             # Utilize git command to list all branches
             for ref in g.ls_remote("--heads", base_repo).split("\n"):
-                branches.append(ref.split("/")[-1])
-            return branches
+                if ref.strip() == "":
+                    continue
+                sha, _, name = ref.partition("\t")
+                heads[name.split("/")[-1]] = sha
+            return heads
         # Execption if git repo is not found or not accessible
         except Exception as e:
             print(e)
-            return []
+            return None
+
+    def _indexed_heads(self):
+        """Head SHAs the cached branches were indexed at, empty if unknown."""
+        with self.cached_lock:
+            return {
+                repo: {branch: info.get("sha", "") for branch, info in branches.items()}
+                for repo, branches in self.cached["cached_repos"].items()
+            }
+
+    def _record_heads(self, base_repo: str, heads: dict):
+        """Record the head SHAs of branches cached before SHAs were recorded.
+
+        Args:
+            base_repo (str): The URL of the git repository.
+            heads (dict): Branch names mapped to their remote head SHA.
+        """
+        with self.cached_lock:
+            branches = self.cached["cached_repos"].get(base_repo, {})
+            for branch, sha in heads.items():
+                if branch in branches and branches[branch].get("sha", "") == "":
+                    branches[branch]["sha"] = sha
+            self._save_cached()
+
+    def _save_cached(self):
+        """Save the cache list of repos and shared files."""
+        with self.cached_lock, open(self.cache_repo_list, "w+") as file:
+            json.dump(self.cached, file, indent=6)
+
+    def _refresh_moved_branches(self, base_repo: str, branches: list[str]):
+        """Refresh branches found moved by the freshness scheduler.
+
+        Branches with a queued or running ingestion job of any kind are
+        skipped, they are checked again on the next tick.
+        """
+        if self.ingest_jobs is not None:
+            active = self.ingest_jobs.active_datasets()
+            branches = [
+                branch for branch in branches if f"{base_repo}@{branch}" not in active
+            ]
+        if len(branches) > 0:
+            self._refresh_repo_branches(base_repo, branches)
 
     def _get_branches_redirects(self, base_repo: str, branches: list[str]):
         """Retrieves the redirects for the specified branches in a given base repository.
@@ -199,6 +613,17 @@ class RetrivalAugment:
     def _add_following_repo_branches(
         self, base_repo: str, repo_branches: list[str], api_key: str = None, *args
     ):
+        """Download and index new branches, refresh the already cached ones.
+
+        Args:
+            base_repo (str): The URL of the git repository.
+            repo_branches (list[str]): Branches to add or refresh.
+            api_key (str): API key for the embedding model.
+            *args: Optional redirect paths of the branches.
+        Returns:
+            str: ID of the ingestion job of the new branches, or else of the
+                refresh, None if indexed in this call.
+        """
         if not base_repo.endswith(".git"):
             return
         # if api_key.strip() == '' and 'OPENAI_API_KEY' in os.environ.keys() and os.getenv('OPENAI_API_KEY').strip() != '':
@@ -210,11 +635,8 @@ class RetrivalAugment:
         # Split the repo path
         _, repo_rel_name = os.path.split(normalized_github_path)
         # Check if repo is cached
-        if not base_repo in self.cached["cached_repos"].keys():
-            self.cached["cached_repos"][base_repo] = {}
-        if not base_repo in self.version_specific_documents.keys():
-            # Add repo to loaded repos
-            self.version_specific_documents[base_repo] = {}
+        with self.cached_lock:
+            self.cached["cached_repos"].setdefault(base_repo, {})
         # Check if no redirects are given (Quick submission)
         if len(args) == 0:
             redirect_mindfully_inputted = False
@@ -223,147 +645,212 @@ class RetrivalAugment:
         else:
             requested_redirects = list(args)
             redirect_mindfully_inputted = True
+        new_redirects = {}
+        refresh_branches = []
         for requested_branch, redirect in zip(repo_branches, requested_redirects):
             if requested_branch in self.cached["cached_repos"][base_repo].keys():
+                refresh_branches.append(requested_branch)
                 if redirect_mindfully_inputted:
-                    self.cached["cached_repos"][base_repo][requested_branch] = {
-                        "path": redirect.strip().rstrip("/")
-                    }
-                if (
-                    not requested_branch
-                    in self.version_specific_documents[base_repo].keys()
-                ):
-                    self.version_specific_documents[base_repo][requested_branch] = (
-                        EmbeddingsDataset(
-                            os.path.join(
-                                self.cache_dir, repo_rel_name, requested_branch
-                            ),
-                            cache_dir=os.path.join(
-                                self.cache_dir,
-                                f"{repo_rel_name}-{requested_branch}-embed",
-                            ),
-                            transformer_model=OpenAIEmbeddings(
-                                model=MODEL_TYPES.DEFAULT_EMBED_MODEL,
-                                api_key=api_key,
-                                base_url=MODEL_TYPES.DEFAULT_EMBED_LOC,
-                            ),
-                        )
+                    with self.cached_lock:
+                        self.cached["cached_repos"][base_repo][requested_branch][
+                            "path"
+                        ] = redirect.strip().rstrip("/")
+                if not ("repo", base_repo, requested_branch) in self.datasets:
+                    self.datasets.register(
+                        ("repo", base_repo, requested_branch),
+                        partial(
+                            self.__branch_dataset, base_repo, requested_branch, api_key
+                        ),
                     )
             else:
-                # Try to download the branch
-                subprocess.run(
-                    f'curl -L -o {os.path.abspath(os.path.join(self.cache_dir, requested_branch + ".zip"))} {normalized_github_path}/zipball/{requested_branch}',
-                    shell=True,
+                new_redirects[requested_branch] = redirect
+        job_id = None
+        if self.ingest_jobs is not None:
+            # Registered once the job is done, see _apply_ingest_job
+            if len(new_redirects) > 0:
+                job_id = self.ingest_jobs.submit(
+                    "branches",
+                    {
+                        "repo": base_repo,
+                        "branches": list(new_redirects.keys()),
+                        "redirects": new_redirects,
+                    },
+                    [f"{base_repo}@{branch}" for branch in new_redirects],
                 )
-                # Check if branch is downloaded
-                try:
-                    # Try to open the zip file
-                    zf = ZipFile(
-                        os.path.join(self.cache_dir, f"{requested_branch}.zip"), "r"
-                    )
-                # If zip file is corrupted
-                except BadZipFile as _:
-                    # Remove the zip file
-                    os.remove(os.path.join(self.cache_dir, f"{requested_branch}.zip"))
-                    # Try alternative download method (https://code.it4i.cz/sccs/docs.it4i.cz/-/archive/master/docs.it4i.cz-master.zip)
-                    subprocess.run(
-                        f'curl -L -o {os.path.abspath(os.path.join(self.cache_dir, requested_branch + ".zip"))} {normalized_github_path}/-/archive/{requested_branch}/zipfile.zip',
-                        shell=True,
-                    )
-                # Try to open the zip file
-                if os.path.exists(
-                    os.path.join(self.cache_dir, f"{requested_branch}.zip")
-                ):
-                    try:
-                        # Open the zip file
-                        zf = ZipFile(
-                            os.path.join(self.cache_dir, f"{requested_branch}.zip"), "r"
-                        )
-                        # Create the directory for the branch
-                        os.makedirs(
-                            os.path.join(self.cache_dir, repo_rel_name), exist_ok=True
-                        )
-                        # Remove the branch directory if it exists
-                        if os.path.exists(
-                            os.path.join(
-                                self.cache_dir, repo_rel_name, requested_branch
-                            )
-                        ):
-                            shutil.rmtree(
-                                os.path.join(
-                                    self.cache_dir, repo_rel_name, requested_branch
-                                )
-                            )
+        else:
+            indexed = self._download_and_index_branches(
+                base_repo, list(new_redirects.keys()), api_key
+            )
+            with self.cached_lock:
+                for requested_branch, sha in indexed.items():
+                    self.cached["cached_repos"][base_repo][requested_branch] = {
+                        "path": new_redirects[requested_branch].strip().rstrip("/"),
+                        "sha": sha,
+                    }
+        with self.cached_lock:
+            # Remove Key entry if embedding failed
+            if len(self.cached["cached_repos"][base_repo].keys()) == 0:
+                self.cached["cached_repos"].pop(base_repo)
+            # Save the cache list
+            self._save_cached()
+        # Re-submitted branches only re-embed their changed files
+        if len(refresh_branches) > 0:
+            refresh_job_id = self._refresh_repo_branches(
+                base_repo, refresh_branches, api_key
+            )
+            if job_id is None:
+                job_id = refresh_job_id
+        return job_id
 
-                        filenames = zf.namelist()
+    def _refresh_repo_branches(
+        self, base_repo: str, repo_branches: list[str], api_key: str = None
+    ):
+        """Re-download cached branches and re-embed only their changed files.
 
-                        zf.extractall(
-                            os.path.join(self.cache_dir, repo_rel_name),
-                            members=filenames,
-                        )
-                        # Move files to the branch directory
-                        shutil.move(
-                            os.path.join(
-                                self.cache_dir, repo_rel_name, zf.namelist()[0]
-                            ),
-                            os.path.join(
-                                self.cache_dir, repo_rel_name, requested_branch
-                            ),
-                        )
-                        # Remove the branch cache directory if it exists
-                        if os.path.exists(
-                            os.path.join(
-                                self.cache_dir,
-                                f"{repo_rel_name}-{requested_branch}-embed",
-                            )
-                        ):
-                            shutil.rmtree(
-                                os.path.join(
-                                    self.cache_dir,
-                                    f"{repo_rel_name}-{requested_branch}-embed",
-                                )
-                            )
+        Args:
+            base_repo (str): The URL of the git repository.
+            repo_branches (list[str]): Cached branches to refresh.
+            api_key (str): API key for the embedding model.
+        Returns:
+            str: ID of the ingestion job, None if indexed in this call.
+        """
+        api_key = "API_KEY"
+        if not base_repo in self.cached["cached_repos"].keys():
+            return None
+        repo_branches = [
+            requested_branch
+            for requested_branch in repo_branches
+            if requested_branch in self.cached["cached_repos"][base_repo].keys()
+        ]
+        if self.ingest_jobs is not None:
+            return self.ingest_jobs.submit(
+                "branches",
+                {"repo": base_repo, "branches": repo_branches, "redirects": {}},
+                [f"{base_repo}@{branch}" for branch in repo_branches],
+            )
+        indexed = self._download_and_index_branches(base_repo, repo_branches, api_key)
+        with self.cached_lock:
+            for requested_branch, sha in indexed.items():
+                self.cached["cached_repos"][base_repo][requested_branch]["sha"] = sha
+            self._save_cached()
+        return None
 
-                        self.version_specific_documents[base_repo][requested_branch] = (
-                            EmbeddingsDataset(
-                                os.path.join(
-                                    self.cache_dir, repo_rel_name, requested_branch
-                                ),
-                                cache_dir=os.path.join(
-                                    self.cache_dir,
-                                    f"{repo_rel_name}-{requested_branch}-embed",
-                                ),
-                                transformer_model=OpenAIEmbeddings(
-                                    model=MODEL_TYPES.DEFAULT_EMBED_MODEL,
-                                    api_key=api_key,
-                                    base_url=MODEL_TYPES.DEFAULT_EMBED_LOC,
-                                ),
-                            )
-                        )
+    def _download_and_index_branches(
+        self,
+        base_repo: str,
+        requested_branches: list[str],
+        api_key: str,
+        progress=None,
+        staging_id: str = None,
+        staging_dirs: dict = None,
+    ):
+        """Download branch archives concurrently and (re)index each of them.
 
-                        self.cached["cached_repos"][base_repo][requested_branch] = {
-                            "path": redirect.strip().rstrip("/")
-                        }
-                        zf.close()
-                        # Remove the zip file
-                        os.remove(
-                            os.path.join(self.cache_dir, f"{requested_branch}.zip")
-                        )
-                    # If zip file is corrupted
-                    except Exception as e:
-                        # Print the error
-                        print(e)
-                        # Remove the zip file
-                        os.remove(
-                            os.path.join(self.cache_dir, f"{requested_branch}.zip")
-                        )
-        # Remove Key entry if embedding failed
-        if len(self.cached["cached_repos"][base_repo].keys()) == 0:
-            self.cached["cached_repos"].pop(base_repo)
-            # Remove the repo from the loaded repos
-            self.version_specific_documents.pop(base_repo)
-        # Save the cache list
-        json.dump(self.cached, open(self.cache_repo_list, "w+"), indent=6)
+        Branches are indexed one by one as their downloads complete, while the
+        remaining downloads continue. An existing embedding cache of a branch
+        is refreshed incrementally from its file manifest. In ingestion worker
+        processes it is refreshed in a staging copy, swapped in by the serving
+        process.
+
+        Args:
+            base_repo (str): The URL of the git repository.
+            requested_branches (list[str]): The branches to download.
+            api_key (str): API key for the embedding model.
+            progress: Optional `progress(fraction, message)` of an ingestion job.
+            staging_id (str): Suffix of the staging copies of this run,
+                the ingestion job id.
+            staging_dirs (dict): Filled with the staging copy of every branch
+                refreshed in one.
+
+        Returns:
+            dict: Downloaded and indexed branches mapped to the head SHA they
+                were downloaded at, empty if unknown.
+        """
+        normalized_github_path = base_repo.removesuffix(".git")
+        _, repo_rel_name = os.path.split(normalized_github_path)
+        if progress is not None:
+            progress(0.0, f"Downloading {len(requested_branches)} branches")
+        # Heads listed just before the download, recorded for freshness checks
+        heads = self._get_repo_heads(base_repo) or {}
+        indexed = {}
+        for i, (requested_branch, downloaded) in enumerate(
+            self.downloader.download_many(
+                normalized_github_path,
+                requested_branches,
+                lambda branch: os.path.join(self.cache_dir, repo_rel_name, branch),
+            )
+        ):
+            if not downloaded:
+                continue
+            branch_progress = None
+            if progress is not None:
+                branch_progress = partial(
+                    self.__branch_progress,
+                    progress,
+                    requested_branch,
+                    i,
+                    len(requested_branches),
+                )
+            key = ("repo", base_repo, requested_branch)
+            embed_dir = self._branch_embed_dir(base_repo, requested_branch)
+            index_dir = embed_dir
+            if self.ingest_staging and os.path.exists(embed_dir):
+                index_dir = f"{embed_dir}.staging-{staging_id}"
+            existed = os.path.exists(index_dir) or index_dir != embed_dir
+            try:
+                # Refresh the already opened embeddings in place
+                dataset = self.datasets.get_open(key)
+                if dataset is not None:
+                    dataset.progress = branch_progress
+                    dataset.refresh()
+                    dataset.progress = None
+                    self.datasets.update_memory(key)
+                elif self.ingest_staging:
+                    if index_dir != embed_dir:
+                        shutil.rmtree(index_dir, ignore_errors=True)
+                        shutil.copytree(embed_dir, index_dir)
+                    self.__branch_dataset(
+                        base_repo,
+                        requested_branch,
+                        api_key,
+                        refresh=True,
+                        cache_dir=index_dir,
+                        progress=branch_progress,
+                    ).close()
+                    if index_dir != embed_dir and staging_dirs is not None:
+                        staging_dirs[requested_branch] = index_dir
+                else:
+                    self.datasets.put(
+                        key,
+                        self.__branch_dataset(
+                            base_repo,
+                            requested_branch,
+                            api_key,
+                            refresh=True,
+                            progress=branch_progress,
+                        ),
+                        partial(self.__branch_dataset, base_repo, requested_branch),
+                    )
+                    self.datasets.get_open(key).progress = None
+                self._dataset_reindexed(f"{base_repo}@{requested_branch}")
+                indexed[requested_branch] = heads.get(requested_branch, "")
+            except IngestCancelled:
+                # A partially built index would be taken as complete
+                if not existed or index_dir != embed_dir:
+                    shutil.rmtree(index_dir, ignore_errors=True)
+                raise
+            except Exception as e:
+                # Print the error
+                print(e)
+                if index_dir != embed_dir:
+                    shutil.rmtree(index_dir, ignore_errors=True)
+        return indexed
+
+    def __branch_progress(self, progress, branch, index, count, done, total):
+        progress(
+            (index + done / max(1, total)) / max(1, count),
+            f"Indexing {branch}: {done}/{total} files",
+        )
 
     def _add_following_file(self, file_info: str, api_key: str = None):
         # if api_key.strip() == '' and 'OPENAI_API_KEY' in os.environ.keys() and os.getenv('OPENAI_API_KEY').strip() != '':
@@ -376,67 +863,334 @@ class RetrivalAugment:
         if filename in self.cached["cached_shared"]:
             # Return if already cached
             os.remove(file_info)
-            return
+            return None
+        # Move file to cache directory
+        shutil.move(file_info, os.path.join(self.cache_dir, filename))
+        if self.ingest_jobs is not None:
+            # Registered once the job is done, see _apply_ingest_job
+            return self.ingest_jobs.submit(
+                "file", {"filename": filename}, [filename]
+            )
         # Process the file
-        else:
-            # Move file to cache directory
-            shutil.move(file_info, os.path.join(self.cache_dir, filename))
-            try:
-                # Remove cache directory if it exists
-                if os.path.exists(os.path.join(self.cache_dir, filename.split(".")[0])):
-                    shutil.rmtree(os.path.join(self.cache_dir, filename.split(".")[0]))
-                # Create the cache directory for the file
-                os.makedirs(
-                    os.path.join(self.cache_dir, filename.split(".")[0]), exist_ok=True
-                )
+        if self._index_shared_file(filename, api_key) is not None:
+            with self.cached_lock:
+                self.cached["cached_shared"].append(filename)
+        # Save the cache list
+        self._save_cached()
+        return None
 
-                # Open the zip file
-                if filename.endswith(".zip"):
-                    zf = ZipFile(os.path.join(self.cache_dir, filename), "r")
-                    filenames = zf.namelist()
-                    zf.extractall(
-                        os.path.join(self.cache_dir, filename.removesuffix(".zip")),
-                        members=filenames,
-                    )
-                else:
-                    shutil.move(
-                        os.path.join(self.cache_dir, filename),
-                        os.path.join(self.cache_dir, filename.split(".")[0], filename),
-                    )
-                    filenames = [filename]
+    def _index_shared_file(self, filename: str, api_key: str, progress=None):
+        """Extract and index a shared file moved into the cache directory.
 
-                self.shared_documents[filename] = EmbeddingsDataset(
-                    os.path.join(self.cache_dir, filename.split(".")[0]),
-                    cache_dir=os.path.join(
-                        self.cache_dir, f'{filename.split(".")[0]}-embed'
-                    ),
-                    transformer_model=OpenAIEmbeddings(
-                        model=MODEL_TYPES.DEFAULT_EMBED_MODEL,
-                        api_key=api_key,
-                        base_url=MODEL_TYPES.DEFAULT_EMBED_LOC,
-                    ),
+        Args:
+            filename (str): Name of the file in the cache directory.
+            api_key (str): API key for the embedding model.
+            progress: Optional `progress(fraction, message)` of an ingestion job.
+
+        Returns:
+            str: The filename if it was indexed, otherwise None.
+        """
+        file_progress = None
+        if progress is not None:
+            progress(0.0, f"Extracting {filename}")
+            file_progress = lambda done, total: progress(
+                done / max(1, total), f"Indexing {filename}: {done}/{total} files"
+            )
+        try:
+            # Remove cache directory if it exists
+            if os.path.exists(os.path.join(self.cache_dir, filename.split(".")[0])):
+                shutil.rmtree(os.path.join(self.cache_dir, filename.split(".")[0]))
+            # Create the cache directory for the file
+            os.makedirs(
+                os.path.join(self.cache_dir, filename.split(".")[0]), exist_ok=True
+            )
+
+            # Open the zip file
+            if filename.endswith(".zip"):
+                zf = ZipFile(os.path.join(self.cache_dir, filename), "r")
+                filenames = zf.namelist()
+                zf.extractall(
+                    os.path.join(self.cache_dir, filename.removesuffix(".zip")),
+                    members=filenames,
                 )
-                self.cached["cached_shared"].append(filename)
-                # Close the zip file
-                if filename.endswith(".zip"):
-                    zf.close()
-                    # Remove the file
-                    os.remove(os.path.join(self.cache_dir, filename))
+            else:
+                shutil.move(
+                    os.path.join(self.cache_dir, filename),
+                    os.path.join(self.cache_dir, filename.split(".")[0], filename),
+                )
+                filenames = [filename]
 
-            # If file is corrupted
-            except Exception as e:
-                # Print the error
-                print(e)
+            if self.ingest_staging:
+                self.__shared_dataset(filename, api_key, file_progress).close()
+            else:
+                self.datasets.put(
+                    ("shared", filename),
+                    self.__shared_dataset(filename, api_key, file_progress),
+                    partial(self.__shared_dataset, filename),
+                )
+            # Close the zip file
+            if filename.endswith(".zip"):
+                zf.close()
                 # Remove the file
                 os.remove(os.path.join(self.cache_dir, filename))
+            return filename
+        except IngestCancelled:
+            # A partially built index would be taken as complete
+            shutil.rmtree(
+                os.path.join(self.cache_dir, f'{filename.split(".")[0]}-embed'),
+                ignore_errors=True,
+            )
+            if os.path.exists(os.path.join(self.cache_dir, filename)):
+                os.remove(os.path.join(self.cache_dir, filename))
+            raise
+        # If file is corrupted
+        except Exception as e:
+            # Print the error
+            print(e)
+            # Remove the file
+            if os.path.exists(os.path.join(self.cache_dir, filename)):
+                os.remove(os.path.join(self.cache_dir, filename))
+            return None
+
+    def _run_ingest_job(self, job: dict, progress):
+        """Run an ingestion job of the job queue.
+
+        Returns:
+            dict: Result of the job, registered by _apply_ingest_job.
+        """
+        api_key = "API_KEY"
+        payload = job["payload"]
+        if job["kind"] == "branches":
+            staging = {}
+            result = {
+                "indexed": self._download_and_index_branches(
+                    payload["repo"],
+                    payload["branches"],
+                    api_key,
+                    progress,
+                    staging_id=job["id"],
+                    staging_dirs=staging,
+                ),
+                "staging": staging,
+            }
+        elif job["kind"] == "file":
+            result = {
+                "shared": self._index_shared_file(
+                    payload["filename"], api_key, progress
+                )
+            }
+        elif job["kind"] == "reindex":
+            result = {
+                "reindexed": self._rebuild_index(
+                    payload, api_key, job["id"], progress
+                )
+            }
+        else:
+            raise ValueError(f"Unknown ingestion job kind {job['kind']}")
+        if self.ingest_staging:
+            # Worker processes hand their ingestion metrics to the server
+            result["metrics"] = METRICS.export()
+        return result
+
+    def _apply_ingest_job(self, job: dict):
+        """Register the datasets indexed by a finished ingestion job."""
+        payload, result = job["payload"], job["result"]
+        if job["kind"] == "branches":
+            base_repo = payload["repo"]
+            for requested_branch, sha in result["indexed"].items():
+                key = ("repo", base_repo, requested_branch)
+                embed_dir = self._branch_embed_dir(base_repo, requested_branch)
+                staging_dir = result.get("staging", {}).get(requested_branch)
+                if staging_dir is not None and os.path.exists(staging_dir):
+                    self.datasets.replace(
+                        key, partial(self.__swap_staging, embed_dir, staging_dir)
+                    )
+                self.datasets.register(
+                    key, partial(self.__branch_dataset, base_repo, requested_branch)
+                )
+                with self.cached_lock:
+                    branches = self.cached["cached_repos"].setdefault(base_repo, {})
+                    if requested_branch not in branches:
+                        branches[requested_branch] = {
+                            "path": payload["redirects"]
+                            .get(requested_branch, "")
+                            .strip()
+                            .rstrip("/")
+                        }
+                    branches[requested_branch]["sha"] = sha
+                self._dataset_reindexed(f"{base_repo}@{requested_branch}")
+        elif job["kind"] == "file" and result["shared"] is not None:
+            with self.cached_lock:
+                if result["shared"] not in self.cached["cached_shared"]:
+                    self.cached["cached_shared"].append(result["shared"])
+            self.datasets.register(
+                ("shared", result["shared"]),
+                partial(self.__shared_dataset, result["shared"]),
+            )
+            self._dataset_reindexed(result["shared"])
+        elif job["kind"] == "reindex":
+            self._apply_index_rebuild(payload, result["reindexed"])
+        METRICS.merge(result.get("metrics", {}))
         # Save the cache list
-        json.dump(self.cached, open(self.cache_repo_list, "w+"), indent=6)
+        self._save_cached()
+        self.ingest_applied += 1
+
+    def __rebuild_target(self, payload: dict):
+        """Dataset key, embedding cache and factory of a rebuild payload."""
+        if "filename" in payload:
+            return (
+                ("shared", payload["filename"]),
+                self._shared_embed_dir(payload["filename"]),
+                partial(self.__shared_dataset, payload["filename"]),
+            )
+        return (
+            ("repo", payload["repo"], payload["branch"]),
+            self._branch_embed_dir(payload["repo"], payload["branch"]),
+            partial(self.__branch_dataset, payload["repo"], payload["branch"]),
+        )
+
+    def _queue_index_rebuild(self, key: tuple):
+        """Rebuild the index of a dataset with the current index settings.
+
+        The rebuild runs as an ingestion job, or in a background thread
+        without ingestion jobs, while the dataset keeps being searched with
+        its previous index. Called when a dataset is opened, so it must not
+        block.
+        """
+        if self.ingest_staging:
+            # Worker processes only run the jobs of the serving process
+            return
+        with self.index_rebuilds_lock:
+            if key in self.index_rebuilds:
+                return
+            self.index_rebuilds.add(key)
+        if key[0] == "repo":
+            payload = {"repo": key[1], "branch": key[2]}
+        else:
+            payload = {"filename": key[1]}
+        print(f"Rebuilding the index of {self._dataset_names([key])[0]}")
+        if self.ingest_jobs is not None:
+            self.ingest_jobs.submit(
+                "reindex", payload, self._dataset_names([key])
+            )
+        else:
+            threading.Thread(
+                target=self.__rebuild_index_now, args=(payload,), daemon=True
+            ).start()
+
+    def __rebuild_index_now(self, payload: dict):
+        try:
+            self._apply_index_rebuild(
+                payload, self._rebuild_index(payload, "API_KEY", uuid.uuid4().hex)
+            )
+        except Exception as e:
+            print(e)
+            with self.index_rebuilds_lock:
+                self.index_rebuilds.discard(self.__rebuild_target(payload)[0])
+
+    def _rebuild_index(
+        self, payload: dict, api_key: str, staging_id: str, progress=None
+    ):
+        """Index a dataset with the current index settings into a staging copy.
+
+        The chunks are embedded from the shared embedding cache, the staging
+        copy replaces the dataset in _apply_index_rebuild.
+
+        Args:
+            staging_id (str): Suffix of the staging copy, the ingestion job id.
+
+        Returns:
+            str: The staging copy, None if the dataset is not indexed.
+        """
+        _, embed_dir, open_dataset = self.__rebuild_target(payload)
+        if not os.path.exists(embed_dir):
+            return None
+        dataset_progress = None
+        if progress is not None:
+            dataset_progress = lambda done, total: progress(
+                done / max(1, total), f"Rebuilding index: {done}/{total} files"
+            )
+        staging_dir = f"{embed_dir}.staging-{staging_id}"
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        try:
+            open_dataset(
+                api_key, progress=dataset_progress, cache_dir=staging_dir
+            ).close()
+        except BaseException:
+            # A partially built index would be taken as complete
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            raise
+        return staging_dir
+
+    def _apply_index_rebuild(self, payload: dict, staging_dir: str):
+        """Swap in the rebuilt index once no request searches the dataset."""
+        key, embed_dir, _ = self.__rebuild_target(payload)
+        if staging_dir is not None and os.path.exists(staging_dir):
+            self.datasets.replace(
+                key, partial(self.__swap_staging, embed_dir, staging_dir)
+            )
+            self._dataset_reindexed(self._dataset_names([key])[0])
+        with self.index_rebuilds_lock:
+            self.index_rebuilds.discard(key)
+
+    def __swap_staging(self, embed_dir: str, staging_dir: str):
+        """Replace the embedding cache with a refreshed staging copy."""
+        os.rename(embed_dir, f"{staging_dir}.old")
+        os.rename(staging_dir, embed_dir)
+        shutil.rmtree(f"{staging_dir}.old", ignore_errors=True)
+
+    def _ingest_job(self, job_id: str):
+        """Status, progress and result of an ingestion job, None if unknown."""
+        if self.ingest_jobs is None or job_id is None:
+            return None
+        return self.ingest_jobs.get(job_id)
+
+    def _cancel_ingest_job(self, job_id: str):
+        """Cancel a queued or running ingestion job."""
+        if self.ingest_jobs is None or job_id is None:
+            return False
+        return self.ingest_jobs.cancel(job_id)
+
+    def _active_ingest_jobs(self):
+        """IDs of the queued and running ingestion jobs."""
+        if self.ingest_jobs is None:
+            return []
+        return [
+            job["id"]
+            for job in self.ingest_jobs.jobs()
+            if job["status"] in ("queued", "running")
+        ]
+
+    def _ingest_report(self):
+        """Markdown table of the recent ingestion jobs."""
+        if self.ingest_jobs is None:
+            return ""
+        jobs = self.ingest_jobs.jobs(limit=10)
+        if len(jobs) == 0:
+            return ""
+        lines = [
+            "### Ingestion Jobs",
+            "| Job | Source | Status | Progress | Message |",
+            "| --- | --- | --- | --- | --- |",
+        ]
+        for job in jobs:
+            source = job["payload"].get("repo") or job["payload"].get("filename")
+            if job["kind"] == "branches":
+                source += " " + ", ".join(job["payload"]["branches"])
+            elif job["kind"] == "reindex" and "branch" in job["payload"]:
+                source += " " + job["payload"]["branch"]
+            lines.append(
+                f"| {job['id']} | {source} | {job['status']} | "
+                f"{job['progress'] * 100:.0f}% | {job['message']} |"
+            )
+        return "\n".join(lines)
 
     def _get_relevant_docs(
         self, git_repos: list[str], versions: list[str], inputs: list[str]
     ) -> str:
 
         result_string = "### Most Relevant Documents"
+        query_embedding = self._embed_query(inputs[-1]["content"])
         # Iterate over all repositories
         for repo in git_repos:
             # Split the repo path
@@ -450,13 +1204,18 @@ class RetrivalAugment:
                 # Check if version is in the repo
                 if f"{repo_rel_dir}/{repo_rel_name}" in version:
                     _, true_ver = os.path.split(version)
-                    relevant_docs = (
-                        self.version_specific_documents[repo][true_ver]
-                    ).relevant_docs_filename(
-                        inputs[-1]["content"],
-                        k=max(1, CONTEXT_SIZE.GIT_DOCUMENTS // len(versions)),
-                        fetch_k=max(1, CONTEXT_SIZE.GIT_DIVERSE_K // len(versions)),
-                    )
+                    # Leased so eviction cannot close the dataset mid-search
+                    with self.datasets.lease([("repo", repo, true_ver)]):
+                        relevant_docs = self._branch_dataset(
+                            repo, true_ver
+                        ).relevant_docs_filename(
+                            inputs[-1]["content"],
+                            k=max(1, CONTEXT_SIZE.GIT_DOCUMENTS // len(versions)),
+                            fetch_k=max(
+                                1, CONTEXT_SIZE.GIT_DIVERSE_K // len(versions)
+                            ),
+                            embedding=query_embedding,
+                        )
                     full_paths = []
                     for path in relevant_docs:
                         # Get the relative file path
@@ -495,35 +1254,314 @@ class RetrivalAugment:
 
         return result_string
 
-    def _rerank_documents(self, documents, query, api_key, model):
-        """Rerank documents based on their relevance to the query."""
-        open_api = OpenAI(api_key=api_key, base_url=MODEL_TYPES.LLM_MODELS[model])
-        reranked_docs = []
-        for doc in documents:
-            rank_out = open_api.chat.completions.create(
-                model=model,
-                messages=[
-                    {
-                        "role": "user",
-                        "content": PROMPTS.RERANK_PROMPT.format(
-                            query=query, document=doc["content"]
-                        ),
-                    }
-                ],
-                max_tokens=1,
-                temperature=0.2,
-                logprobs=True,
-            )
-            if rank_out.choices[0].logprobs.to_dict().get("Yes") is not None:
-                reranked_docs.append(
-                    (doc, rank_out.choices[0].logprobs.to_dict().get("Yes"))
+    def _retrieve_documents(
+        self,
+        query: str,
+        version_datasets: list[tuple],
+        shared_datasets: list[tuple],
+        num_versions: int,
+        num_shared: int,
+        rerank: str,
+        api_key: str,
+        model: str,
+    ):
+        """Retrieve the candidate documents of one question.
+
+        Every dataset is searched (and reranked) concurrently, bounded by the
+        retrieval concurrency of a single request. Which candidates make it
+        into the prompt is decided by the context packer.
+
+        Returns:
+            tuple: Scored documents of the versions and of the shared files.
+        """
+        query_embedding = self._embed_query(query)
+
+        def version_documents(dataset: EmbeddingsDataset, covered: int):
+            # Get the relevant documents
+            docs = dataset(
+                query,
+                k=CONTEXT_SIZE.GIT_TO_RANK * covered // num_versions,
+                fetch_k=CONTEXT_SIZE.GIT_DIVERSE_K * covered // num_versions,
+                embedding=query_embedding,
+            )
+            if rerank:
+                return self._rerank_documents(
+                    docs,
+                    query,
+                    api_key,
+                    model,
+                    rerank,
+                    query_embedding,
+                    dataset.dataset_keys,
+                )
+            # Without reranking the search order interleaves the datasets
+            return [(doc, -rank) for rank, doc in enumerate(docs)]
+
+        def shared_documents(dataset: EmbeddingsDataset, covered: int):
+            # Get the relevant documents
+            docs = dataset.querry_documents_small(
+                query,
+                k=CONTEXT_SIZE.SHARED_TO_RANK * covered // num_shared,
+                fetch_k=CONTEXT_SIZE.SHARED_DIVERSE_K * covered // num_shared,
+                embedding=query_embedding,
+            )
+            if rerank:
+                return self._rerank_documents(
+                    docs,
+                    query,
+                    api_key,
+                    model,
+                    rerank,
+                    query_embedding,
+                    dataset.dataset_keys,
                 )
+            return [(doc, -rank) for rank, doc in enumerate(docs)]
+
+        tasks = len(version_datasets) + len(shared_datasets)
+        with ThreadPoolExecutor(
+            max_workers=max(1, min(self.retrieval_concurrency, tasks))
+        ) as executor:
+            version_futures = [
+                executor.submit(version_documents, dataset, covered)
+                for dataset, covered in version_datasets
+            ]
+            shared_futures = [
+                executor.submit(shared_documents, dataset, covered)
+                for dataset, covered in shared_datasets
+            ]
+            docs = [doc for future in version_futures for doc in future.result()]
+            shared_docs = [doc for future in shared_futures for doc in future.result()]
+        return docs, shared_docs
+
+    def _cached_retrieval(self, key: tuple):
+        """Get the memoized documents of a chat message, or None."""
+        with self.retrievals_lock:
+            if key not in self.retrievals:
+                return None
+            self.retrievals.move_to_end(key)
+            docs, shared_docs, _ = self.retrievals[key]
+            return docs, shared_docs
+
+    def _cache_retrieval(self, key: tuple, docs, shared_docs, dataset_keys):
+        """Memoize the documents of a chat message for the following turns.
+
+        Args:
+            dataset_keys (set): Keys of the datasets the documents come from,
+                the entry is dropped when one of them is re-indexed.
+        """
+        with self.retrievals_lock:
+            self.retrievals[key] = (docs, shared_docs, dataset_keys)
+            while len(self.retrievals) > RETRIEVAL_CACHE_SIZE:
+                self.retrievals.popitem(last=False)
+
+    def _llm_client(self, api_key: str, model: str):
+        """Get the OpenAI client of the model, reused across requests."""
+        return self.clients.openai(MODEL_TYPES.LLM_MODELS[model], api_key)
+
+    def _collect_metrics(self):
+        """Gauges of open datasets, ingestion jobs and endpoint connections.
+
+        Returns:
+            list[tuple]: (name, labels, value) samples of the metrics endpoint.
+        """
+        memory = self.datasets.memory_usage()
+        samples = [
+            ("rag_open_datasets", {}, len(memory)),
+            ("rag_dataset_memory_bytes", {}, sum(memory.values())),
+        ]
+        if self.ingest_jobs is not None:
+            statuses = {}
+            for job in self.ingest_jobs.jobs():
+                statuses[job["status"]] = statuses.get(job["status"], 0) + 1
+            samples += [
+                ("rag_ingest_jobs", {"status": status}, count)
+                for status, count in statuses.items()
+            ]
+        for endpoint, stats in self.clients.metrics().items():
+            labels = {"endpoint": endpoint}
+            idle = stats["idle_connections"]
+            samples += [
+                ("rag_http_requests_total", labels, stats["requests"]),
+                ("rag_http_errors_total", labels, stats["errors"]),
+                ("rag_http_header_seconds_total", labels, stats["seconds"]),
+                ("rag_http_connections", {**labels, "state": "idle"}, idle),
+                (
+                    "rag_http_connections",
+                    {**labels, "state": "busy"},
+                    stats["connections"] - idle,
+                ),
+            ]
+        return samples
+
+    def _reranker(self, name: str):
+        """Get the reranker backend, created on first use.
+
+        Args:
+            name (str): One of RERANKERS.
+        """
+        with self.clients_lock:
+            if name not in self.rerankers:
+                if name == "llm":
+                    self.rerankers[name] = LLMReranker(
+                        self._llm_client,
+                        concurrency=self.rerank_concurrency,
+                        batch_size=self.rerank_batch_size,
+                    )
+                elif name == "embedding":
+                    self.rerankers[name] = EmbeddingReranker(self._embedding_function())
+                elif name == "cross-encoder":
+                    self.rerankers[name] = CrossEncoderReranker(
+                        self.cross_encoder_model
+                    )
+                else:
+                    raise ValueError(f"Unknown reranker {name}, expected {RERANKERS}")
+            return self.rerankers[name]
+
+    def _rerank_documents(
+        self,
+        documents,
+        query,
+        api_key,
+        model,
+        rerank="llm",
+        query_embedding=None,
+        datasets: list[str] = (),
+    ):
+        """Rerank documents based on their relevance to the query.
+
+        Scores are looked up in the persistent rerank score cache first, only
+        the missing documents are sent to the reranker.
+
+        Args:
+            datasets (list[str]): Keys of the datasets the documents come from.
+        """
+        if rerank not in RERANKER_CLASSES:
+            raise ValueError(f"Unknown reranker {rerank}, expected {RERANKERS}")
+        # Scores of older reranker versions are not reused
+        version = RERANKER_CLASSES[rerank].version
+        if rerank == "llm":
+            model_key = f"llm:v{version}:{model}"
+        elif rerank == "cross-encoder":
+            model_key = f"cross-encoder:v{version}:{self.cross_encoder_model}"
+        else:
+            model_key = f"{rerank}:v{version}:{MODEL_TYPES.DEFAULT_EMBED_MODEL}"
+        contents = [doc["content"] for doc in documents]
+        scores = self.rerank_scores.get_many(query, contents, model_key)
+        missing = [i for i in range(len(documents)) if i not in scores]
+        METRICS.inc("rag_cache_total", len(scores), cache="rerank_score", result="hit")
+        METRICS.inc(
+            "rag_cache_total", len(missing), cache="rerank_score", result="miss"
+        )
+        if len(missing) > 0:
+            METRICS.inc("rag_rerank_requests_total", reranker=rerank)
+            METRICS.inc("rag_reranked_documents_total", len(missing), reranker=rerank)
+            with METRICS.timer("rag_stage_seconds", stage="rerank"):
+                missing_scores = self._reranker(rerank).score(
+                    [documents[i] for i in missing],
+                    query,
+                    query_embedding,
+                    api_key=api_key,
+                    model=model,
+                )
+            scores.update(zip(missing, missing_scores))
+            self.rerank_scores.put_many(
+                query,
+                [contents[i] for i in missing],
+                missing_scores,
+                model_key,
+                datasets,
+            )
+        reranked_docs = [
+            (doc, scores[i]) for i, doc in enumerate(documents) if scores[i] is not None
+        ]
         return sorted(reranked_docs, key=lambda x: x[1], reverse=True)
 
-    def _construct_messages(self, copied_inputs, git_repos, shared, system_prompt):
-        """Construct messages for the OpenAI API call."""
+    def _prompt_budget(self, model: str):
+        """Maximal number of prompt tokens for the model.
+
+        The context window minus the answer, capped to bound prefill time and
+        lowered by a safety margin for tokenizers other than cl100k.
+        """
+        window = MODEL_TYPES.CONTEXT_WINDOWS.get(
+            model, MODEL_TYPES.DEFAULT_CONTEXT_WINDOW
+        )
+        return int(
+            min(window - CONTEXT_SIZE.ANSWER_TOKENS, CONTEXT_SIZE.MAX_PROMPT_TOKENS)
+            * CONTEXT_SIZE.TOKEN_SAFETY
+        )
+
+    def _pack_context(self, copied_inputs, git_repos, shared, system_prompt, model):
+        """Fit the system prompt, history and documents into the token budget.
+
+        The oldest turns are dropped when the conversation alone does not fit.
+        The remaining budget is filled with the best scored documents of the
+        newest question first, then of older questions. The packed contexts
+        are stored in `version_context` and `shared_context` of every kept
+        user message.
+
+        Returns:
+            list: The kept messages.
+        """
+        prompt_budget = self._prompt_budget(model)
+        budget = prompt_budget - count_tokens(system_prompt)
+        source = "\n".join(git_repos + (shared if shared != None else []))
+        turn_tokens = [
+            count_tokens(
+                one_input["content"]
+                if one_input["role"] == "assistant"
+                else PROMPTS.INPUT_PROMPT.format(
+                    source=source,
+                    version_context="",
+                    shared_context="",
+                    question=one_input["content"],
+                )
+            )
+            for one_input in copied_inputs
+        ]
+        start = 0
+        while start < len(copied_inputs) - 1 and (
+            sum(turn_tokens[start:]) > budget
+            or copied_inputs[start]["role"] != "user"
+        ):
+            start += 1
+        kept_inputs = copied_inputs[start:]
+        budget -= sum(turn_tokens[start:])
+
+        reordering = LongContextReorder()
+        for one_input in reversed(kept_inputs):
+            if one_input["role"] != "user":
+                continue
+            version_ids = {id(doc) for doc, _ in one_input["docs"]}
+            selected, used = pack_documents(
+                one_input["docs"] + one_input["shared"], max(0, budget)
+            )
+            budget -= used
+            # Most relevant documents at the start and the end of the context
+            one_input["version_context"] = "\n".join(
+                format_document(doc)
+                for doc in reordering.transform_documents(
+                    [doc for doc in selected if id(doc) in version_ids]
+                )
+            )
+            one_input["shared_context"] = "\n".join(
+                format_document(doc)
+                for doc in reordering.transform_documents(
+                    [doc for doc in selected if id(doc) not in version_ids]
+                )
+            )
+        METRICS.observe("rag_prompt_tokens", prompt_budget - budget)
+        METRICS.inc("rag_prompt_tokens_total", prompt_budget - budget)
+        return kept_inputs
+
+    def _construct_messages(
+        self, copied_inputs, git_repos, shared, system_prompt, model
+    ):
+        """Construct messages for the OpenAI API call within the token budget."""
+        kept_inputs = self._pack_context(
+            copied_inputs, git_repos, shared, system_prompt, model
+        )
         messages = [{"role": "system", "content": system_prompt}]
-        for one_input in copied_inputs:
+        for one_input in kept_inputs:
             role = one_input["role"]
             messages.append(
                 {
@@ -535,12 +1573,8 @@ class RetrivalAugment:
                             source="\n".join(
                                 git_repos + (shared if shared != None else [])
                             ),
-                            version_context="\n".join(
-                                [str(doc) for doc in one_input["docs"]]
-                            ),
-                            shared_context="\n".join(
-                                [str(sh) for sh in one_input["shared"]]
-                            ),
+                            version_context=one_input["version_context"],
+                            shared_context=one_input["shared_context"],
                             question=one_input["content"],
                         )
                     ),
@@ -558,7 +1592,7 @@ class RetrivalAugment:
         api_key: str = None,
         model: str = "gpt-3.5-turbo",
         system_prompt: str = PROMPTS.SYSTEM_PROMPT,
-        rerank: bool = True,
+        rerank: str = "llm",
         preserve_history: bool = True,
         judge_answer: bool = False,
     ):
@@ -579,99 +1613,123 @@ class RetrivalAugment:
         if not preserve_history:
             inputs = inputs[-1:]
 
+        start = time.perf_counter()
+
+        # Rerank with the LLM when only enabled
+        if rerank is True:
+            rerank = "llm"
+
         copied_inputs = inputs.copy()
-        open_api = OpenAI(api_key=api_key, base_url=MODEL_TYPES.LLM_MODELS[model])
+        open_api = self._llm_client(api_key, model)
 
-        # Get most relevant documents for given repos and versions
-        for i, user_in in enumerate(copied_inputs):
-            if user_in["role"] == "user":
-                copied_inputs[i]["docs"] = []
-
-                for repo in git_repos:
-
-                    _, repo_rel_name = os.path.split(repo.removesuffix(".git"))
-                    repo_dir = os.path.dirname(repo)
-                    _, repo_rel_dir = os.path.split(repo_dir)
-
-                    for version in versions:
-                        if f"{repo_rel_dir}/{repo_rel_name}" in version:
-                            _, true_ver = os.path.split(version)
-                            # Get the relevant documents
-                            docs = self.version_specific_documents[repo][true_ver](
-                                user_in["content"],
-                                k=CONTEXT_SIZE.GIT_TO_RANK // len(versions),
-                                fetch_k=CONTEXT_SIZE.GIT_DIVERSE_K // len(versions),
-                            )
-                            if rerank:
-                                docs = self._rerank_documents(
-                                    docs, user_in["content"], api_key, model
-                                )
-                                copied_inputs[i]["docs"] += docs[
-                                    : CONTEXT_SIZE.GIT_DOCUMENTS
-                                ]
-                            else:
-                                copied_inputs[i]["docs"] += docs[
-                                    : max(
-                                        1, CONTEXT_SIZE.GIT_DOCUMENTS // len(versions)
-                                    )
-                                ]
-
-                if rerank:
-                    copied_inputs[i]["docs"] = sorted(
-                        copied_inputs[i]["docs"], key=lambda x: x[1], reverse=True
-                    )[: CONTEXT_SIZE.GIT_DOCUMENTS]
-                    copied_inputs[i]["docs"] = list(
-                        map(lambda x: x[0], copied_inputs[i]["docs"])
-                    )
-                    reordering = LongContextReorder()
-                    copied_inputs[i]["docs"] = reordering.transform_documents(
-                        copied_inputs[i]["docs"]
-                    )
+        # Get most relevant documents for given repos, versions and shared files
+        version_keys = self._version_keys(git_repos, versions)
+        shared_keys = [("shared", share) for share in shared]
 
-        # Get most relevant documents for shared documents
+        # Answer repeated questions without history from the answer cache
+        answer_selection = None
+        if len(copied_inputs) == 1:
+            answer_datasets = self._dataset_names(version_keys + shared_keys)
+            # Judged answers end with their judgment, cached apart
+            answer_selection = AnswerCache.selection_key(
+                answer_datasets,
+                model,
+                "\n".join(
+                    [
+                        system_prompt,
+                        PROMPTS.INPUT_PROMPT,
+                        str(rerank),
+                        PROMPTS.JUDGEMENT_PROMPT if judge_answer else "",
+                    ]
+                ),
+            )
+            answer = self.answers.get(
+                answer_selection, self._embed_query(copied_inputs[0]["content"])
+            )
+            METRICS.inc(
+                "rag_cache_total",
+                cache="answer",
+                result="miss" if answer is None else "hit",
+            )
+            if answer is not None:
+                METRICS.inc("rag_requests_total", source="answer_cache")
+                inputs.append({"role": "assistant", "content": ""})
+                for i in range(0, len(answer), ANSWER_REPLAY_CHUNK):
+                    inputs[-1]["content"] += answer[i : i + ANSWER_REPLAY_CHUNK]
+                    yield inputs
+                METRICS.observe(
+                    "rag_request_seconds",
+                    time.perf_counter() - start,
+                    source="answer_cache",
+                )
+                return
+        METRICS.inc("rag_requests_total", source="model")
+        # Documents of past turns are reused, only new messages are retrieved
+        selection = (
+            tuple(version_keys),
+            tuple(shared_keys),
+            rerank or None,
+            model if rerank == "llm" else None,
+        )
+        missing = []
         for i, user_in in enumerate(copied_inputs):
             if user_in["role"] == "user":
-                copied_inputs[i]["shared"] = []
-
-                for share in shared:
-                    # Get the relevant documents
-                    docs = self.shared_documents[share].querry_documents_small(
-                        user_in["content"],
-                        k=CONTEXT_SIZE.SHARED_TO_RANK // len(shared),
-                        fetch_k=CONTEXT_SIZE.SHARED_DIVERSE_K // len(shared),
-                    )
-                    if rerank:
-                        docs = self._rerank_documents(
-                            docs, user_in["content"], api_key, model
+                retrieved = self._cached_retrieval((user_in["content"],) + selection)
+                METRICS.inc(
+                    "rag_cache_total",
+                    cache="retrieval",
+                    result="miss" if retrieved is None else "hit",
+                )
+                if retrieved is None:
+                    missing.append(i)
+                else:
+                    copied_inputs[i]["docs"], copied_inputs[i]["shared"] = retrieved
+        if len(missing) > 0:
+            retrieval_start = time.perf_counter()
+            with self.datasets.lease(version_keys + shared_keys):
+                version_datasets = self._search_datasets(version_keys)
+                shared_datasets = self._search_datasets(shared_keys)
+                dataset_keys = {
+                    key
+                    for dataset, _ in version_datasets + shared_datasets
+                    for key in dataset.dataset_keys
+                }
+                for i in missing:
+                    copied_inputs[i]["docs"], copied_inputs[i]["shared"] = (
+                        self._retrieve_documents(
+                            copied_inputs[i]["content"],
+                            version_datasets,
+                            shared_datasets,
+                            len(versions),
+                            len(shared),
+                            rerank,
+                            api_key,
+                            model,
                         )
-                        copied_inputs[i]["shared"] += docs[
-                            : CONTEXT_SIZE.SHARED_DOCUMENTS
-                        ]
-                    else:
-                        copied_inputs[i]["shared"] += docs[
-                            : max(1, CONTEXT_SIZE.SHARED_DOCUMENTS // len(shared))
-                        ]
-
-                if rerank:
-                    copied_inputs[i]["shared"] = sorted(
-                        copied_inputs[i]["shared"], key=lambda x: x[1], reverse=True
-                    )[: CONTEXT_SIZE.SHARED_DOCUMENTS]
-                    copied_inputs[i]["shared"] = list(
-                        map(lambda x: x[0], copied_inputs[i]["shared"])
                     )
-                    reordering = LongContextReorder()
-                    copied_inputs[i]["shared"] = reordering.transform_documents(
-                        copied_inputs[i]["shared"]
+                    self._cache_retrieval(
+                        (copied_inputs[i]["content"],) + selection,
+                        copied_inputs[i]["docs"],
+                        copied_inputs[i]["shared"],
+                        dataset_keys,
                     )
+            METRICS.observe(
+                "rag_stage_seconds",
+                time.perf_counter() - retrieval_start,
+                stage="retrieval",
+            )
 
-        messages = self._construct_messages(
-            copied_inputs, git_repos, shared, system_prompt
-        )
+        with METRICS.timer("rag_stage_seconds", stage="prompt"):
+            messages = self._construct_messages(
+                copied_inputs, git_repos, shared, system_prompt, model
+            )
 
+        generation_start = time.perf_counter()
+        first_token = True
         completion = open_api.chat.completions.create(
             model=model,
             messages=messages,
-            max_tokens=2048,
+            max_tokens=CONTEXT_SIZE.ANSWER_TOKENS,
             stream=True,
             temperature=(
                 float(temperature) if (temperature != None and temperature > 0) else 0.7
@@ -685,28 +1743,56 @@ class RetrivalAugment:
                 if chunk.choices[0].delta.content != None
                 else ""
             )
+            if first_token and inputs[-1]["content"] != "":
+                first_token = False
+                METRICS.observe(
+                    "rag_stage_seconds",
+                    time.perf_counter() - generation_start,
+                    stage="first_token",
+                )
             yield inputs
+        METRICS.observe(
+            "rag_stage_seconds",
+            time.perf_counter() - generation_start,
+            stage="generation",
+        )
 
         if judge_answer:
             judgment_prompt = PROMPTS.JUDGEMENT_PROMPT.format(
                 question=copied_inputs[-1]["content"],
                 answer=inputs[-1]["content"],
-                version_context="\n".join(
-                    [str(doc) for doc in copied_inputs[-1]["docs"]]
-                ),
-                shared_context="\n".join(
-                    [str(sh) for sh in copied_inputs[-1]["shared"]]
-                ),
+                version_context=copied_inputs[-1]["version_context"],
+                shared_context=copied_inputs[-1]["shared_context"],
             )
 
-            judgment_response = open_api.chat.completions.create(
-                model=model,
-                messages=[{"role": "user", "content": judgment_prompt}],
-                max_tokens=10,
-                temperature=0.1,
-            )
+            with METRICS.timer("rag_stage_seconds", stage="judgement"):
+                judgment_response = open_api.chat.completions.create(
+                    model=model,
+                    messages=[{"role": "user", "content": judgment_prompt}],
+                    max_tokens=10,
+                    temperature=0.1,
+                )
             print(judgment_response)
             inputs[-1][
                 "content"
             ] += f"\n\nJudgment: {judgment_response.choices[0].message.content}"
             yield inputs
+
+        if answer_selection is not None and inputs[-1]["content"].strip() != "":
+            self.answers.put(
+                answer_selection,
+                answer_datasets,
+                copied_inputs[0]["content"],
+                self._embed_query(copied_inputs[0]["content"]),
+                inputs[-1]["content"],
+            )
+        METRICS.observe(
+            "rag_request_seconds", time.perf_counter() - start, source="model"
+        )
+
+
+def _ingest_worker(cache_repo_list: str, cache_dir: str, args: argparse.Namespace):
+    """Create the job handler of an ingestion worker process."""
+    retrival_class = RetrivalAugment(cache_repo_list, cache_dir, args)
+    retrival_class.ingest_staging = True
+    return retrival_class._run_ingest_job
@@ -0,0 +1,143 @@
+import hashlib
+import sqlite3
+import threading
+import time
+
+
+def normalize_query(query: str):
+    """Normalize case, whitespace and trailing punctuation of a question."""
+    return " ".join(query.lower().split()).rstrip("?!. ")
+
+
+def _hash(text: str):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class RerankScoreCache:
+    """Persistent LRU cache of rerank scores.
+
+    Scores are keyed by (normalized query hash, chunk content hash, model) and
+    stored in SQLite. Every entry records the datasets the chunk was retrieved
+    from, so all entries of a dataset can be dropped when it is re-indexed.
+    Once more than `max_entries` are stored, the least recently used are
+    removed. A `max_entries` of 0 disables the cache.
+    """
+
+    def __init__(self, path: str, max_entries: int = 100000):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.connection = None
+        if max_entries <= 0:
+            return
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            """CREATE TABLE IF NOT EXISTS scores (
+                query_hash TEXT,
+                chunk_hash TEXT,
+                model TEXT,
+                datasets TEXT,
+                score REAL,
+                last_used REAL,
+                PRIMARY KEY (query_hash, chunk_hash, model)
+            )"""
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS scores_last_used ON scores (last_used)"
+        )
+        self.connection.commit()
+
+    def get_many(self, query: str, contents: list[str], model: str):
+        """Look up the cached scores of chunks.
+
+        Returns:
+            dict: Mapping of index of the chunk in `contents` to its score.
+        """
+        if self.connection is None or len(contents) == 0:
+            return {}
+        query_hash = _hash(normalize_query(query))
+        chunk_hashes = [_hash(content) for content in contents]
+        with self.lock:
+            rows = self.connection.execute(
+                f"""SELECT chunk_hash, score FROM scores
+                WHERE query_hash = ? AND model = ?
+                AND chunk_hash IN ({','.join('?' * len(chunk_hashes))})
+                AND score IS NOT NULL""",
+                [query_hash, model] + chunk_hashes,
+            ).fetchall()
+            self.connection.execute(
+                f"""UPDATE scores SET last_used = ?
+                WHERE query_hash = ? AND model = ?
+                AND chunk_hash IN ({','.join('?' * len(chunk_hashes))})""",
+                [time.time(), query_hash, model] + chunk_hashes,
+            )
+            self.connection.commit()
+        scores = dict(rows)
+        return {
+            i: scores[chunk_hash]
+            for i, chunk_hash in enumerate(chunk_hashes)
+            if chunk_hash in scores
+        }
+
+    def put_many(
+        self,
+        query: str,
+        contents: list[str],
+        scores: list[float],
+        model: str,
+        datasets: list[str],
+    ):
+        """Store the scores of chunks retrieved from the given datasets.
+
+        Missing (None) scores are not stored, the chunks are scored again.
+        """
+        entries = [
+            (content, score)
+            for content, score in zip(contents, scores)
+            if score is not None
+        ]
+        if self.connection is None or len(entries) == 0:
+            return
+        query_hash = _hash(normalize_query(query))
+        # Delimited so a dataset can be matched exactly on invalidation
+        datasets = "\n" + "\n".join(datasets) + "\n"
+        now = time.time()
+        with self.lock:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO scores VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (query_hash, _hash(content), model, datasets, score, now)
+                    for content, score in entries
+                ],
+            )
+            self.__evict()
+            self.connection.commit()
+
+    def invalidate(self, dataset: str):
+        """Drop every score of chunks retrieved from the dataset."""
+        if self.connection is None:
+            return
+        with self.lock:
+            self.connection.execute(
+                "DELETE FROM scores WHERE instr(datasets, ?) > 0",
+                ("\n" + dataset + "\n",),
+            )
+            self.connection.commit()
+
+    def __len__(self):
+        if self.connection is None:
+            return 0
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM scores").fetchone()[0]
+
+    def __evict(self):
+        count = self.connection.execute("SELECT COUNT(*) FROM scores").fetchone()[0]
+        if count <= self.max_entries:
+            return
+        # Evict a tenth of the cache at once to not evict on every insert
+        overflow = count - self.max_entries + self.max_entries // 10
+        self.connection.execute(
+            """DELETE FROM scores WHERE rowid IN (
+                SELECT rowid FROM scores ORDER BY last_used LIMIT ?
+            )""",
+            (overflow,),
+        )
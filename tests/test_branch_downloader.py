@@ -0,0 +1,70 @@
+import io
+import os
+import tarfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+from branch_downloader import BranchDownloader
+
+
+def tarball(files: dict):
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w:gz") as archive:
+        for name, content in files.items():
+            info = tarfile.TarInfo(f"repo-main/{name}")
+            info.size = len(content)
+            archive.addfile(info, io.BytesIO(content))
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def server():
+    """Serves chunked tarballs of branch "good", drops "broken" mid-chunk."""
+    body = tarball({"docs/index.md": os.urandom(1 << 18).hex().encode()})
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            if "/tarball/" not in self.path:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            self.wfile.write(f"{len(body):x}\r\n".encode())
+            if self.path.endswith("/good"):
+                self.wfile.write(body + b"\r\n0\r\n\r\n")
+            else:
+                self.wfile.write(body[: len(body) // 2])
+            self.close_connection = True
+
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}/org/repo"
+    httpd.shutdown()
+
+
+def test_dropped_connection_keeps_branch(server, tmp_path):
+    branch_dir = tmp_path / "repo" / "broken"
+    branch_dir.mkdir(parents=True)
+    (branch_dir / "old.md").write_text("old")
+
+    assert not BranchDownloader(timeout=5).download(server, "broken", str(branch_dir))
+    assert os.listdir(tmp_path / "repo") == ["broken"]
+    assert (branch_dir / "old.md").read_text() == "old"
+
+
+def test_dropped_connection_does_not_stop_other_branches(server, tmp_path):
+    downloaded = dict(
+        BranchDownloader(timeout=5).download_many(
+            server, ["broken", "good"], lambda branch: str(tmp_path / branch)
+        )
+    )
+
+    assert downloaded == {"broken": False, "good": True}
+    assert sorted(os.listdir(tmp_path)) == ["good"]
+    assert (tmp_path / "good" / "docs" / "index.md").exists()
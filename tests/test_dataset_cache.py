@@ -0,0 +1,63 @@
+import threading
+import time
+
+from dataset_cache import DatasetCache
+
+
+class FakeDataset:
+    def __init__(self):
+        self.closed = False
+
+    def memory_usage(self):
+        return 1
+
+    def close(self):
+        self.closed = True
+
+
+def test_concurrent_users_wait_for_one_open():
+    cache = DatasetCache()
+    opened = []
+
+    def factory():
+        time.sleep(0.1)
+        opened.append(FakeDataset())
+        return opened[-1]
+
+    cache.register(("shared", "a"), factory)
+    cache.register(("shared", "b"), FakeDataset)
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(cache.get(("shared", "a"))))
+        for _ in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    # Other datasets are not blocked by the slow open
+    start = time.monotonic()
+    cache.get(("shared", "b"))
+    assert time.monotonic() - start < 0.05
+    for thread in threads:
+        thread.join()
+
+    assert len(opened) == 1
+    assert all(result is opened[0] for result in results)
+
+
+def test_replace_waits_for_leases():
+    cache = DatasetCache()
+    cache.register(("shared", "a"), FakeDataset)
+    dataset = cache.get(("shared", "a"))
+    swapped = threading.Event()
+
+    with cache.lease([("shared", "a")]):
+        thread = threading.Thread(
+            target=cache.replace, args=(("shared", "a"), swapped.set)
+        )
+        thread.start()
+        time.sleep(0.05)
+        assert not swapped.is_set()
+    thread.join(1)
+
+    assert swapped.is_set() and dataset.closed
+    assert cache.get(("shared", "a")) is not dataset
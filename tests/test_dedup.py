@@ -0,0 +1,63 @@
+import random
+import string
+from dedup import NearDuplicateIndex
+
+
+def random_text(length: int, rng: random.Random):
+    words = [
+        "".join(rng.choices(string.ascii_lowercase, k=rng.randint(2, 10)))
+        for _ in range(length // 3)
+    ]
+    return " ".join(words)[:length]
+
+
+def test_exact_copies_and_ids():
+    index = NearDuplicateIndex()
+    assert index.add("some  chunk\ncontent", "a")
+    assert not index.add("some chunk content", "b")
+    assert not index.add("other content", "a")
+    assert index.add("other content", "c")
+
+
+def test_contained_chunks_in_both_directions():
+    rng = random.Random(0)
+    chunks = [random_text(1024, rng) for _ in range(200)]
+    index = NearDuplicateIndex()
+    for chunk in chunks:
+        assert index.add(chunk)
+    for chunk in chunks:
+        length = rng.randint(len(chunk) // 5, len(chunk) // 2)
+        start = rng.randrange(len(chunk) - length + 1)
+        assert not index.add(chunk[start : start + length])
+
+    index = NearDuplicateIndex()
+    small = chunks[0][100:300]
+    assert index.add(small)
+    assert not index.add(chunks[0])
+
+
+def test_edited_and_distinct_chunks():
+    rng = random.Random(1)
+    chunks = [random_text(1024, rng) for _ in range(50)]
+    index = NearDuplicateIndex()
+    for chunk in chunks:
+        assert index.add(chunk)
+    for chunk in chunks:
+        i = rng.randrange(len(chunk))
+        assert not index.add(chunk[:i] + "#" + chunk[i + 1 :])
+    for _ in range(50):
+        assert index.add(random_text(1024, rng))
+
+
+def test_common_shingles_do_not_grow_posting_lists():
+    rng = random.Random(2)
+    header = random_text(300, rng)
+    chunks = [header + " " + random_text(700, rng) for _ in range(100)]
+    index = NearDuplicateIndex(max_postings=8)
+    for chunk in chunks:
+        assert index.add(chunk)
+    for chunk in chunks[::10]:
+        assert not index.add(chunk[:-1])
+    assert index.add(header + " " + random_text(700, rng))
+
+    assert max(len(posting) for posting in index.postings.values()) == 8
@@ -0,0 +1,15 @@
+import pytest
+
+pytest.importorskip("langchain.storage")
+
+from embedding_cache import embedding_store
+
+
+def test_vectors_are_stored_as_sharded_float32(tmp_path):
+    store = embedding_store(str(tmp_path), "model")
+    store.mset([("chunk text", [0.5, -1.25, 2.0])])
+
+    assert store.mget(["chunk text", "other"]) == [[0.5, -1.25, 2.0], None]
+    files = [path for path in tmp_path.rglob("*") if path.is_file()]
+    assert len(files) == 1 and files[0].stat().st_size == 12
+    assert files[0].parent.parent == tmp_path / "model"
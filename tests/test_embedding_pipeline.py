@@ -0,0 +1,58 @@
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("langchain_core")
+
+from langchain_core.documents import Document
+
+from embedding_pipeline import EmbeddingPipeline
+
+
+class FlakyEmbeddings:
+    """Fails the first request containing "bad", embeds the text length."""
+
+    def __init__(self):
+        self.failed = False
+        self.lock = threading.Lock()
+
+    def embed_documents(self, texts):
+        with self.lock:
+            if "bad" in texts and not self.failed:
+                self.failed = True
+                raise ConnectionError("embedding server unavailable")
+        return [[float(len(text))] for text in texts]
+
+
+def test_failed_batch_is_retried_without_blocking_others():
+    written = []
+    with EmbeddingPipeline(
+        FlakyEmbeddings(),
+        lambda docs, vectors: written.append((time.monotonic(), docs)),
+        concurrency=2,
+        batch_size=1,
+        min_batch_size=1,
+    ) as pipeline:
+        start = time.monotonic()
+        pipeline.add([Document(page_content=text) for text in ["bad", "a", "b"]])
+        stats = pipeline.close()
+
+    assert stats["retries"] == 1 and stats["chunks"] == 3
+    # The other batches are written during the backoff of the failed one
+    first = {docs[0].page_content: at - start for at, docs in written}
+    assert first["b"] < 0.5 <= first["bad"]
+
+
+def test_executor_is_shut_down_when_retries_run_out():
+    class Failing:
+        def embed_documents(self, texts):
+            raise ConnectionError("embedding server unavailable")
+
+    pipeline = EmbeddingPipeline(Failing(), lambda docs, vectors: None, max_retries=0)
+    with pytest.raises(ConnectionError):
+        with pipeline:
+            pipeline.add([Document(page_content="a")])
+            pipeline.close()
+
+    assert pipeline.executor._shutdown
@@ -0,0 +1,17 @@
+from freshness import FreshnessScheduler
+
+
+def test_branches_without_indexed_sha_are_recorded_not_refreshed():
+    refreshed, recorded = [], []
+    scheduler = FreshnessScheduler(
+        lambda: {},
+        lambda repo: {"main": "b", "dev": "c", "legacy": "d"},
+        lambda repo, branches: refreshed.append(branches),
+        record=lambda repo, heads: recorded.append(heads),
+    )
+    scheduler.close()
+
+    moved = scheduler.check("repo", {"main": "a", "dev": "c", "legacy": ""})
+
+    assert moved == ["main"] and refreshed == [["main"]]
+    assert recorded == [{"legacy": "d"}]
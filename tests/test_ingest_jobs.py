@@ -0,0 +1,21 @@
+from ingest_jobs import IngestJobQueue
+
+
+def test_jobs_of_the_same_dataset_run_one_at_a_time(tmp_path):
+    queue = IngestJobQueue(str(tmp_path / "jobs.sqlite3"))
+    branches = queue.submit("branches", {"repo": "r", "branches": ["main"]}, ["r@main"])
+    assert (
+        queue.submit("branches", {"repo": "r", "branches": ["main"]}, ["r@main"])
+        == branches
+    )
+    reindex = queue.submit("reindex", {"repo": "r", "branch": "main"}, ["r@main"])
+    other = queue.submit("file", {"filename": "f.zip"}, ["f.zip"])
+
+    assert queue.claim(1)["id"] == branches
+    assert queue.claim(2)["id"] == other
+    assert queue.claim(3) is None
+
+    queue.finish(branches, {"indexed": {}})
+    assert queue.claim(3) is None
+    queue.mark_applied(branches)
+    assert queue.claim(3)["id"] == reindex
@@ -0,0 +1,37 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from quantized_index import QuantizedIndex
+
+
+def test_rescored_search_reads_memory_mapped_vectors(tmp_path):
+    vectors = np.random.default_rng(0).normal(size=(200, 32)).astype(np.float32)
+    ids = [f"{i:036d}" for i in range(len(vectors))]
+    path = str(tmp_path / "quantized-index.npz")
+    index = QuantizedIndex(path, "int8", 8)
+    index.add(ids, vectors)
+    index.remove(ids[:1])
+    index.save()
+
+    index = QuantizedIndex(path, "int8", 8)
+    found, scores, found_vectors = index.rescored_search(vectors[5], 3)
+
+    assert index.rescorable and isinstance(index.vectors, np.memmap)
+    assert found[0] == ids[5] and scores[0] == pytest.approx(1.0, abs=1e-5)
+    assert np.allclose(found_vectors[0], vectors[5])
+
+
+def test_index_without_vectors_is_not_rescorable(tmp_path):
+    vectors = np.random.default_rng(0).normal(size=(50, 16)).astype(np.float32)
+    path = str(tmp_path / "quantized-index.npz")
+    index = QuantizedIndex(path, "float16", 8)
+    index.add([f"{i:036d}" for i in range(len(vectors))], vectors)
+    index.save()
+    (tmp_path / "quantized-index-vectors.npy").unlink()
+
+    index = QuantizedIndex(path, "float16", 8)
+    _, _, found_vectors = index.rescored_search(vectors[0], 2)
+
+    assert not index.rescorable
+    assert found_vectors.shape == (2, 8)
@@ -0,0 +1,71 @@
+import math
+from types import SimpleNamespace
+from unittest import mock
+import pytest
+
+rerankers = pytest.importorskip("rerankers")
+
+
+class Logprobs:
+    """Logprobs of a chat completion as returned by the OpenAI client."""
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+
+    def to_dict(self):
+        return {
+            "content": [
+                {"token": token, "logprob": logprob, "bytes": [], "top_logprobs": []}
+                for token, logprob in self.tokens
+            ]
+        }
+
+
+def mock_client(answers: dict):
+    """Client answering with the tokens of the first document in the prompt."""
+
+    def create(messages, **kwargs):
+        prompt = messages[-1]["content"].split("Query: query")[-1]
+        document = min(
+            (document for document in answers if document in prompt),
+            key=prompt.index,
+        )
+        tokens = answers[document]
+        return SimpleNamespace(choices=[SimpleNamespace(logprobs=Logprobs(tokens))])
+
+    client = mock.Mock()
+    client.chat.completions.create.side_effect = create
+    return client
+
+
+def test_llm_reranker_scores_single_documents():
+    client = mock_client(
+        {
+            "first": [("Yes", -0.1)],
+            "second": [("No", -0.2)],
+            "third": [(" Yes", -0.5)],
+        }
+    )
+    reranker = rerankers.LLMReranker(lambda api_key, model: client, batch_size=1)
+    documents = [{"content": name} for name in ["first", "second", "third"]]
+
+    scores = reranker.score(documents, "query", api_key="key", model="model")
+
+    assert client.chat.completions.create.call_count == 3
+    assert all(score is not None for score in scores)
+    assert math.isclose(scores[0], -0.1)
+    assert math.isclose(scores[1], math.log(1 - math.exp(-0.2)))
+    assert math.isclose(scores[2], -0.5)
+
+
+def test_llm_reranker_falls_back_to_single_documents():
+    # One answer line for a batch of two documents cannot be attributed
+    client = mock_client({"first": [("Yes", -0.3)], "second": [("No", -0.05)]})
+    reranker = rerankers.LLMReranker(lambda api_key, model: client, batch_size=2)
+    documents = [{"content": "first"}, {"content": "second"}]
+
+    scores = reranker.score(documents, "query", api_key="key", model="model")
+
+    assert client.chat.completions.create.call_count == 3
+    assert math.isclose(scores[0], -0.3)
+    assert math.isclose(scores[1], math.log(1 - math.exp(-0.05)))
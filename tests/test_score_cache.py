@@ -0,0 +1,10 @@
+from score_cache import RerankScoreCache
+
+
+def test_missing_scores_are_not_stored(tmp_path):
+    cache = RerankScoreCache(str(tmp_path / "scores.sqlite3"))
+    cache.put_many("Query?", ["a", "b"], [-0.5, None], "llm:v2:model", ["repo"])
+
+    assert cache.get_many("query", ["a", "b"], "llm:v2:model") == {0: -0.5}
+    assert cache.get_many("query", ["a"], "llm:v1:model") == {}
+    assert len(cache) == 1